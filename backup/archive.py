@@ -0,0 +1,528 @@
+import os
+import time
+import zlib
+import lzma
+import struct
+import hashlib
+import typing
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from .compression import CompressionPolicy, CODEC_STORE, CODEC_DEFLATE, CODEC_LZMA
+from .checkpoint import CheckpointWriter, CommittedMember
+from .scanner import ScanEntry, SourceFile
+from .delta import DeltaEncoder, get_delta_arcname
+
+DEFAULT_COMPRESSION_LEVEL = 6
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+# number of compressed blocks that may wait for being written (per worker)
+BLOCKS_IN_FLIGHT_PER_WORKER = 4
+
+_DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+_MASK_USE_DATA_DESCRIPTOR = 0x08
+_MASK_COMPRESS_OPTION_1 = 0x02
+# lzma members up to this size are compressed as a whole on the thread pool
+LZMA_PARALLEL_MAX_SIZE = 16 * 1024 * 1024
+# the backup files are checksummed in blocks (stored in the catalog), so verify can
+# check single blocks (sampling) and report where a file is corrupted
+CHECKSUM_BLOCK_SIZE = 8 * 1024 * 1024
+# small files (by the size of the scan) are read ahead on an I/O thread pool, at most
+# PREFETCH_MAX_FILES files / PREFETCH_MAX_BYTES bytes ahead of the archive writer
+SMALL_FILE_SIZE = COMPRESSION_BLOCK_SIZE
+PREFETCH_WORKERS = 16
+PREFETCH_MAX_FILES = 1024
+PREFETCH_MAX_BYTES = 64 * 1024 * 1024
+# prefetched small files are compressed in batches (one task per batch)
+SMALL_FILE_BATCH_FILES = 64
+SMALL_FILE_BATCH_BYTES = COMPRESSION_BLOCK_SIZE
+
+
+def get_default_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def new_block_hash():
+    # blake2b: faster than sha256 in software, part of the standard library
+    return hashlib.blake2b(digest_size=32)
+
+
+def _deflate_block(data: bytes, level: int, is_last: bool) -> bytes:
+    # Every block is compressed independently (raw deflate). Blocks that are not
+    # the last block of a member end with a sync flush, so the compressed blocks
+    # can simply be concatenated to one valid deflate stream (same as pigz).
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+
+
+class TeeWriter:
+    # File like object that writes one stream into several files at once. A
+    # destination that fails (e.g. disk full) is dropped, the others continue.
+    # TeeWriter is not seekable - zipfile then uses data descriptors.
+
+    def __init__(self, files: list[typing.BinaryIO]):
+        self.files: list[typing.BinaryIO] = files
+        self.errors: dict[int, OSError] = {}
+        # the checksums of the stream are calculated while writing
+        self.sha256 = hashlib.sha256()
+        self.block_checksums: list[str] = []
+        self._block_hash = new_block_hash()
+        self._position: int = 0
+
+    def write(self, data: bytes) -> int:
+        for i, f in enumerate(self.files):
+            if i in self.errors:
+                continue
+            try:
+                f.write(data)
+            except OSError as e:
+                self.errors[i] = e
+        if len(self.errors) == len(self.files):
+            raise OSError('Writing failed in all destinations: {}'.format('; '.join(str(e) for e in self.errors.values())))
+        self.sha256.update(data)
+        self._update_blocks(data)
+        return len(data)
+
+    def _update_blocks(self, data: bytes) -> None:
+        view = memoryview(data)
+        while len(view) > 0:
+            length = min(len(view), CHECKSUM_BLOCK_SIZE - self._position % CHECKSUM_BLOCK_SIZE)
+            self._block_hash.update(view[:length])
+            self._position += length
+            view = view[length:]
+            if self._position % CHECKSUM_BLOCK_SIZE == 0:
+                self.block_checksums.append(self._block_hash.hexdigest())
+                self._block_hash = new_block_hash()
+
+    def get_block_checksums(self) -> list[str]:
+        # checksums of all blocks incl. the last (incomplete) block
+        if self._position % CHECKSUM_BLOCK_SIZE != 0:
+            return self.block_checksums + [self._block_hash.hexdigest()]
+        return list(self.block_checksums)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        for i, f in enumerate(self.files):
+            if i in self.errors:
+                continue
+            try:
+                f.flush()
+            except OSError as e:
+                self.errors[i] = e
+
+    def sync(self) -> None:
+        # everything written so far is on disk (checkpoints); uploads (see
+        # backends.Upload) are synced on their own
+        self.flush()
+        for i, f in enumerate(self.files):
+            if i in self.errors:
+                continue
+            try:
+                if hasattr(f, 'sync'):
+                    f.sync()
+                else:
+                    os.fsync(f.fileno())
+            except OSError as e:
+                self.errors[i] = e
+
+    def resume(self, prefix_file: str, offset: int) -> None:
+        # Continues an interrupted stream: the files already contain the first offset
+        # bytes (a copy of them is in prefix_file); the checksums are calculated again.
+        with open(prefix_file, 'rb') as f:
+            remaining = offset
+            while remaining > 0:
+                data = f.read(min(remaining, CHECKSUM_BLOCK_SIZE))
+                if not data:
+                    raise OSError('File is shorter than the checkpoint: {}'.format(prefix_file))
+                self.sha256.update(data)
+                self._update_blocks(data)
+                remaining -= len(data)
+
+
+class _PendingBlock:
+
+    def __init__(self, zinfo: zipfile.ZipInfo, zip64: bool, future: Future, is_first: bool, is_last: bool):
+        self.zinfo = zinfo
+        self.zip64 = zip64
+        self.future = future
+        self.is_first = is_first
+        self.is_last = is_last
+
+
+class _PendingBatch:
+    # the single block members of a batch of small files, compressed in one task
+
+    def __init__(self, zinfos: list[zipfile.ZipInfo], future: Future):
+        self.zinfos = zinfos
+        self.future = future
+
+
+class _SourceMember:
+    # a file that is archived: its member, its state (size, mtime_ns; if needed) and
+    # the prefetched content of a small file
+
+    def __init__(self, filepath: str, zinfo: zipfile.ZipInfo, file_stat: tuple[int, int] = None, data: Future = None):
+        self.filepath = filepath
+        self.zinfo = zinfo
+        self.file_stat = file_stat
+        self.data = data
+
+
+def _store_block(data: bytes, is_last: bool) -> bytes:
+    return data
+
+
+def _get_lzma_compressor(level: int) -> tuple[bytes, lzma.LZMACompressor]:
+    # same as zipfile.LZMACompressor, but with a configurable preset
+    properties = lzma._encode_filter_properties({'id': lzma.FILTER_LZMA1, 'preset': level})
+    compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[lzma._decode_filter_properties(lzma.FILTER_LZMA1, properties)])
+    return struct.pack('<BBH', 9, 4, len(properties)) + properties, compressor
+
+
+def _lzma_member(data: bytes, level: int) -> bytes:
+    header, compressor = _get_lzma_compressor(level)
+    return header + compressor.compress(data) + compressor.flush()
+
+
+def _compress_batch(members: list[tuple[bytes, str]], level: int) -> list[bytes]:
+    # (data, codec) of whole small files -> their compressed member data
+    result: list[bytes] = []
+    for data, codec in members:
+        if codec == CODEC_LZMA:
+            result.append(_lzma_member(data, level))
+        elif codec == CODEC_STORE:
+            result.append(data)
+        else:
+            result.append(_deflate_block(data, level, True))
+    return result
+
+
+def _get_zinfo(filepath: str, arcname: str, entry: ScanEntry = None) -> zipfile.ZipInfo:
+    # same as zipfile.ZipInfo.from_file, but with the stat data of the scan (if known)
+    if entry is None:
+        return zipfile.ZipInfo.from_file(filepath, arcname)
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(entry.mtime_ns / 1e9)[0:6])
+    zinfo.external_attr = (entry.mode & 0xFFFF) << 16
+    zinfo.file_size = entry.size
+    return zinfo
+
+
+class ParallelZipWriter:
+    # Writes a standard zip archive whose members are compressed on a thread pool
+    # (zlib and lzma release the GIL while compressing). Files are read in blocks;
+    # the compressed blocks are written in the order of the input, so the archive
+    # layout is deterministic regardless of the number of workers.
+    #
+    # How each member is compressed is decided by the CompressionPolicy (store,
+    # deflate or lzma). Deflate blocks of large files are compressed in parallel;
+    # lzma members can't be split, so large lzma members are compressed in order.
+    #
+    # write_files takes the ScanEntry of the scan where available: the files are not
+    # stat'ed again, and small files are read ahead on an I/O thread pool and
+    # compressed in batches (see SMALL_FILE_SIZE), so trees of many small files are
+    # not limited by the latency of opening and reading one file after the other.
+    #
+    # delta: large files are stored as deltas against their last backup where
+    # possible (see delta.DeltaEncoder).
+    #
+    # on_skipped: files that vanished or became unreadable since the scan are left out
+    # of the archive and reported with the error (default: the error is raised).
+    #
+    # Example usage:
+    #    with ParallelZipWriter('/tmp/archive.zip', workers=8) as writer:
+    #        writer.write_files(['/path/to/file1', '/path/to/file2'])
+    #        writer.writestr('info.json', '{}')
+
+    def __init__(self, file: typing.Union[str, typing.BinaryIO], workers: int = None, policy: CompressionPolicy = None, checkpoint: CheckpointWriter = None, committed: dict[str, CommittedMember] = None, opener: typing.Callable[[str], typing.BinaryIO] = None, delta: DeltaEncoder = None, on_skipped: typing.Callable[[str, OSError], None] = None):
+        self.workers: int = workers if (workers is not None) and (workers > 0) else get_default_workers()
+        self.policy: CompressionPolicy = policy if policy is not None else CompressionPolicy()
+        compresslevel = self.policy.level if self.policy.codec == CODEC_DEFLATE else DEFAULT_COMPRESSION_LEVEL
+        self.zip = zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._pending: deque[typing.Union[_PendingBlock, _PendingBatch]] = deque()
+        self._max_pending: int = self.workers * BLOCKS_IN_FLIGHT_PER_WORKER
+        # compressed size of the member that is currently written
+        self._compress_size: int = 0
+        # checkpoints: finished members are reported to the checkpoint writer; members
+        # committed by an interrupted run are taken over if their file did not change
+        self.checkpoint: typing.Optional[CheckpointWriter] = checkpoint
+        self._committed: dict[str, CommittedMember] = dict(committed) if committed is not None else {}
+        self._file_stats: dict[str, tuple[int, int]] = {}
+        # opens the files for reading (e.g. throttle.ThrottleGroup.open_source)
+        self._open: typing.Callable[[str], typing.BinaryIO] = opener if opener is not None else (lambda filepath: open(filepath, 'rb'))
+        self.delta: typing.Optional[DeltaEncoder] = delta
+        self.on_skipped: typing.Optional[typing.Callable[[str, OSError], None]] = on_skipped
+
+    def __enter__(self) -> 'ParallelZipWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # pending blocks are dropped; the archive is incomplete anyway
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self.zip.close()
+
+    def write_files(self, files: typing.Iterable[SourceFile]) -> None:
+        # Small files are written in batches of single block members; a large file
+        # (or a path without stat data) is streamed block by block in between, while
+        # the small files behind it are still read ahead.
+        reader = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+        try:
+            batch: list[_SourceMember] = []
+            batch_size = 0
+            for member in self._prefetch(files, reader):
+                if member.data is None:
+                    self._write_batch(batch)
+                    batch, batch_size = [], 0
+                    self._write_member(member)
+                    continue
+                batch.append(member)
+                batch_size += member.zinfo.file_size
+                if (len(batch) >= SMALL_FILE_BATCH_FILES) or (batch_size >= SMALL_FILE_BATCH_BYTES):
+                    self._write_batch(batch)
+                    batch, batch_size = [], 0
+            self._write_batch(batch)
+        finally:
+            reader.shutdown(wait=True, cancel_futures=True)
+
+    def write(self, filepath: str, arcname: str = None, entry: ScanEntry = None) -> None:
+        # entry: the stat data of the scan (the file is not stat'ed again)
+        member = self._get_member(filepath, arcname if arcname is not None else filepath, entry)
+        if member is not None:
+            self._write_member(member)
+
+    def _get_member(self, filepath: str, arcname: str, entry: ScanEntry = None) -> typing.Optional[_SourceMember]:
+        # None: the member of an interrupted run is taken over (see checkpoints) or the file is skipped
+        file_stat = (entry.size, entry.mtime_ns) if entry is not None else None
+        try:
+            zinfo = _get_zinfo(filepath, arcname, entry)
+            if (file_stat is None) and ((self.checkpoint is not None) or (len(self._committed) > 0) or (self.delta is not None)):
+                st = os.stat(filepath)
+                file_stat = (st.st_size, st.st_mtime_ns)
+        except OSError as e:
+            self._skip(filepath, None, e)
+            return None
+        if (self.checkpoint is not None) or (len(self._committed) > 0):
+            committed = self._committed.pop(zinfo.filename, None)
+            if (committed is None) and (self.delta is not None):
+                committed = self._committed.pop(get_delta_arcname(zinfo.filename), None)
+            if (committed is not None) and (committed.size == file_stat[0]) and (committed.mtime_ns == file_stat[1]):
+                if committed.zinfo.filename != zinfo.filename:
+                    self.delta.add_delta(zinfo.filename)
+                self.zip.filelist.append(committed.zinfo)
+                self.zip.NameToInfo[committed.zinfo.filename] = committed.zinfo
+                return None
+            self._file_stats[zinfo.filename] = file_stat
+        return _SourceMember(filepath, zinfo, file_stat)
+
+    def _prefetch(self, files: typing.Iterable[SourceFile], reader: ThreadPoolExecutor) -> typing.Iterator[_SourceMember]:
+        # Yields the members in the order of the input; the content of the small files
+        # is read on the reader pool, up to PREFETCH_MAX_FILES / PREFETCH_MAX_BYTES ahead.
+        window: deque[_SourceMember] = deque()
+        window_bytes = 0
+        for file in files:
+            entry = file if isinstance(file, ScanEntry) else None
+            filepath = entry.path if entry is not None else file
+            member = self._get_member(filepath, filepath, entry)
+            if member is None:
+                continue
+            if (entry is not None) and (entry.size <= SMALL_FILE_SIZE) and ((self.delta is None) or (entry.size < self.delta.min_size)):
+                member.data = reader.submit(self._read_file, filepath)
+                window_bytes += entry.size
+            window.append(member)
+            while (len(window) > PREFETCH_MAX_FILES) or (window_bytes > PREFETCH_MAX_BYTES):
+                member = window.popleft()
+                if member.data is not None:
+                    window_bytes -= member.zinfo.file_size
+                yield member
+        yield from window
+
+    def _read_file(self, filepath: str) -> bytes:
+        with self._open(filepath) as f:
+            return f.read()
+
+    def _skip(self, filepath: str, zinfo: typing.Optional[zipfile.ZipInfo], error: OSError) -> None:
+        # the file vanished or became unreadable since the scan
+        if self.on_skipped is None:
+            raise error
+        if zinfo is not None:
+            self._file_stats.pop(zinfo.filename, None)
+        self.on_skipped(filepath, error)
+
+    def _write_batch(self, batch: list[_SourceMember]) -> None:
+        # the prefetched small files as single block members, compressed in one task
+        if len(batch) == 0:
+            return
+        members: list[tuple[bytes, str]] = []
+        zinfos: list[zipfile.ZipInfo] = []
+        for member in batch:
+            zinfo = member.zinfo
+            try:
+                data = member.data.result()
+            except OSError as e:
+                self._skip(member.filepath, zinfo, e)
+                continue
+            codec = self.policy.get_codec(member.filepath, len(data), data)
+            zinfo.compress_type = zipfile.ZIP_LZMA if codec == CODEC_LZMA else zipfile.ZIP_STORED if codec == CODEC_STORE else zipfile.ZIP_DEFLATED
+            # the file might have changed since the scan
+            zinfo.CRC = zlib.crc32(data)
+            zinfo.file_size = len(data)
+            members.append((data, codec))
+            zinfos.append(zinfo)
+        if len(zinfos) == 0:
+            return
+        future = self._executor.submit(_compress_batch, members, self.policy.level)
+        self._pending.append(_PendingBatch(zinfos, future))
+        self._drain(self._max_pending)
+
+    def _write_member(self, member: _SourceMember) -> None:
+        filepath, zinfo = member.filepath, member.zinfo
+        zinfo.CRC = 0
+        # the file size might change while reading, so zip64 is decided the same way zipfile does
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+
+        try:
+            source = self._open(filepath)
+        except OSError as e:
+            self._skip(filepath, zinfo, e)
+            return
+        if self.delta is not None:
+            arcname = zinfo.filename
+            source = self.delta.open(filepath, zinfo, member.file_stat[0], member.file_stat[1], source)
+            if (zinfo.filename != arcname) and (arcname in self._file_stats):
+                self._file_stats[zinfo.filename] = self._file_stats.pop(arcname)
+        with source as f:
+            block = f.read(COMPRESSION_BLOCK_SIZE)
+            codec = self.policy.get_codec(filepath, zinfo.file_size, block)
+            if codec == CODEC_LZMA:
+                zinfo.compress_type = zipfile.ZIP_LZMA
+                if zinfo.file_size <= LZMA_PARALLEL_MAX_SIZE:
+                    data = block + f.read()
+                    zinfo.CRC = zlib.crc32(data)
+                    zinfo.file_size = len(data)
+                    self._submit(zinfo, zip64, True, True, _lzma_member, data, self.policy.level)
+                else:
+                    header, compressor = _get_lzma_compressor(self.policy.level)
+                    self._write_sequential(zinfo, zip64, f, block, header, compressor)
+                return
+
+            if codec == CODEC_STORE:
+                zinfo.compress_type = zipfile.ZIP_STORED
+                function, args = _store_block, ()
+            else:
+                zinfo.compress_type = zipfile.ZIP_DEFLATED
+                function, args = _deflate_block, (self.policy.level,)
+
+            crc = 0
+            file_size = 0
+            is_first = True
+            while True:
+                next_block = f.read(COMPRESSION_BLOCK_SIZE) if len(block) == COMPRESSION_BLOCK_SIZE else b''
+                is_last = len(next_block) == 0
+                crc = zlib.crc32(block, crc)
+                file_size += len(block)
+                if is_last:
+                    # the CRC and the size are known before the last block is written
+                    zinfo.CRC = crc
+                    zinfo.file_size = file_size
+                self._submit(zinfo, zip64, is_first, is_last, function, block, *args, is_last)
+                if is_last:
+                    break
+                block = next_block
+                is_first = False
+
+    def writestr(self, arcname: str, data: typing.Union[str, bytes]) -> None:
+        self._drain(0)
+        self.zip.writestr(arcname, data)
+
+    def close(self) -> None:
+        try:
+            self._drain(0)
+        finally:
+            self._executor.shutdown(wait=True)
+        self.zip.close()
+
+    def _submit(self, zinfo: zipfile.ZipInfo, zip64: bool, is_first: bool, is_last: bool, function: typing.Callable, *args) -> None:
+        future = self._executor.submit(function, *args)
+        self._pending.append(_PendingBlock(zinfo, zip64, future, is_first, is_last))
+        self._drain(self._max_pending)
+
+    def _drain(self, max_pending: int) -> None:
+        while len(self._pending) > max_pending:
+            pending = self._pending.popleft()
+            if isinstance(pending, _PendingBatch):
+                for zinfo, data in zip(pending.zinfos, pending.future.result()):
+                    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+                    self._write_block(_PendingBlock(zinfo, zip64, None, True, True), data)
+            else:
+                self._write_block(pending, pending.future.result())
+
+    def _write_sequential(self, zinfo: zipfile.ZipInfo, zip64: bool, f: typing.BinaryIO, block: bytes, header: bytes, compressor) -> None:
+        # members with a stateful compressor are compressed in order on this thread
+        self._drain(0)
+        crc = 0
+        file_size = 0
+        self._write_block(_PendingBlock(zinfo, zip64, None, True, False), header)
+        while block:
+            crc = zlib.crc32(block, crc)
+            file_size += len(block)
+            self._write_block(_PendingBlock(zinfo, zip64, None, False, False), compressor.compress(block))
+            block = f.read(COMPRESSION_BLOCK_SIZE)
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        self._write_block(_PendingBlock(zinfo, zip64, None, False, True), compressor.flush())
+
+    def _write_block(self, pending: _PendingBlock, data: bytes) -> None:
+        zip = self.zip
+        zinfo = pending.zinfo
+        if pending.is_first:
+            self._compress_size = 0
+            # lzma data includes an end-of-stream marker
+            flag_bits = _MASK_COMPRESS_OPTION_1 if zinfo.compress_type == zipfile.ZIP_LZMA else 0
+            if pending.is_last:
+                # single block member: all header information is already known
+                zinfo.flag_bits = flag_bits
+                zinfo.compress_size = len(data)
+                self._write_header(zinfo, pending.zip64)
+            else:
+                # CRC and sizes follow in a data descriptor after the member data
+                zinfo.flag_bits = flag_bits | _MASK_USE_DATA_DESCRIPTOR
+                crc, file_size = zinfo.CRC, zinfo.file_size
+                zinfo.CRC, zinfo.file_size, zinfo.compress_size = 0, 0, 0
+                self._write_header(zinfo, pending.zip64)
+                zinfo.CRC, zinfo.file_size = crc, file_size
+
+        zip.fp.write(data)
+        self._compress_size += len(data)
+
+        if pending.is_last:
+            if zinfo.flag_bits & _MASK_USE_DATA_DESCRIPTOR:
+                zinfo.compress_size = self._compress_size
+                if not pending.zip64 and ((zinfo.file_size > zipfile.ZIP64_LIMIT) or (zinfo.compress_size > zipfile.ZIP64_LIMIT)):
+                    raise RuntimeError('File size too large, zip64 is needed: {}'.format(zinfo.filename))
+                fmt = '<LLQQ' if pending.zip64 else '<LLLL'
+                zip.fp.write(struct.pack(fmt, _DATA_DESCRIPTOR_SIGNATURE, zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+            zip.start_dir = zip.fp.tell()
+            zip.filelist.append(zinfo)
+            zip.NameToInfo[zinfo.filename] = zinfo
+            file_stat = self._file_stats.pop(zinfo.filename, None)
+            if (self.checkpoint is not None) and (file_stat is not None):
+                self.checkpoint.add_member(zinfo, file_stat[0], file_stat[1], zip.start_dir)
+
+    def _write_header(self, zinfo: zipfile.ZipInfo, zip64: bool) -> None:
+        # same steps as zipfile.ZipFile._open_to_write, but for data that is
+        # already compressed
+        zip = self.zip
+        if zip._seekable:
+            zip.fp.seek(zip.start_dir)
+        zinfo.header_offset = zip.fp.tell()
+        zip._writecheck(zinfo)
+        zip._didModify = True
+        zip.fp.write(zinfo.FileHeader(zip64))
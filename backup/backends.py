@@ -0,0 +1,462 @@
+import io
+import os
+import json
+import glob
+import typing
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# boto3 is optional - only needed for S3 destinations
+try:
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+BACKEND_LOCAL = 'local'
+BACKEND_S3 = 's3'
+BACKENDS = (BACKEND_LOCAL, BACKEND_S3)
+
+MIB = 1024 * 1024
+DEFAULT_PART_SIZE_MB = 16
+MIN_PART_SIZE_MB = 5                # S3: all parts but the last one have at least 5 MiB
+MAX_PARTS = 10000
+# the part size grows every PART_SIZE_STEP parts (archives larger than part_size * MAX_PARTS)
+PART_SIZE_STEP = 1000
+DEFAULT_MAX_CONNECTIONS = 8
+DELETE_BATCH_SIZE = 1000            # S3: keys per DeleteObjects request
+READ_BUFFER_SIZE = MIB              # ranged reads of restores and verifications
+UPLOAD_STATE_SUFFIX = '.upload'
+
+
+class DestinationBackend:
+    # Storage of the backup files of a destination that is not a local directory.
+    #
+    # The metadata of such a destination - catalog, manifests, checkpoints - is still
+    # kept in its local Destination.directory; the backup files are stored in the
+    # backend instead. A backup file is addressed by the path it would have in the
+    # local directory (e.g. /destination/BACKUP_profile/archive20250101120000.zip),
+    # so the code that works with destination paths does not change. Local
+    # destinations have no backend (see configs.Backend.get_backend).
+
+    def __init__(self, directory: str):
+        self.directory: str = directory
+
+    def get_relpath(self, filepath: str) -> str:
+        # the path below the destination directory, with "/" as separator
+        return os.path.relpath(filepath, self.directory).replace(os.sep, '/')
+
+    def get_filepath(self, relpath: str) -> str:
+        return os.path.join(self.directory, *relpath.split('/'))
+
+    def get_url(self, filepath: str) -> str:
+        raise NotImplementedError()
+
+    def open_upload(self, filepath: str, resume_offset: int = 0, prefix_file: str = None) -> 'Upload':
+        # resume_offset > 0: continues the upload of an interrupted backup; the
+        # first resume_offset bytes of the file are in prefix_file (see checkpoint)
+        raise NotImplementedError()
+
+    def upload_file(self, local_file: str, filepath: str) -> None:
+        raise NotImplementedError()
+
+    def open_file(self, filepath: str) -> typing.BinaryIO:
+        # seekable file object for reading
+        raise NotImplementedError()
+
+    def get_size(self, filepath: str) -> typing.Optional[int]:
+        # None: the file does not exist
+        raise NotImplementedError()
+
+    def list_files(self, prefix: str = '') -> typing.Iterator[tuple[str, int]]:
+        # (filepath, size) of the files of the destination whose path below the
+        # destination directory starts with prefix (e.g. utils.BACKUP_DIR_PREFIX)
+        raise NotImplementedError()
+
+    def delete_files(self, filepaths: list[str]) -> None:
+        raise NotImplementedError()
+
+    def discard_uploads(self, directory: str, keep: str = None) -> list[str]:
+        # Aborts the uploads of interrupted backups (the upload state files in
+        # directory, except the one of the backup file keep). Returns the state files.
+        raise NotImplementedError()
+
+    def abort_uploads(self, cutoff: datetime, prefix: str = '') -> int:
+        # Aborts the uploads started before the cutoff whose path starts with
+        # prefix (see list_files). Returns their number.
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class Upload:
+    # Write-only file object that uploads a backup file into a backend. The file
+    # appears in the backend only on complete(); close() keeps an unfinished upload
+    # (it can be resumed or aborted later).
+
+    def write(self, data: bytes) -> int:
+        raise NotImplementedError()
+
+    def flush(self) -> None:
+        pass
+
+    def sync(self) -> None:
+        # everything written so far is stored (checkpoints)
+        raise NotImplementedError()
+
+    def complete(self) -> None:
+        raise NotImplementedError()
+
+    def abort(self) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+def get_upload_state_filepath(backup_file: str) -> str:
+    # hidden file in the local destination directory, next to the checkpoint (see checkpoint.get_checkpoint_filepath)
+    return os.path.join(os.path.dirname(backup_file), '.' + os.path.basename(backup_file) + UPLOAD_STATE_SUFFIX)
+
+
+def _load_upload_state(state_file: str) -> typing.Optional[dict]:
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_upload_state(state_file: str, state: dict) -> None:
+    temp_file = state_file + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, state_file)
+
+
+def _remove_file(filepath: str) -> None:
+    if os.path.exists(filepath):
+        os.remove(filepath)
+
+
+class S3Backend(DestinationBackend):
+    # Destination in an S3 compatible object storage (AWS, MinIO, Ceph, ...).
+    #
+    # The backup files are stored as objects under prefix + their path below the
+    # destination directory. All requests share one client whose connection pool has
+    # max_connections connections; the parts of the uploads are sent on a thread pool
+    # of the same size. endpoint_url: other services than AWS (e.g. a local MinIO).
+    # Without credentials the default credential chain of boto3 is used (environment,
+    # ~/.aws/credentials, instance profile).
+    #
+    # Example usage:
+    #    backend = S3Backend('/var/backup/s3', 'backups', 'host1/', endpoint_url='http://localhost:9000')
+    #    with backend.open_file('/var/backup/s3/BACKUP_documents/archive20250101120000.zip') as f:
+    #        data = f.read()
+
+    def __init__(self, directory: str, bucket: str, prefix: str = '', endpoint_url: str = None, region: str = None, access_key_id: str = None,
+                 secret_access_key: str = None, part_size: int = DEFAULT_PART_SIZE_MB * MIB, max_connections: int = DEFAULT_MAX_CONNECTIONS):
+        super().__init__(directory)
+        if boto3 is None:
+            raise Exception('S3 destinations require the python package "boto3"')
+        self.bucket: str = bucket
+        self.prefix: str = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.part_size: int = part_size
+        self.max_connections: int = max_connections
+        config = botocore.config.Config(max_pool_connections=max_connections, retries={'max_attempts': 10, 'mode': 'standard'})
+        self.client = boto3.session.Session().client('s3', endpoint_url=endpoint_url, region_name=region, aws_access_key_id=access_key_id,
+                                                     aws_secret_access_key=secret_access_key, config=config)
+        self._executor: typing.Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def get_key(self, filepath: str) -> str:
+        return self.prefix + self.get_relpath(filepath)
+
+    def get_url(self, filepath: str) -> str:
+        return 's3://{}/{}'.format(self.bucket, self.get_key(filepath))
+
+    def call(self, operation: str, **kwargs) -> dict:
+        # client errors are OSErrors like the errors of local destinations
+        try:
+            return getattr(self.client, operation)(**kwargs)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            raise OSError('S3 {} failed for s3://{}/{}: {}'.format(operation, self.bucket, kwargs.get('Key', self.prefix), e)) from e
+
+    def paginate(self, operation: str, **kwargs) -> typing.Iterator[dict]:
+        try:
+            yield from self.client.get_paginator(operation).paginate(**kwargs)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            raise OSError('S3 {} failed for s3://{}/{}: {}'.format(operation, self.bucket, kwargs.get('Key', self.prefix), e)) from e
+
+    def submit(self, function, *args) -> Future:
+        # the thread pool of the part uploads (shared by all uploads of the destination)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix='s3')
+            return self._executor.submit(function, *args)
+
+    def open_upload(self, filepath: str, resume_offset: int = 0, prefix_file: str = None) -> 'MultipartUpload':
+        key = self.get_key(filepath)
+        state_file = get_upload_state_filepath(filepath)
+        parts: list[dict] = []
+        upload_id = None
+        if resume_offset > 0:
+            state = _load_upload_state(state_file)
+            if (state is not None) and (state.get('key') == key):
+                upload_id, parts = state['upload_id'], self._get_resumable_parts(key, state, resume_offset)
+                if parts is None:
+                    self._abort(key, upload_id)
+                    upload_id, parts = None, []
+        if upload_id is None:
+            upload_id = self.call('create_multipart_upload', Bucket=self.bucket, Key=key)['UploadId']
+        upload = MultipartUpload(self, key, upload_id, state_file, parts)
+        # the state is saved right away: an interrupted upload can be found and aborted (see discard_uploads)
+        upload.save_state()
+        if resume_offset > 0:
+            # the bytes between the parts that are kept and the checkpoint
+            offset = sum(part['Size'] for part in parts)
+            with open(prefix_file, 'rb') as f:
+                f.seek(offset)
+                remaining = resume_offset - offset
+                while remaining > 0:
+                    data = f.read(min(remaining, self.part_size))
+                    if not data:
+                        raise OSError('File is shorter than the checkpoint: {}'.format(prefix_file))
+                    upload.write(data)
+                    remaining -= len(data)
+        return upload
+
+    def _get_resumable_parts(self, key: str, state: dict, resume_offset: int) -> typing.Optional[list[dict]]:
+        # The parts of the interrupted upload that are stored and lie completely before
+        # the checkpoint (parts uploaded after the last checkpoint are written again).
+        # None: the upload does not exist any more.
+        try:
+            stored = {part['PartNumber']: part for page in self.paginate('list_parts', Bucket=self.bucket, Key=key, UploadId=state['upload_id'])
+                      for part in page.get('Parts', [])}
+        except OSError:
+            return None
+        parts: list[dict] = []
+        offset = 0
+        for part in sorted(state.get('parts', []), key=lambda part: part['PartNumber']):
+            stored_part = stored.get(part['PartNumber'])
+            if (part['PartNumber'] != len(parts) + 1) or (stored_part is None) or (stored_part['ETag'] != part['ETag']) or (stored_part['Size'] != part['Size']):
+                break
+            if offset + part['Size'] > resume_offset:
+                break
+            parts.append(part)
+            offset += part['Size']
+        return parts
+
+    def _abort(self, key: str, upload_id: str) -> None:
+        try:
+            self.call('abort_multipart_upload', Bucket=self.bucket, Key=key, UploadId=upload_id)
+        except OSError:
+            # e.g. the upload was already completed or aborted
+            pass
+
+    def upload_file(self, local_file: str, filepath: str) -> None:
+        # small files (volume indexes) in one request
+        with open(local_file, 'rb') as f:
+            self.call('put_object', Bucket=self.bucket, Key=self.get_key(filepath), Body=f.read())
+
+    def open_file(self, filepath: str) -> typing.BinaryIO:
+        key = self.get_key(filepath)
+        size = self.call('head_object', Bucket=self.bucket, Key=key)['ContentLength']
+        return io.BufferedReader(S3ObjectReader(self, key, size), READ_BUFFER_SIZE)
+
+    def get_size(self, filepath: str) -> typing.Optional[int]:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.get_key(filepath))['ContentLength']
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise OSError('S3 head_object failed for {}: {}'.format(self.get_url(filepath), e)) from e
+        except botocore.exceptions.BotoCoreError as e:
+            raise OSError('S3 head_object failed for {}: {}'.format(self.get_url(filepath), e)) from e
+
+    def list_files(self, prefix: str = '') -> typing.Iterator[tuple[str, int]]:
+        for page in self.paginate('list_objects_v2', Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for item in page.get('Contents', []):
+                yield self.get_filepath(item['Key'][len(self.prefix):]), item['Size']
+
+    def delete_files(self, filepaths: list[str]) -> None:
+        # DeleteObjects takes up to DELETE_BATCH_SIZE keys per request
+        keys = [self.get_key(filepath) for filepath in filepaths]
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            response = self.call('delete_objects', Bucket=self.bucket, Delete={'Objects': [{'Key': key} for key in keys[i:i + DELETE_BATCH_SIZE]], 'Quiet': True})
+            errors = response.get('Errors', [])
+            if len(errors) > 0:
+                raise OSError('S3 delete_objects failed for {} objects, e.g. s3://{}/{}: {}'.format(len(errors), self.bucket, errors[0].get('Key'), errors[0].get('Message')))
+
+    def discard_uploads(self, directory: str, keep: str = None) -> list[str]:
+        discarded: list[str] = []
+        for state_file in glob.glob(os.path.join(glob.escape(directory), '.*' + UPLOAD_STATE_SUFFIX)):
+            if (keep is not None) and (os.path.basename(state_file) == os.path.basename(get_upload_state_filepath(keep))):
+                continue
+            state = _load_upload_state(state_file)
+            if state is not None:
+                self._abort(state['key'], state['upload_id'])
+            _remove_file(state_file)
+            discarded.append(state_file)
+        return discarded
+
+    def abort_uploads(self, cutoff: datetime, prefix: str = '') -> int:
+        # e.g. uploads of backups that were killed before they could clean up
+        count = 0
+        cutoff = cutoff.astimezone()        # local time -> aware (the initiation time is in UTC)
+        for page in self.paginate('list_multipart_uploads', Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for upload in page.get('Uploads', []):
+                if upload['Initiated'] < cutoff:
+                    self._abort(upload['Key'], upload['UploadId'])
+                    count += 1
+        return count
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+class MultipartUpload(Upload):
+    # Streams a backup file into an S3 object (multipart upload) - no local copy is
+    # needed. The stream is cut into parts (see S3Backend.part_size) that are uploaded
+    # on the thread pool of the backend while the stream goes on; at most
+    # max_connections parts of an upload are in flight, so the memory is bounded.
+    #
+    # sync() waits for the parts in flight and saves the upload id and the uploaded
+    # parts to the upload state file - a resumed backup continues the upload after
+    # these parts (see S3Backend.open_upload).
+
+    def __init__(self, backend: S3Backend, key: str, upload_id: str, state_file: str, parts: list[dict]):
+        self.backend: S3Backend = backend
+        self.key: str = key
+        self.upload_id: str = upload_id
+        self.state_file: str = state_file
+        self._parts: dict[int, dict] = {part['PartNumber']: part for part in parts}
+        self._pending: dict[int, Future] = {}
+        self._next_part: int = len(parts) + 1
+        self._buffer = bytearray()
+        self._slots = threading.BoundedSemaphore(backend.max_connections)
+
+    def _get_part_size(self) -> int:
+        return self.backend.part_size * (1 + (self._next_part - 1) // PART_SIZE_STEP)
+
+    def write(self, data: bytes) -> int:
+        self._collect(wait=False)
+        self._buffer += data
+        while len(self._buffer) >= self._get_part_size():
+            size = self._get_part_size()
+            self._submit(bytes(self._buffer[:size]))
+            del self._buffer[:size]
+        return len(data)
+
+    def _submit(self, data: bytes) -> None:
+        if self._next_part > MAX_PARTS:
+            raise OSError('Too many parts for s3://{}/{} - increase the part size'.format(self.backend.bucket, self.key))
+        self._slots.acquire()
+        try:
+            future = self.backend.submit(self._upload_part, self._next_part, data)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        self._pending[self._next_part] = future
+        self._next_part += 1
+
+    def _upload_part(self, number: int, data: bytes) -> dict:
+        response = self.backend.call('upload_part', Bucket=self.backend.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data)
+        return {'PartNumber': number, 'ETag': response['ETag'], 'Size': len(data)}
+
+    def _collect(self, wait: bool) -> None:
+        # finished parts; raises the error of a failed part
+        for number, future in list(self._pending.items()):
+            if wait or future.done():
+                del self._pending[number]
+                self._parts[number] = future.result()
+
+    def save_state(self) -> None:
+        parts = [self._parts[number] for number in sorted(self._parts)]
+        _save_upload_state(self.state_file, {'key': self.key, 'upload_id': self.upload_id, 'parts': parts})
+
+    def sync(self) -> None:
+        # the data after the last full part is not uploaded yet - a resumed backup
+        # takes it from the temporary file of a local destination
+        self._collect(wait=True)
+        self.save_state()
+
+    def complete(self) -> None:
+        if (len(self._buffer) > 0) or (self._next_part == 1):
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._collect(wait=True)
+        parts = [{'PartNumber': number, 'ETag': self._parts[number]['ETag']} for number in sorted(self._parts)]
+        self.backend.call('complete_multipart_upload', Bucket=self.backend.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+        _remove_file(self.state_file)
+
+    def abort(self) -> None:
+        self.close()
+        self.backend._abort(self.key, self.upload_id)
+        _remove_file(self.state_file)
+
+    def close(self) -> None:
+        # the parts in flight are finished (or failed); the upload itself is kept
+        for future in self._pending.values():
+            future.cancel()
+        for future in self._pending.values():
+            if not future.cancelled():
+                future.exception()
+        self._pending.clear()
+        self._buffer = bytearray()
+
+
+class S3ObjectReader(io.RawIOBase):
+    # Seekable reader of an object (ranged GET requests); wrapped in a BufferedReader
+    # by S3Backend.open_file. Zip archives are read with random access like local files.
+
+    def __init__(self, backend: S3Backend, key: str, size: int):
+        self.backend: S3Backend = backend
+        self.key: str = key
+        self.size: int = size
+        self._position: int = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError('Invalid seek position: {}'.format(offset))
+        self._position = offset
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), self.size - self._position)
+        if length <= 0:
+            return 0
+        response = self.backend.call('get_object', Bucket=self.backend.bucket, Key=self.key, Range='bytes={}-{}'.format(self._position, self._position + length - 1))
+        count = 0
+        with response['Body'] as body:
+            view = memoryview(buffer)
+            while count < length:
+                data = body.read(length - count)
+                if not data:
+                    break
+                view[count:count + len(data)] = data
+                count += len(data)
+        self._position += count
+        return count
@@ -1,13 +1,28 @@
 import os
-import shutil
+import time
 import datetime
-import tempfile
 import typing
+import itertools
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from .configs import ConfigObject, Profile, Destination
+from .configs import ConfigObject, Profile, Destination, get_config_filepath
 from .logmgr import LogManager
-from .utils import filter_files, create_zip, copy_file, open_with_editor
+from .utils import iter_files, prefetch, CountingIterator, WriteResult, create_archive, parse_backup_time, get_arcname, open_with_editor, BACKUP_FILENAME_FORMAT_DATETIMESTAMP
+from .manifest import Manifest, ChangeDetector, BACKUP_MODE_FULL, BACKUP_MODE_INCREMENTAL, load_manifest, save_manifest, needs_full_backup
+from .scanner import ScanEntry, IgnoreMatcher, DEFAULT_SCAN_WORKERS
+from .chunkstore import STORAGE_ARCHIVE, STORAGE_CHUNKS, store_snapshot, cleanup_chunk_store
+from .catalog import Catalog, BackupRecord, FileRecord, FileIndexStage, BACKUP_KIND_ARCHIVE, BACKUP_KIND_SNAPSHOT
+from .archive import CHECKSUM_BLOCK_SIZE, get_default_workers
+from .metrics import RunMetrics, RunProfiler, BYTES_READ, BYTES_WRITTEN, ARCHIVE_INPUT, ARCHIVE_SIZE
+from .checkpoint import Checkpoint, find_checkpoint, discard_checkpoints
+from .compression import FORMAT_ZIP
+from .journal import get_journal_file, load_journal, iter_journal_files, mark_backup
+from .throttle import Throttle, ThrottleGroup, set_process_priority, MIB
+from .planner import ScanPlan
+from .backends import DestinationBackend, BACKEND_LOCAL
+from .delta import DeltaEncoder, commit_signatures, discard_signatures
 
 
 class BackupManager():
@@ -23,10 +38,26 @@ class BackupManager():
         self.log = LogManager(self.backup_time)
 
         # load configurations (from config.json file)
-        self.config_filepath: str = os.path.join(os.path.dirname(__file__), 'config.json') 
+        self.config_filepath: str = get_config_filepath(self.args.config)
         if not os.path.isfile(self.config_filepath):
             raise Exception('Config file not found. Please ensure that the file is present:\n{}'.format(self.config_filepath))
         self.configs = ConfigObject(self.config_filepath, self.log)
+        self.log.configure(self.configs.settings.log_directory, self.configs.settings.log_level)
+
+        # timers and counters of this run (see metrics.RunMetrics)
+        self.metrics = RunMetrics(self.backup_time, self.configs.settings.slowest_files)
+
+        # I/O limits (see throttle); a destination's throttle is shared by all profiles
+        self._profile_throttles: dict[str, Throttle] = {}
+        self._destination_throttles: dict[str, Throttle] = {}
+        self._lock = threading.Lock()
+
+        # destinations that are not local directories (see backends), by destination id
+        self._backends: dict[str, DestinationBackend] = {}
+
+        # concurrent profiles (see _do_concurrent_backup): one scan for all of them
+        self._scan_plan: typing.Optional[ScanPlan] = None
+        self._concurrent_profiles: int = 1
 
 
     def _do_backup(self, profiles: list[Profile], destinations: list[Destination]) -> None:
@@ -34,45 +65,484 @@ class BackupManager():
             self.log.log_hint('Backup process completed. No valid and active profiles or destinations defined.\n')
             return
 
+        if (len(profiles) > 1) and self.configs.settings.concurrent_profiles:
+            self._do_concurrent_backup(profiles, destinations)
+        else:
+            for profile in profiles:
+                self._do_profile_backup(profile, destinations)
+
+        # the limits of a destination are shared by the profiles
+        for destination_id, throttle in self._destination_throttles.items():
+            if throttle.delay > 0:
+                self.metrics.add_time('throttled', throttle.delay)
+                self.log.log_hint('I/O limits of destination {}: delayed by {:.1f} seconds.'.format(destination_id, throttle.delay))
+
+        self.log.log_hint('Backup process completed!\n')
+
+
+    def _do_profile_backup(self, profile: Profile, destinations: list[Destination]) -> None:
+        self.log.log_hint('\n[{}]:: Start backup of file system (profile: "{}")'.format(profile.id, profile.id))
+
+        now = datetime.datetime.now()
+        archive_destinations = [destination for destination in destinations if destination.storage == STORAGE_ARCHIVE]
+        chunk_destinations = [destination for destination in destinations if destination.storage == STORAGE_CHUNKS]
+        throttle = self._get_profile_throttle(profile)
+        delay = throttle.delay
+        with self.metrics.stage('backup', profile.id):
+            if len(archive_destinations) > 0:
+                self._do_archive_backup(profile, archive_destinations, now)
+            if len(chunk_destinations) > 0:
+                self._do_snapshot_backup(profile, chunk_destinations, now)
+        delay = throttle.delay - delay
+        if delay > 0:
+            self.metrics.add_time('throttled', delay, profile.id)
+            self.log.log_hint('[{}]:: I/O limits: delayed by {:.1f} seconds.'.format(profile.id, delay))
+
+
+    def _do_concurrent_backup(self, profiles: list[Profile], destinations: list[Destination]) -> None:
+        # The sources of all profiles are scanned in one pass (see planner.ScanPlan)
+        # and the profiles are archived at the same time; they share the compression
+        # workers (see _get_workers). Profiles whose sources overlap do not walk the
+        # same directories again.
+        self.log.log_hint('Backing up {} profiles concurrently (one scan of their sources).'.format(len(profiles)))
+        self._scan_plan = ScanPlan(min(self._get_scan_workers(profile) for profile in profiles))
         for profile in profiles:
-            self.log.log_hint('\n[{}]:: Start backup of file system (profile: "{}")'.format(profile.id, profile.id))
-            self.log.log_hint('[{}]:: Collecting files...'.format(profile.id))
-
-            files = filter_files(profile.source, profile.ignore)
-
-            self.log.log_hint('[{}]:: Found {} files to back up.'.format(profile.id, len(files)))
-            if len(files) == 0: 
-                self.log.log_hint('[{}]:: Please check the configuration file {}'.format(profile.id, self.config_filepath))
-                return
-            
-            if not self.args.dryrun:
-                # we create a compressed archive of the file system in a temporary dictionary
-                self.log.log_hint('[{}]:: Creating backup...'.format(profile.id))
-                temp_dir = tempfile.mkdtemp()
-                try: 
-                    backup_file = create_zip(files, temp_dir)
-
-                    self.log.log_hint('[{}]:: Copying backup to {} backup destinations...'.format(profile.id, len(destinations)))
-                    destination_foldername = 'BACKUP_{}'.format(profile.id)
-                    for destination in destinations:
-                        destination_path = os.path.join(destination.directory, destination_foldername)
-                        copy_file(backup_file, destination_path)  
-                        self.log.log_hint('[{}]:: File system backed up to:\n{}\n'.format(profile.id, destination_path + '/' + os.path.basename(backup_file)))
-
-                finally:
-                    #remove artifacts
-                    if temp_dir and os.path.isdir(temp_dir):
-                        shutil.rmtree(temp_dir)
+            self._scan_plan.add_profile(profile.id, profile.source, profile.ignore, self._get_profile_throttle(profile))
+        self._concurrent_profiles = len(profiles)
+        self._scan_plan.start()
+
+        def backup_profile(profile: Profile) -> None:
+            try:
+                self._do_profile_backup(profile, destinations)
+            finally:
+                # e.g. incremental backups with a change journal do not take the scanned files
+                self._scan_plan.release(profile.id)
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(profiles), thread_name_prefix='profile') as executor:
+                futures = [executor.submit(backup_profile, profile) for profile in profiles]
+            # like the sequential run: an unexpected error ends the run (after the other profiles are done)
+            for future in futures:
+                future.result()
+        finally:
+            self._scan_plan.close()
+            self._scan_plan = None
+            self._concurrent_profiles = 1
+
+
+    def _collect_files(self, profile: Profile, journal_files: typing.Iterator[ScanEntry] = None) -> typing.Optional[typing.Iterator[ScanEntry]]:
+        # Starts the scan of the profile's file system (or reads the files from the
+        # change journal, see _read_journal). The files are streamed: the scan runs in
+        # the background while the files are already being archived.
+        # Returns None if there are no files at all.
+        self.log.log_hint('[{}]:: Collecting files...'.format(profile.id))
+        planned = self._scan_plan.take(profile.id) if (journal_files is None) and (self._scan_plan is not None) else None
+        if planned is not None:
+            # the shared scan already runs in the background
+            files = self.metrics.time_scan(planned, profile.id)
+        else:
+            files = journal_files if journal_files is not None else iter_files(profile.source, profile.ignore, self._get_scan_workers(profile), self._get_profile_throttle(profile))
+            files = prefetch(self.metrics.time_scan(files, profile.id))
+        first = next(files, None)
+        if first is None:
+            self.log.log_hint('[{}]:: Found 0 files to back up.'.format(profile.id))
+            self.log.log_hint('[{}]:: Please check the configuration file {}'.format(profile.id, self.config_filepath))
+            return None
+        return itertools.chain([first], files)
+
+
+    def _do_archive_backup(self, profile: Profile, destinations: list[Destination], now: datetime.datetime) -> None:
+        destination_foldername = 'BACKUP_{}'.format(profile.id)
+        destination_paths = [os.path.join(destination.directory, destination_foldername) for destination in destinations]
+
+        # an interrupted backup is continued (--resume) or its leftovers are deleted
+        resume = self._get_checkpoint(profile, destinations, destination_paths)
+        if resume is not None:
+            now = datetime.datetime.strptime(resume.backup_time, BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+
+        # incremental backups: only new or changed files are archived
+        previous_manifest = None
+        is_full_backup = True
+        detector = None
+        if profile.mode == BACKUP_MODE_INCREMENTAL:
+            previous_manifest = load_manifest(destination_paths)
+            if resume is not None:
+                # the resumed archive keeps the mode it was started with
+                is_full_backup = (resume.mode == BACKUP_MODE_FULL) or (previous_manifest is None)
             else:
-                self.log.log_hint('Dry run. No backup is created.')            
+                is_full_backup = needs_full_backup(previous_manifest, profile.days_between_full, now, BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+                if (not is_full_backup) and (not self._has_backup_chain(profile, destinations, destination_paths, previous_manifest)):
+                    is_full_backup = True
+                if (not is_full_backup) and any(not os.path.isabs(filepath) for filepath in previous_manifest.files):
+                    # the last backup was made before relative sources were resolved (see
+                    # configs.resolve_source): its files are known under other names
+                    self.log.log_warning('[{}]:: Incremental mode: the last backup has relative file names, relative sources are archived with their absolute path now - creating a full backup.'.format(profile.id))
+                    is_full_backup = True
+            if is_full_backup:
+                previous_manifest = None
+                self.log.log_hint('[{}]:: Incremental mode: creating a full backup.'.format(profile.id))
 
-        self.log.log_hint('Backup process completed!\n')
+        # with a change journal of the watch daemon the sources are not scanned
+        journal_files = self._read_journal(profile, previous_manifest) if (previous_manifest is not None) and (resume is None) else None
+        files = self._collect_files(profile, journal_files)
+        if files is None:
+            return
+        files = CountingIterator(files)
+
+        if profile.mode == BACKUP_MODE_INCREMENTAL:
+            detector = ChangeDetector(previous_manifest, profile.manifest_hash)
+            entries = detector.iter_changed(files)
+            if not is_full_backup:
+                # do not create an empty archive, if nothing changed at all
+                first = next(entries, None)
+                if (first is None) and (len(detector.get_deleted()) == 0):
+                    self.log.log_hint('[{}]:: Found {} files to back up.'.format(profile.id, files.count))
+                    self.log.log_hint('[{}]:: No changes since the last backup.'.format(profile.id))
+                    return
+                entries = itertools.chain([first] if first is not None else [], entries)
+        else:
+            entries = files
+        entries = self.metrics.time_files(entries, profile.id)
+        if self.args.dryrun:
+            for _ in entries:
+                pass
+            self.log.log_hint('[{}]:: Found {} files to back up.'.format(profile.id, files.count))
+            if detector is not None:
+                self.log.log_hint('[{}]:: Incremental mode: {} new or changed files, {} deleted files.'.format(profile.id, detector.changed_count, len(detector.get_deleted())))
+            self.log.log_hint('Dry run. No backup is created.')
+            return
+
+        # the file index of the archive is streamed into a temporary file and stored in the
+        # catalogs when the archive is complete (used by restores, see catalog.FileIndexStage)
+        with FileIndexStage(destination_paths) as file_index:
+            # the ScanEntry items are passed on: the archive writer reuses their stat data
+            filepaths = self._index_files(entries, file_index)
+
+            # the compressed archive is streamed into all destinations at once
+            self.log.log_hint('[{}]:: Creating backup in {} backup destinations...'.format(profile.id, len(destinations)))
+            get_deleted_files = detector.get_deleted if detector is not None else None
+            bytes_read = self.metrics.get_counter(BYTES_READ, profile.id)
+            with self.metrics.stage('archive', profile.id):
+                mode = BACKUP_MODE_FULL if is_full_backup else BACKUP_MODE_INCREMENTAL
+                backup_info = {'profile': profile.id, 'backup_time': now.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP), 'mode': mode}
+                # checkpoints: single zip archives only (volumes of a set are complete archives anyway);
+                # a resumed upload needs the temporary file of a local destination
+                backends = self._get_backends(destinations, destination_paths)
+                checkpoint_interval = self.configs.settings.checkpoint_interval if (profile.compression.format == FORMAT_ZIP) and (profile.volume_size == 0) else 0
+                if len(backends) == len(destinations):
+                    checkpoint_interval = 0
+                delta = self._get_delta_encoder(profile, destination_paths, now, previous_manifest, resume)
+                result = create_archive(filepaths, destination_paths, profile.compression.format, profile.compression.get_policy(), get_deleted_files, self._get_workers(profile), backup_info,
+                                        checkpoint_interval, resume, profile.get_volume_size(), self._get_throttles(profile, destinations, destination_paths), backends, delta,
+                                        detector.discard if detector is not None else None)
+            backup_files, errors = result.backup_files, result.errors
+            # files that vanished or became unreadable since the scan are not part of the backup
+            for filepath, error in result.skipped.items():
+                self.log.log_error('[{}]:: Cannot back up file {}: {}'.format(profile.id, filepath, error), profile=profile.id, path=filepath)
+            file_index.remove(get_arcname(filepath) for filepath in result.skipped)
+            self.metrics.count(ARCHIVE_INPUT, self.metrics.get_counter(BYTES_READ, profile.id) - bytes_read, profile.id)
+            self.metrics.count(ARCHIVE_SIZE, result.size, profile.id)
+            self.metrics.count(BYTES_WRITTEN, result.size * len(backup_files), profile.id)
+            for destination_path, seconds in result.durations.items():
+                self.metrics.add_destination(profile.id, destination_path, result.size, seconds)
+            self.log.log_hint('[{}]:: Found {} files to back up.'.format(profile.id, files.count))
+            if detector is not None:
+                self.log.log_hint('[{}]:: Incremental mode: {} new or changed files, {} deleted files.'.format(profile.id, detector.changed_count, len(detector.get_deleted())))
+            if (delta is not None) and (len(delta.arcnames) > 0):
+                self.log.log_hint('[{}]:: Delta mode: {} files stored as deltas ({:.1f} MiB of {:.1f} MiB).'.format(profile.id, len(delta.arcnames), delta.output_size / MIB, delta.input_size / MIB))
+                file_index.set_delta(delta.arcnames)
+            for destination_path, error in errors.items():
+                self.log.log_error('[{}]:: Backup to {} failed: {}'.format(profile.id, destination_path, error), profile=profile.id, destination=destination_path)
+            for destination_path, backup_file in backup_files.items():
+                if destination_path in backends:
+                    backup_file = backends[destination_path].get_url(backup_file)
+                self.log.log_hint('[{}]:: File system backed up to:\n{}\n'.format(profile.id, backup_file))
+
+            # register the new archive (or the volumes of the set) in the catalogs of the destinations
+            file_count = (detector.changed_count if detector is not None else files.count) - len(result.skipped)
+            for filepath in (detector.get_deleted() if detector is not None else []):
+                file_index.add(FileRecord(get_arcname(filepath), None, None, True))
+            volumes = self._get_volume_indexes(result) if len(result.volumes) > 0 else [(result, 0, None, file_count)]
+            with self.metrics.stage('catalog', profile.id):
+                for destination, destination_path in zip(destinations, destination_paths):
+                    if destination_path not in backup_files:
+                        continue
+                    for volume, start, stop, volume_file_count in volumes:
+                        filename = os.path.basename(volume.backup_files[destination_path])
+                        record = BackupRecord(profile.id, parse_backup_time(filename).strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP), os.path.join(destination_foldername, filename),
+                                              BACKUP_KIND_ARCHIVE, volume.size, volume_file_count, volume.checksum, mode)
+                        self._add_to_catalog(profile, destination, record, file_index.iter_files(start, stop), volume.block_checksums)
+
+        if profile.mode == BACKUP_MODE_INCREMENTAL:
+            with self.metrics.stage('manifest', profile.id):
+                manifest = Manifest()
+                manifest.backup_time = now.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+                manifest.full_backup_time = manifest.backup_time if is_full_backup else previous_manifest.full_backup_time
+                manifest.files = detector.states
+                # destinations that failed keep their old manifest - their next backup will be a full one
+                for destination_path in destination_paths:
+                    if destination_path not in backup_files:
+                        if delta is not None:
+                            discard_signatures(destination_path)
+                        continue
+                    if delta is not None:
+                        commit_signatures(destination_path, manifest)
+                    save_manifest(manifest, destination_path)
+            self._mark_journal(profile, manifest)
+
+
+    def _has_backup_chain(self, profile: Profile, destinations: list[Destination], destination_paths: list[str], manifest: Manifest) -> bool:
+        # An incremental backup depends on the archives of the manifest's chain: the
+        # full backup and the incremental backups after it. If one of them is missing
+        # in a destination (deleted by hand, by the clean-up mechanism of an older
+        # version, ...), a new full backup is needed.
+        for destination, destination_path in zip(destinations, destination_paths):
+            backend = self._get_backend(destination)
+            try:
+                with Catalog(destination.directory, backend) as catalog:
+                    chain = [record for record in catalog.get_backups_until(profile.id, manifest.backup_time) if record.backup_time >= manifest.full_backup_time]
+                    if backend is not None:
+                        stored = {filepath for filepath, _ in backend.list_files(backend.get_relpath(destination_path) + '/')}
+                        missing = [record for record in chain if catalog.get_file(record) not in stored]
+                    else:
+                        missing = [record for record in chain if not os.path.exists(catalog.get_file(record))]
+            except Exception as e:
+                self.log.log_warning('[{}]:: Cannot check the backups of destination {}: {}'.format(profile.id, destination.id, e))
+                return False
+            if (len(chain) == 0) or (chain[0].backup_time != manifest.full_backup_time) or (len(missing) > 0):
+                backup_time = missing[0].backup_time if len(missing) > 0 else manifest.full_backup_time
+                self.log.log_warning('[{}]:: Incremental mode: the backup {} that the next incremental backup depends on is missing in destination {} - creating a full backup.'.format(
+                    profile.id, backup_time, destination.id), profile=profile.id, destination=destination.id)
+                return False
+        return True
+
+
+    def _read_journal(self, profile: Profile, previous_manifest: Manifest) -> typing.Optional[typing.Iterator[ScanEntry]]:
+        # The files of an incremental backup from the change journal of the watch
+        # daemon (see watch.WatchManager): only the changed paths are read from the file
+        # system. Returns None if the sources have to be scanned.
+        journal_file = get_journal_file(self.configs.settings.journal_directory, profile.id)
+        if self.args.scan or not os.path.exists(journal_file):
+            return None
+        try:
+            since = datetime.datetime.strptime(previous_manifest.backup_time, BACKUP_FILENAME_FORMAT_DATETIMESTAMP).timestamp()
+        except ValueError:
+            return None
+        changed_paths = load_journal(journal_file, profile.id, profile.source, profile.ignore, since)
+        if changed_paths is None:
+            self.log.log_hint('[{}]:: The change journal does not cover the time since the last backup - scanning the sources.'.format(profile.id))
+            return None
+        self.log.log_hint('[{}]:: Change journal: {} changed paths since the last backup, the sources are not scanned.'.format(profile.id, len(changed_paths)))
+        return iter_journal_files(previous_manifest, changed_paths, IgnoreMatcher(profile.ignore))
+
+
+    def _mark_journal(self, profile: Profile, manifest: Manifest) -> None:
+        # the watch daemon drops the changes that are in the new manifest
+        journal_file = get_journal_file(self.configs.settings.journal_directory, profile.id)
+        if not os.path.exists(journal_file):
+            return
+        try:
+            mark_backup(journal_file, datetime.datetime.strptime(manifest.backup_time, BACKUP_FILENAME_FORMAT_DATETIMESTAMP).timestamp())
+        except OSError as e:
+            self.log.log_error('[{}]:: Cannot update the change journal {}: {}'.format(profile.id, journal_file, e), profile=profile.id)
+
+
+    def _get_volume_indexes(self, result: WriteResult) -> list[tuple[WriteResult, int, typing.Optional[int], int]]:
+        # the volumes of a set with the range of their files in the file index (the
+        # files were added in the order they were archived) and the number of files;
+        # the deleted files are added last - they are stored in the last volume
+        volumes = []
+        start = 0
+        for volume in result.volumes:
+            stop = start + volume.file_count + len(volume.skipped)
+            volumes.append((volume, start, stop, volume.file_count))
+            start = stop
+        volume, start, _, file_count = volumes[-1]
+        volumes[-1] = (volume, start, None, file_count)
+        return volumes
+
+
+    def _get_checkpoint(self, profile: Profile, destinations: list[Destination], destination_paths: list[str]) -> typing.Optional[Checkpoint]:
+        # Returns the checkpoint of an interrupted archive backup if the run should
+        # resume it. Without --resume (or if the checkpoint does not fit the profile
+        # any more) the checkpoints and temporary files are deleted, and the
+        # unfinished uploads of destinations with a backend are aborted.
+        if self.args.dryrun:
+            return None
+        checkpoint = find_checkpoint(destination_paths) if self.args.resume else None
+        if (checkpoint is not None) and ((checkpoint.profile != profile.id) or (checkpoint.format != profile.compression.format)
+                                         or (checkpoint.mode == BACKUP_MODE_INCREMENTAL and profile.mode != BACKUP_MODE_INCREMENTAL)):
+            self.log.log_warning('[{}]:: The interrupted backup {} does not match the profile configuration - starting a new backup.'.format(profile.id, checkpoint.filename))
+            checkpoint = None
+        if checkpoint is not None:
+            self.log.log_hint('[{}]:: Resuming the interrupted backup {} ({} files already archived).'.format(profile.id, checkpoint.filename, len(checkpoint.members)))
+            # checkpoints of other interrupted archives are of no use any more
+            for checkpoint_file in discard_checkpoints(destination_paths, keep=checkpoint.filename):
+                self.log.log_debug('[{}]:: Deleted the checkpoint {}'.format(profile.id, checkpoint_file))
+            self._discard_uploads(profile, destinations, destination_paths, checkpoint.filename)
+            return checkpoint
+        for checkpoint_file in discard_checkpoints(destination_paths):
+            self.log.log_hint('[{}]:: Deleted the interrupted backup {} (use --resume to continue interrupted backups).'.format(profile.id, checkpoint_file))
+        self._discard_uploads(profile, destinations, destination_paths)
+        return None
+
+
+    def _discard_uploads(self, profile: Profile, destinations: list[Destination], destination_paths: list[str], keep: str = None) -> None:
+        for destination_path, backend in self._get_backends(destinations, destination_paths).items():
+            try:
+                for state_file in backend.discard_uploads(destination_path, keep):
+                    self.log.log_debug('[{}]:: Aborted the upload of the interrupted backup {}'.format(profile.id, state_file))
+            except OSError as e:
+                self.log.log_warning('[{}]:: Cannot abort the uploads of interrupted backups in {}: {}'.format(profile.id, destination_path, e))
+
+
+    def _do_snapshot_backup(self, profile: Profile, destinations: list[Destination], now: datetime.datetime) -> None:
+        # chunk store destinations: every backup is a snapshot index referencing
+        # deduplicated chunks, so there is no need for incremental archives
+        backup_time = now.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+        # the sources are scanned and read once for all chunk stores
+        files = self._collect_files(profile)
+        if files is None:
+            return
+        if self.args.dryrun:
+            self.log.log_hint('[{}]:: Found {} files to back up.'.format(profile.id, sum(1 for _ in files)))
+            return
+        destination_paths = [destination.directory for destination in destinations]
+        for destination_path in destination_paths:
+            self.log.log_hint('[{}]:: Storing snapshot in chunk store {}...'.format(profile.id, destination_path))
+        start, bytes_read = time.perf_counter(), self.metrics.get_counter(BYTES_READ, profile.id)
+        with self.metrics.stage('snapshot', profile.id):
+            throttle = self._get_throttles(profile, destinations, destination_paths)
+            snapshots = store_snapshot(self.metrics.time_files(files, profile.id), destination_paths, profile.id, backup_time, self.log, throttle,
+                                       self._get_workers(profile))
+        seconds, bytes_read = time.perf_counter() - start, self.metrics.get_counter(BYTES_READ, profile.id) - bytes_read
+        for destination, (snapshot_file, count) in zip(destinations, snapshots):
+            self.metrics.add_destination(profile.id, destination.directory, bytes_read, seconds)
+            self.log.log_hint('[{}]:: {} files backed up to:\n{}\n'.format(profile.id, count, snapshot_file))
+            record = BackupRecord(profile.id, backup_time, os.path.relpath(snapshot_file, destination.directory),
+                                  BACKUP_KIND_SNAPSHOT, os.path.getsize(snapshot_file), count, None, BACKUP_MODE_FULL)
+            self._add_to_catalog(profile, destination, record)
+
+
+    def _get_delta_encoder(self, profile: Profile, destination_paths: list[str], now: datetime.datetime, previous_manifest: typing.Optional[Manifest], resume: typing.Optional[Checkpoint]) -> typing.Optional[DeltaEncoder]:
+        # Delta mode: the signatures staged by an interrupted run are only of use if
+        # it is resumed. A full backup stores all files as a whole (new signatures).
+        if profile.delta_min_size == 0:
+            return None
+        if resume is None:
+            for destination_path in destination_paths:
+                discard_signatures(destination_path)
+        return DeltaEncoder(destination_paths, profile.get_delta_min_size(), now.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP), previous_manifest)
+
+
+    def _index_files(self, files: typing.Iterable[ScanEntry], file_index: FileIndexStage) -> typing.Iterator[ScanEntry]:
+        for entry in files:
+            file_index.add(FileRecord(get_arcname(entry.path), entry.size, entry.mtime_ns))
+            yield entry
+
+
+    def _add_to_catalog(self, profile: Profile, destination: Destination, record: BackupRecord, file_index: typing.Iterable[FileRecord] = None, block_checksums: list[str] = None) -> None:
+        # the backup itself is complete - a failing catalog is only reported
+        # (a lost catalog is rebuilt from the backup files)
+        try:
+            with Catalog(destination.directory, self._get_backend(destination)) as catalog:
+                catalog.add_backup(record)
+                if file_index is not None:
+                    catalog.add_files(record.filename, file_index)
+                if block_checksums:
+                    catalog.add_blocks(record.filename, CHECKSUM_BLOCK_SIZE, block_checksums)
+        except Exception as e:
+            self.log.log_error('[{}]:: Cannot update the backup catalog of {}: {}'.format(profile.id, destination.directory, e))
+
+
+    def _get_workers(self, profile: Profile) -> int:
+        # the command line argument overrules the profile configuration,
+        # limits.max_workers caps both
+        workers = self.args.workers if (self.args.workers is not None) and (self.args.workers > 0) else profile.workers
+        if self._concurrent_profiles > 1:
+            # concurrent profiles share the budget (--workers or one worker per cpu core)
+            budget = self.args.workers if (self.args.workers is not None) and (self.args.workers > 0) else get_default_workers()
+            share = max(1, budget // self._concurrent_profiles)
+            workers = min(workers, share) if workers > 0 else share
+        if profile.limits.max_workers > 0:
+            workers = min(workers if workers > 0 else get_default_workers(), profile.limits.max_workers)
+        return workers
+
+
+    def _get_scan_workers(self, profile: Profile) -> int:
+        if profile.limits.max_workers > 0:
+            return min(DEFAULT_SCAN_WORKERS, profile.limits.max_workers)
+        return DEFAULT_SCAN_WORKERS
+
+
+    def _get_profile_throttle(self, profile: Profile) -> Throttle:
+        with self._lock:
+            if profile.id not in self._profile_throttles:
+                self._profile_throttles[profile.id] = profile.limits.get_throttle()
+            return self._profile_throttles[profile.id]
+
+
+    def _get_throttles(self, profile: Profile, destinations: list[Destination], destination_directories: list[str]) -> ThrottleGroup:
+        # the throttles of the profile and of the destinations (by the directories the backup is written to)
+        throttles: dict[str, Throttle] = {}
+        with self._lock:
+            for destination, destination_directory in zip(destinations, destination_directories):
+                if destination.id not in self._destination_throttles:
+                    self._destination_throttles[destination.id] = destination.limits.get_throttle()
+                throttles[destination_directory] = self._destination_throttles[destination.id]
+        return ThrottleGroup(self._get_profile_throttle(profile), throttles)
+
+
+    def _get_backend(self, destination: Destination) -> typing.Optional[DestinationBackend]:
+        # None: a local destination; the backend (and its connections) is shared by the profiles
+        with self._lock:
+            if destination.id not in self._backends:
+                self._backends[destination.id] = destination.backend.get_backend(destination.directory)
+            return self._backends[destination.id]
+
+
+    def _get_backends(self, destinations: list[Destination], destination_directories: list[str]) -> dict[str, DestinationBackend]:
+        # the backends of the destinations (by the directories the backup is written to)
+        backends: dict[str, DestinationBackend] = {}
+        for destination, destination_directory in zip(destinations, destination_directories):
+            backend = self._get_backend(destination)
+            if backend is not None:
+                backends[destination_directory] = backend
+        return backends
+
+
+    def _close_backends(self) -> None:
+        for backend in self._backends.values():
+            if backend is not None:
+                backend.close()
+        self._backends.clear()
+
+
+    def _set_priority(self) -> None:
+        # nice and ioprio of the run (settings): of the threads running already, the
+        # worker threads inherit them
+        settings = self.configs.settings
+        if (settings.nice is None) and (settings.io_priority is None):
+            return
+        try:
+            set_process_priority(settings.nice, settings.io_priority)
+        except OSError as e:
+            self.log.log_warning('Cannot set the priority of the backup run: {}'.format(e))
 
 
     def _do_cleanupMechanism(self, destinations: list[Destination]) -> None:
         from .utils import cleanup_destination
         for destination in destinations:
-            cleanup_destination(destination.directory, destination.days_to_keep)              
+            with self.metrics.stage('cleanup'):
+                if destination.storage == STORAGE_CHUNKS:
+                    cleanup_chunk_store(destination.directory, destination.days_to_keep)
+                elif destination.backend.type == BACKEND_LOCAL:
+                    cleanup_destination(destination.directory, destination.days_to_keep)
+                elif destination.days_to_keep > 0:
+                    try:
+                        cleanup_destination(destination.directory, destination.days_to_keep, self._get_backend(destination))
+                    except OSError as e:
+                        self.log.log_error('Cannot clean up the destination {}: {}'.format(destination.id, e), destination=destination.id)
 
 
     def _getBackupProfiles(self) -> list[Profile]:
@@ -108,8 +578,53 @@ class BackupManager():
         return backup_destinations
 
 
+    def _do_list(self, destinations: list[Destination]) -> None:
+        # prints the backups stored in the destinations (read from their catalogs)
+        profile_id = self.args.profile.strip() if self.args.profile else None
+        for destination in destinations:
+            # the catalog of a destination with a backend is rebuilt from the storage if it is missing
+            backend = self._get_backend(destination)
+            if (backend is None) and (not os.path.isdir(destination.directory)):
+                self.log.log_hint('Destination "{}" is not available: {}\n'.format(destination.id, destination.directory))
+                continue
+            with Catalog(destination.directory, backend) as catalog:
+                records = catalog.list_backups(profile_id)
+            self.log.log_hint('Destination "{}" ({}): {} backups'.format(destination.id, destination.directory, len(records)))
+            for record in records:
+                size = '{:.1f} MB'.format(record.size / (1024 * 1024)) if record.size is not None else '-'
+                file_count = record.file_count if record.file_count is not None else '-'
+                self.log.log_hint('  [{}] {}  {:<8} {:>8} files {:>10}  {}'.format(record.profile, record.backup_time, record.kind, file_count, size, record.filename))
+            self.log.log_hint('')
+
+
+    def _write_metrics(self) -> None:
+        # the run report is written for every run; the backup itself is not affected by errors
+        settings = self.configs.settings
+        self.metrics.finished = datetime.datetime.now()
+        try:
+            report_file = self.metrics.write_report(settings.report_directory)
+            self.log.log_hint('Run report written to: {}'.format(report_file))
+        except OSError as e:
+            self.log.log_error('Cannot write the run report to {}: {}'.format(settings.report_directory, e))
+        if settings.prometheus_textfile is not None:
+            try:
+                self.metrics.write_prometheus(settings.prometheus_textfile)
+            except OSError as e:
+                self.log.log_error('Cannot write the prometheus metrics to {}: {}'.format(settings.prometheus_textfile, e))
+
+
     def run(self) -> int:  
         """Main method - use this to get the job done"""
+        if self.args.list:
+            self._do_list(self._getBackupDestinations())
+            self._close_backends()
+            return 0
+
+        self._set_priority()
+        profiler = RunProfiler() if self.args.profile_run else None
+        if profiler is not None:
+            profiler.start()
+
         if self.args.dryrun:
             self.log.log_hint('\nSTART Dry run backup process.\n')
         else:
@@ -122,8 +637,16 @@ class BackupManager():
         if not self.args.dryrun:
             all_destinations: list[Destination] = list(self.configs.destinations.values())
             self._do_cleanupMechanism(all_destinations)
+        self._close_backends()
+
+        if profiler is not None:
+            for profile_file in profiler.stop(self.configs.settings.report_directory, self.backup_time):
+                self.log.log_hint('Profile of the run written to: {}'.format(profile_file))
+        self._write_metrics()
 
         # How to notify the user, that an error occured? #Krücke:
-        open_with_editor(self.log.get_errorlog_file())    
+        self.log.flush()
+        if self.log.error_count > 0:
+            open_with_editor(self.log.get_errorlog_file())    
 
         return 0    
\ No newline at end of file
@@ -0,0 +1,377 @@
+# benchmark suite
+#
+# Generates synthetic file trees and measures the backup stages (scan, archive,
+# copy, clean-up) on their own and the whole BackupManager run end to end.
+# Every measurement runs in a fresh (spawned) process, so the peak RSS belongs
+# to this one stage. The trees are generated from a fixed seed and reused, the
+# report is JSON - reports of different commits can be compared with --baseline.
+#
+# Example usage:
+#    python3 -m backup.benchmark --scale 0.1 --output before.json
+#    python3 -m backup.benchmark --scale 0.1 --baseline before.json --output after.json
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import typing
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+REPORT_VERSION = 1
+DEFAULT_SEED = 42
+DEFAULT_REPEAT = 3
+DEFAULT_WORKDIR = os.path.join('.backup', 'benchmark')
+BENCHMARK_PROFILE_ID = 'benchmark'
+
+DATA_TEXT = 'text'          # compressible
+DATA_RANDOM = 'random'      # incompressible
+
+STAGE_SCAN = 'scan'
+STAGE_ARCHIVE = 'archive'
+STAGE_BACKUP = 'backup'     # BackupManager end to end
+STAGE_COPY = 'copy'
+STAGE_CLEANUP = 'cleanup'
+TREE_STAGES = [STAGE_SCAN, STAGE_ARCHIVE, STAGE_BACKUP]
+FIXTURE_STAGES = [STAGE_COPY, STAGE_CLEANUP]
+
+# fixtures of the stages that don't work on a tree (at scale 1.0)
+COPY_FILE_SIZE = 512 * 1024 * 1024
+CLEANUP_ARCHIVES = 5000
+CLEANUP_DAYS_TO_KEEP = 365
+
+_WRITE_BLOCK_SIZE = 1024 * 1024
+_TEXT_WORDS = ['backup', 'file', 'system', 'archive', 'profile', 'destination', 'the', 'a', 'of',
+               'and', 'data', 'error', 'log', 'time', 'value', 'config', 'to', 'in', 'is', 'for']
+
+
+class TreeSpec(typing.NamedTuple):
+    # a synthetic file tree (counts and sizes at scale 1.0)
+    name: str
+    file_count: int
+    min_size: int
+    max_size: int
+    depth: int              # directory levels below the root
+    files_per_dir: int
+    data: str               # DATA_TEXT or DATA_RANDOM
+    ignore_count: int = 0   # number of ignore patterns (about a quarter of the files is ignored)
+
+
+TREES = {spec.name: spec for spec in [
+    TreeSpec('small_files', 20000, 512, 8 * 1024, 2, 50, DATA_TEXT),
+    TreeSpec('huge_files', 4, 256 * 1024 * 1024, 256 * 1024 * 1024, 0, 4, DATA_TEXT),
+    TreeSpec('random_data', 256, 1024 * 1024, 4 * 1024 * 1024, 1, 16, DATA_RANDOM),
+    TreeSpec('deep_nesting', 5000, 512, 16 * 1024, 32, 5, DATA_TEXT),
+    TreeSpec('ignore_heavy', 20000, 512, 8 * 1024, 3, 25, DATA_TEXT, ignore_count=200),
+]}
+
+
+def scale_spec(spec: TreeSpec, scale: float) -> TreeSpec:
+    # fewer/more files; huge files get smaller/larger instead
+    if spec.file_count <= spec.files_per_dir:
+        return spec._replace(min_size=max(1, int(spec.min_size * scale)), max_size=max(1, int(spec.max_size * scale)))
+    return spec._replace(file_count=max(1, int(spec.file_count * scale)))
+
+
+def get_ignore_patterns(spec: TreeSpec) -> list[str]:
+    patterns: list[str] = []
+    for i in range(spec.ignore_count):
+        # half file patterns, half directory patterns (pruned by the scanner)
+        patterns.append('*.tmp{}'.format(i) if i % 2 == 0 else '**/cache{}/'.format(i))
+    return patterns
+
+
+def _get_dir(spec: TreeSpec, dir_index: int, dir_count: int) -> str:
+    if spec.depth == 0:
+        return ''
+    fanout = max(2, int(round(dir_count ** (1.0 / spec.depth))))
+    parts = []
+    for level in range(spec.depth):
+        parts.append('d{}_{}'.format(level, (dir_index // fanout ** (spec.depth - level - 1)) % fanout))
+    return os.path.join(*parts)
+
+
+def _write_data(f: typing.BinaryIO, size: int, data: str, rng: random.Random, text_pool: bytes) -> None:
+    while size > 0:
+        length = min(size, _WRITE_BLOCK_SIZE)
+        if data == DATA_RANDOM:
+            f.write(rng.randbytes(length))
+        else:
+            offset = rng.randrange(len(text_pool) - length + 1) if length < len(text_pool) else 0
+            f.write(text_pool[offset:offset + length])
+        size -= length
+
+
+def _get_text_pool(rng: random.Random) -> bytes:
+    words = [rng.choice(_TEXT_WORDS) for _ in range(_WRITE_BLOCK_SIZE // 4)]
+    pool = ' '.join(words).encode('ascii')
+    while len(pool) < _WRITE_BLOCK_SIZE:
+        pool += pool
+    return pool[:_WRITE_BLOCK_SIZE]
+
+
+def generate_tree(root: str, spec: TreeSpec, seed: int = DEFAULT_SEED) -> dict:
+    # Creates the tree (same seed: same tree). An existing tree with the same spec
+    # is reused. Returns a summary: file count and bytes of the files that are
+    # not ignored.
+    marker_file = root.rstrip(os.sep) + '.json'
+    marker = {'spec': spec._asdict(), 'seed': seed}
+    if os.path.isdir(root) and os.path.isfile(marker_file):
+        with open(marker_file, 'r') as f:
+            existing = json.load(f)
+        if existing.get('spec') == marker['spec'] and existing.get('seed') == seed:
+            return existing['summary']
+    if os.path.exists(root):
+        shutil.rmtree(root)
+
+    rng = random.Random(seed)
+    text_pool = _get_text_pool(rng)
+    dir_count = max(1, (spec.file_count + spec.files_per_dir - 1) // spec.files_per_dir)
+    files = 0
+    total_bytes = 0
+    for i in range(spec.file_count):
+        directory = os.path.join(root, _get_dir(spec, i // spec.files_per_dir, dir_count))
+        filename = 'file{}.txt'.format(i) if spec.data == DATA_TEXT else 'file{}.bin'.format(i)
+        ignored = False
+        if spec.ignore_count > 0 and i % 4 == 0:
+            # every 4th file is ignored - by its extension or by its directory
+            pattern = rng.randrange(spec.ignore_count)
+            if pattern % 2 == 0:
+                filename = 'file{}.tmp{}'.format(i, pattern)
+            else:
+                directory = os.path.join(directory, 'cache{}'.format(pattern))
+            ignored = True
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        size = rng.randint(spec.min_size, spec.max_size)
+        with open(os.path.join(directory, filename), 'wb') as f:
+            _write_data(f, size, spec.data, rng, text_pool)
+        if not ignored:
+            files += 1
+            total_bytes += size
+
+    marker['summary'] = {'files': files, 'bytes': total_bytes}
+    with open(marker_file, 'w') as f:
+        json.dump(marker, f)
+    return marker['summary']
+
+
+def _get_peak_rss() -> typing.Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux: KiB, macOS: bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _reset_directory(directory: str) -> None:
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+
+def _prepare_cleanup(destination: str, count: int) -> None:
+    # archives spread over the last 5 years, about 20% are younger than CLEANUP_DAYS_TO_KEEP
+    from .utils import BACKUP_DIR_PREFIX, BACKUP_FILENAME_PREFIX, BACKUP_FILENAME_FORMAT_DATETIMESTAMP
+    from .catalog import Catalog
+    _reset_directory(destination)
+    now = datetime.now()
+    for i in range(count):
+        directory = os.path.join(destination, '{}profile{}'.format(BACKUP_DIR_PREFIX, i % 10))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        backup_time = now - timedelta(days=5 * 365 * i / count, seconds=i)
+        open(os.path.join(directory, BACKUP_FILENAME_PREFIX + backup_time.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP) + '.zip'), 'wb').close()
+    # the catalog is created in advance (a normal run keeps it up to date)
+    Catalog(destination).close()
+
+
+def _write_config(workdir: str, root: str, ignore_patterns: list[str], destination: str) -> str:
+    config = {
+        'backup_profiles': [{'id': BENCHMARK_PROFILE_ID, 'active': True, 'source': [os.path.join(root, '')], 'ignore': ignore_patterns}],
+        'backup_destinations': [{'id': BENCHMARK_PROFILE_ID, 'active': True, 'days_to_keep': -1, 'directory': destination}]
+    }
+    config_file = os.path.join(workdir, 'config.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+    return config_file
+
+
+def _run_stage(stage: str, workdir: str, root: str, ignore_patterns: list[str], summary: dict, workers: typing.Optional[int]) -> dict:
+    # Runs in a spawned process. Returns wall time, processed files/bytes and the peak RSS.
+    import io
+    import contextlib
+    from .utils import filter_files, iter_files, create_zip, copy_file, cleanup_destination
+
+    destination = os.path.join(workdir, 'destination')
+    files, total_bytes = summary['files'], summary['bytes']
+    output_bytes = None
+
+    if stage == STAGE_COPY:
+        source = os.path.join(workdir, 'fixtures', 'copy.bin')
+        _reset_directory(destination)
+        start = time.perf_counter()
+        copy_file(source, destination)
+    elif stage == STAGE_CLEANUP:
+        _prepare_cleanup(destination, files)
+        start = time.perf_counter()
+        cleanup_destination(destination, CLEANUP_DAYS_TO_KEEP)
+    elif stage == STAGE_SCAN:
+        start = time.perf_counter()
+        files = len(filter_files([os.path.join(root, '')], ignore_patterns))
+    elif stage == STAGE_ARCHIVE:
+        _reset_directory(destination)
+        start = time.perf_counter()
+        result = create_zip(list(iter_files([os.path.join(root, '')], ignore_patterns)), [destination], workers=workers)
+        output_bytes = result.size
+    elif stage == STAGE_BACKUP:
+        from .backupmgr import BackupManager
+        _reset_directory(destination)
+        config_file = _write_config(workdir, root, ignore_patterns, destination)
+        args = argparse.Namespace(dryrun=False, profile=BENCHMARK_PROFILE_ID, destinations=[], workers=workers, list=False, config=config_file, profile_run=False, resume=False, scan=False)
+        os.chdir(workdir)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            BackupManager(args).run()
+    else:
+        raise ValueError('Unknown stage: {}'.format(stage))
+    wall_time = time.perf_counter() - start
+
+    return {'wall_time': wall_time, 'files': files, 'bytes': total_bytes, 'output_bytes': output_bytes, 'peak_rss': _get_peak_rss()}
+
+
+def measure(stage: str, workdir: str, root: str, ignore_patterns: list[str], summary: dict, workers: typing.Optional[int], repeat: int) -> dict:
+    # every repetition in a fresh process: no warm caches of the interpreter, a
+    # peak RSS of this stage only
+    runs: list[dict] = []
+    context = multiprocessing.get_context('spawn')
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            runs.append(executor.submit(_run_stage, stage, workdir, root, ignore_patterns, summary, workers).result())
+
+    wall_times = [run['wall_time'] for run in runs]
+    wall_time = statistics.median(wall_times)
+    files, total_bytes = runs[0]['files'], runs[0]['bytes']
+    peak_rss = [run['peak_rss'] for run in runs if run['peak_rss'] is not None]
+    return {
+        'wall_time': round(wall_time, 4),
+        'wall_time_min': round(min(wall_times), 4),
+        'wall_time_max': round(max(wall_times), 4),
+        'files': files,
+        'bytes': total_bytes,
+        'output_bytes': runs[0]['output_bytes'],
+        'files_per_sec': round(files / wall_time, 1) if wall_time > 0 else None,
+        'mb_per_sec': round(total_bytes / (1024 * 1024) / wall_time, 2) if wall_time > 0 else None,
+        'peak_rss_mb': round(max(peak_rss) / (1024 * 1024), 1) if len(peak_rss) > 0 else None,
+    }
+
+
+def _get_git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(workdir: str, trees: list[str], stages: list[str], scale: float = 1.0, seed: int = DEFAULT_SEED, repeat: int = DEFAULT_REPEAT, workers: int = None, log=print) -> dict:
+    workdir = os.path.abspath(workdir)
+    report = {
+        'version': REPORT_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': _get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'scale': scale,
+        'seed': seed,
+        'repeat': repeat,
+        'workers': workers,
+        'results': {}
+    }
+
+    for name in trees:
+        spec = scale_spec(TREES[name], scale)
+        root = os.path.join(workdir, 'trees', name)
+        log('Generating tree "{}"...'.format(name))
+        summary = generate_tree(root, spec, seed)
+        for stage in [stage for stage in stages if stage in TREE_STAGES]:
+            log('  {} / {}'.format(name, stage))
+            report['results']['{}/{}'.format(name, stage)] = measure(stage, workdir, root, get_ignore_patterns(spec), summary, workers, repeat)
+
+    for stage in [stage for stage in stages if stage in FIXTURE_STAGES]:
+        log('  {}'.format(stage))
+        if stage == STAGE_COPY:
+            size = max(1, int(COPY_FILE_SIZE * scale))
+            fixture = os.path.join(workdir, 'fixtures', 'copy.bin')
+            if (not os.path.isfile(fixture)) or (os.path.getsize(fixture) != size):
+                os.makedirs(os.path.dirname(fixture), exist_ok=True)
+                rng = random.Random(seed)
+                with open(fixture, 'wb') as f:
+                    _write_data(f, size, DATA_RANDOM, rng, b'')
+            summary = {'files': 1, 'bytes': size}
+        else:
+            summary = {'files': max(1, int(CLEANUP_ARCHIVES * scale)), 'bytes': 0}
+        report['results'][stage] = measure(stage, workdir, '', [], summary, workers, repeat)
+
+    return report
+
+
+def compare_reports(report: dict, baseline: dict) -> list[str]:
+    # relative change of the wall time per measurement (negative: faster)
+    lines: list[str] = []
+    if (report['scale'], report['seed']) != (baseline.get('scale'), baseline.get('seed')):
+        lines.append('Warning: the baseline was created with another scale/seed - the results are not comparable.')
+    lines.append('{:<28} {:>12} {:>12} {:>9}'.format('benchmark', 'baseline [s]', 'current [s]', 'change'))
+    for key, result in report['results'].items():
+        previous = baseline.get('results', {}).get(key)
+        if previous is None:
+            lines.append('{:<28} {:>12} {:>12.3f} {:>9}'.format(key, '-', result['wall_time'], 'new'))
+            continue
+        change = (result['wall_time'] - previous['wall_time']) / previous['wall_time'] * 100 if previous['wall_time'] > 0 else 0
+        lines.append('{:<28} {:>12.3f} {:>12.3f} {:>+8.1f}%'.format(key, previous['wall_time'], result['wall_time'], change))
+    return lines
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='FileSystemBackup: benchmark suite')
+    parser.add_argument('--workdir', type=str, default=DEFAULT_WORKDIR, help='Directory for the generated trees and backups')
+    parser.add_argument('--trees', nargs='*', default=list(TREES.keys()), choices=list(TREES.keys()), help='Trees to generate and benchmark')
+    parser.add_argument('--stages', nargs='*', default=TREE_STAGES + FIXTURE_STAGES, choices=TREE_STAGES + FIXTURE_STAGES, help='Stages to benchmark')
+    parser.add_argument('--scale', type=float, default=1.0, help='Scale of the trees (e.g. 0.1 for a quick run)')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='Seed of the tree generator')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Repetitions per benchmark (the median is reported)')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of compression threads')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Write the JSON report to this file (default: stdout)')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON report of an earlier run to compare with')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.workdir, args.trees, args.stages, args.scale, args.seed, max(1, args.repeat), args.workers,
+                            log=lambda msg: print(msg, file=sys.stderr))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print('\n'.join(compare_reports(report, baseline)), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
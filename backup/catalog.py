@@ -0,0 +1,445 @@
+import os
+import json
+import sqlite3
+import typing
+from datetime import datetime
+
+from .utils import BACKUP_DIR_PREFIX, BACKUP_FILENAME_FORMAT_DATETIMESTAMP, parse_backup_time, get_temp_filepath
+from .chunkstore import parse_snapshot_time
+from .backends import DestinationBackend
+from .manifest import BACKUP_MODE_FULL, BACKUP_MODE_INCREMENTAL, MANIFEST_FILENAME, Manifest
+
+CATALOG_FILENAME = 'backup_catalog.sqlite'
+
+CATALOG_VERSION = 4
+
+FILE_INDEX_STAGING_FILENAME = 'file_index.sqlite'
+FILE_INDEX_BATCH_SIZE = 10000
+
+BACKUP_KIND_ARCHIVE = 'archive'
+BACKUP_KIND_SNAPSHOT = 'snapshot'
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS backups (
+        id INTEGER PRIMARY KEY,
+        profile TEXT NOT NULL,
+        backup_time TEXT NOT NULL,
+        filename TEXT NOT NULL UNIQUE,
+        kind TEXT NOT NULL,
+        size INTEGER,
+        file_count INTEGER,
+        checksum TEXT,
+        mode TEXT,
+        indexed INTEGER NOT NULL DEFAULT 0,
+        block_size INTEGER
+    )''',
+    'CREATE INDEX IF NOT EXISTS backups_profile_time ON backups (profile, backup_time)',
+    'CREATE INDEX IF NOT EXISTS backups_time ON backups (backup_time)',
+    # the files of each backup (archive member names, see utils.get_arcname);
+    # deleted = 1: the file was deleted since the previous (incremental) backup;
+    # delta = 1: the file is stored as a delta against its previous version (see delta)
+    '''CREATE TABLE IF NOT EXISTS files (
+        backup_id INTEGER NOT NULL REFERENCES backups (id) ON DELETE CASCADE,
+        arcname TEXT NOT NULL,
+        size INTEGER,
+        mtime_ns INTEGER,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        delta INTEGER NOT NULL DEFAULT 0
+    )''',
+    'CREATE INDEX IF NOT EXISTS files_backup_arcname ON files (backup_id, arcname)',
+    # checksums of the backup file in blocks of backups.block_size (see verify)
+    '''CREATE TABLE IF NOT EXISTS blocks (
+        backup_id INTEGER NOT NULL REFERENCES backups (id) ON DELETE CASCADE,
+        block_index INTEGER NOT NULL,
+        checksum TEXT NOT NULL,
+        PRIMARY KEY (backup_id, block_index)
+    )''',
+]
+
+# the file index of a backup while it is written (see FileIndexStage): a scratch
+# file without journal and syncs; position: the order the files were added in
+_STAGING_SCHEMA = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    '''CREATE TABLE files (
+        position INTEGER PRIMARY KEY,
+        arcname TEXT NOT NULL,
+        size INTEGER,
+        mtime_ns INTEGER,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        delta INTEGER NOT NULL DEFAULT 0
+    )''',
+    'CREATE INDEX files_arcname ON files (arcname)',
+]
+
+# upgrades of older catalogs: version -> (table, statement); tables that an older
+# catalog does not have yet are created with the current schema instead
+_MIGRATIONS = {
+    1: [('backups', 'ALTER TABLE backups ADD COLUMN mode TEXT'),
+        ('backups', 'ALTER TABLE backups ADD COLUMN indexed INTEGER NOT NULL DEFAULT 0')],
+    2: [('backups', 'ALTER TABLE backups ADD COLUMN block_size INTEGER')],
+    3: [('files', 'ALTER TABLE files ADD COLUMN delta INTEGER NOT NULL DEFAULT 0')],
+}
+
+_RECORD_COLUMNS = 'profile, backup_time, filename, kind, size, file_count, checksum, mode'
+
+
+class BackupRecord(typing.NamedTuple):
+    profile: str
+    backup_time: str            # BACKUP_FILENAME_FORMAT_DATETIMESTAMP
+    filename: str               # relative to the destination directory
+    kind: str
+    size: typing.Optional[int]
+    file_count: typing.Optional[int]
+    checksum: typing.Optional[str]
+    mode: typing.Optional[str] = None      # manifest.BACKUP_MODE_FULL/INCREMENTAL; None: unknown (rebuilt catalog)
+
+
+class FileRecord(typing.NamedTuple):
+    arcname: str
+    size: typing.Optional[int]
+    mtime_ns: typing.Optional[int]
+    deleted: bool = False
+    delta: bool = False
+
+
+class Catalog:
+    # SQLite catalog of all backups stored in a destination directory. Listing,
+    # "latest backup" and retention queries are index lookups instead of walks
+    # through the destination. A lost catalog is rebuilt from the files on disk
+    # (without file counts and checksums - these are only known while writing).
+    #
+    # The catalog also holds the file index of each backup (used by restores). It
+    # is written with the backup; after a rebuild, backups are indexed again from
+    # the archives when they are needed (see restore.RestoreManager).
+    # Block checksums of the archives are stored as well (see verify.VerifyManager).
+    # Destinations with a backend (see backends) keep the catalog in their local
+    # directory; it is rebuilt from the files stored in the backend.
+    #
+    # Example usage:
+    #    with Catalog('/destination/') as catalog:
+    #        latest = catalog.get_latest_backup('filesystem_backup_1')
+
+    def __init__(self, destination_directory: str, backend: DestinationBackend = None):
+        self.destination_directory: str = destination_directory
+        self.backend: typing.Optional[DestinationBackend] = backend
+        self.catalog_file: str = os.path.join(destination_directory, CATALOG_FILENAME)
+        if not os.path.exists(destination_directory):
+            os.makedirs(destination_directory, exist_ok=True)
+        self._connection = sqlite3.connect(self.catalog_file, timeout=30)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        # the schema is checked under the write lock - concurrent profiles open the catalog at the same time
+        self._connection.execute('BEGIN IMMEDIATE')
+        version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+        is_new = not self._has_table('backups')
+        if (version == 0) and (not is_new):
+            # catalogs of the first version had no user_version
+            version = 1
+        if (version > 0) and (version < CATALOG_VERSION):
+            for migration in range(version, CATALOG_VERSION):
+                for table, statement in _MIGRATIONS.get(migration, []):
+                    if self._has_table(table):
+                        self._connection.execute(statement)
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+        self._connection.execute('PRAGMA user_version = {}'.format(CATALOG_VERSION))
+        if is_new:
+            # still under the write lock: no backup is registered before the rebuild
+            self.rebuild()
+        self._connection.commit()
+
+    def __enter__(self) -> 'Catalog':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _has_table(self, table: str) -> bool:
+        return self._connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0] > 0
+
+    def add_backup(self, record: BackupRecord) -> None:
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO backups ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(_RECORD_COLUMNS),
+                tuple(record))
+
+    def remove_backup(self, filename: str) -> None:
+        with self._connection:
+            self._connection.execute('DELETE FROM backups WHERE filename = ?', (filename,))
+
+    def list_backups(self, profile: str = None) -> list[BackupRecord]:
+        if profile is None:
+            rows = self._connection.execute('SELECT ' + _RECORD_COLUMNS + ' FROM backups ORDER BY profile, backup_time, filename')
+        else:
+            rows = self._connection.execute('SELECT ' + _RECORD_COLUMNS + ' FROM backups WHERE profile = ? ORDER BY backup_time, filename', (profile,))
+        return [BackupRecord(*row) for row in rows]
+
+    def get_latest_backup(self, profile: str) -> typing.Optional[BackupRecord]:
+        row = self._connection.execute(
+            'SELECT ' + _RECORD_COLUMNS + ' FROM backups WHERE profile = ? ORDER BY backup_time DESC LIMIT 1',
+            (profile,)).fetchone()
+        return BackupRecord(*row) if row is not None else None
+
+    def get_expired_backups(self, cutoff: datetime, kind: str = None) -> list[BackupRecord]:
+        # The backups whose chain ended at or before the cutoff. An incremental backup
+        # needs the full backup and the incremental backups before it: a chain (see
+        # get_backup_chains) expires as a whole, when its newest backup expires.
+        cutoff_time = cutoff.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+        expired = [record for chain in self.get_backup_chains() if chain[-1].backup_time <= cutoff_time for record in chain]
+        return sorted((record for record in expired if (kind is None) or (record.kind == kind)), key=lambda record: record.backup_time)
+
+    def get_backup_chains(self, profile: str = None) -> list[list[BackupRecord]]:
+        # The backups grouped into chains (oldest first): a full backup (all volumes
+        # of the set) and the incremental backups after it. Snapshots are complete on
+        # their own. A backup of unknown mode (rebuilt catalog, see rebuild) might be
+        # incremental - it is kept in the chain before it.
+        chains: list[list[BackupRecord]] = []
+        for record in self.list_backups(profile):
+            previous = chains[-1][-1] if len(chains) > 0 else None
+            starts_chain = (record.kind == BACKUP_KIND_SNAPSHOT) or (record.mode == BACKUP_MODE_FULL)
+            if (previous is None) or (previous.profile != record.profile) or (starts_chain and (previous.backup_time != record.backup_time)):
+                chains.append([record])
+            else:
+                chains[-1].append(record)
+        return chains
+
+    def get_file(self, record: BackupRecord) -> str:
+        return os.path.join(self.destination_directory, record.filename)
+
+    def get_backups_until(self, profile: str, backup_time: str) -> list[BackupRecord]:
+        # all backups of the profile up to (and including) backup_time, oldest first
+        rows = self._connection.execute('SELECT ' + _RECORD_COLUMNS + ' FROM backups WHERE profile = ? AND backup_time <= ? ORDER BY backup_time, filename', (profile, backup_time))
+        return [BackupRecord(*row) for row in rows]
+
+    def set_mode(self, filename: str, mode: str) -> None:
+        with self._connection:
+            self._connection.execute('UPDATE backups SET mode = ? WHERE filename = ?', (mode, filename))
+
+    def is_indexed(self, filename: str) -> bool:
+        row = self._connection.execute('SELECT indexed FROM backups WHERE filename = ?', (filename,)).fetchone()
+        return (row is not None) and (row[0] == 1)
+
+    def add_files(self, filename: str, files: typing.Iterable[FileRecord]) -> None:
+        # (Re-)places the file index of a backup - in one transaction
+        with self._connection:
+            row = self._connection.execute('SELECT id FROM backups WHERE filename = ?', (filename,)).fetchone()
+            if row is None:
+                raise KeyError('Backup not found in the catalog: {}'.format(filename))
+            backup_id = row[0]
+            self._connection.execute('DELETE FROM files WHERE backup_id = ?', (backup_id,))
+            self._connection.executemany('INSERT INTO files (backup_id, arcname, size, mtime_ns, deleted, delta) VALUES (?, ?, ?, ?, ?, ?)',
+                                         ((backup_id, f.arcname, f.size, f.mtime_ns, 1 if f.deleted else 0, 1 if f.delta else 0) for f in files))
+            self._connection.execute('UPDATE backups SET indexed = 1 WHERE id = ?', (backup_id,))
+
+    def add_blocks(self, filename: str, block_size: int, checksums: list[str]) -> None:
+        # (Re-)places the block checksums of a backup file
+        with self._connection:
+            row = self._connection.execute('SELECT id FROM backups WHERE filename = ?', (filename,)).fetchone()
+            if row is None:
+                raise KeyError('Backup not found in the catalog: {}'.format(filename))
+            backup_id = row[0]
+            self._connection.execute('DELETE FROM blocks WHERE backup_id = ?', (backup_id,))
+            self._connection.executemany('INSERT INTO blocks (backup_id, block_index, checksum) VALUES (?, ?, ?)',
+                                         ((backup_id, i, checksum) for i, checksum in enumerate(checksums)))
+            self._connection.execute('UPDATE backups SET block_size = ? WHERE id = ?', (block_size, backup_id))
+
+    def get_blocks(self, filename: str) -> tuple[typing.Optional[int], list[str]]:
+        # Returns the block size and the block checksums of a backup file
+        # (None, []: no block checksums, e.g. a rebuilt catalog)
+        row = self._connection.execute('SELECT id, block_size FROM backups WHERE filename = ?', (filename,)).fetchone()
+        if (row is None) or (row[1] is None):
+            return None, []
+        checksums = [checksum for checksum, in self._connection.execute('SELECT checksum FROM blocks WHERE backup_id = ? ORDER BY block_index', (row[0],))]
+        return row[1], checksums
+
+    def find_files(self, filename: str, arcname_patterns: list[str]) -> list[FileRecord]:
+        # Files of one backup matching any of the patterns: an exact member name, a
+        # directory (all files below it) or a glob pattern (*, ?, [...]).
+        # No patterns: all files of the backup.
+        conditions: list[str] = []
+        parameters: list = []
+        for pattern in arcname_patterns:
+            if any(c in pattern for c in '*?['):
+                conditions.append('arcname GLOB ?')
+                parameters.append(pattern)
+            else:
+                # directory: range query on the index ('0' is the character after '/')
+                directory = pattern.rstrip('/')
+                conditions.append('(arcname = ? OR (arcname >= ? AND arcname < ?))')
+                parameters += [directory, directory + '/', directory + '0']
+        query = 'SELECT arcname, size, mtime_ns, deleted, delta FROM files WHERE backup_id = (SELECT id FROM backups WHERE filename = ?)'
+        if len(conditions) > 0:
+            query += ' AND (' + ' OR '.join(conditions) + ')'
+        return [FileRecord(arcname, size, mtime_ns, deleted == 1, delta == 1) for arcname, size, mtime_ns, deleted, delta in self._connection.execute(query, [filename] + parameters)]
+
+    def _iter_backup_files(self) -> typing.Iterator[tuple[str, str, int]]:
+        # (backup folder, file name, size) of the files in the backup folders
+        if self.backend is not None:
+            # only the backup folders - other objects may share the bucket and prefix
+            for filepath, size in self.backend.list_files(BACKUP_DIR_PREFIX):
+                folder = os.path.dirname(os.path.relpath(filepath, self.destination_directory))
+                if folder.startswith(BACKUP_DIR_PREFIX) and (os.sep not in folder):
+                    yield folder, os.path.basename(filepath), size
+            return
+        with os.scandir(self.destination_directory) as entries:
+            backup_dirs = [entry for entry in entries if entry.is_dir() and entry.name.startswith(BACKUP_DIR_PREFIX)]
+        for backup_dir in backup_dirs:
+            with os.scandir(backup_dir.path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield backup_dir.name, entry.name, entry.stat().st_size
+
+    def _get_stored_backups(self) -> list[BackupRecord]:
+        # the backup files in the backup folders of the destination
+        records: list[BackupRecord] = []
+        manifests: dict[str, typing.Optional[Manifest]] = {}
+        for folder, name, size in self._iter_backup_files():
+            profile = folder[len(BACKUP_DIR_PREFIX):]
+            kind = BACKUP_KIND_ARCHIVE
+            backup_time = parse_backup_time(name)
+            if backup_time is None:
+                kind = BACKUP_KIND_SNAPSHOT
+                backup_time = parse_snapshot_time(name)
+            if backup_time is None:
+                continue
+            if folder not in manifests:
+                manifests[folder] = self._load_manifest(folder)
+            backup_time = backup_time.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+            mode = BACKUP_MODE_FULL if kind == BACKUP_KIND_SNAPSHOT else self._get_stored_mode(manifests[folder], backup_time)
+            records.append(BackupRecord(profile, backup_time, os.path.join(folder, name), kind, size, None, None, mode))
+        return records
+
+    def _load_manifest(self, folder: str) -> typing.Optional[Manifest]:
+        # the manifest of an incremental profile (always in the local directory)
+        try:
+            with open(os.path.join(self.destination_directory, folder, MANIFEST_FILENAME), 'r', encoding='utf-8') as f:
+                return Manifest.from_dict(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def _get_stored_mode(self, manifest: typing.Optional[Manifest], backup_time: str) -> typing.Optional[str]:
+        # The mode of a stored archive, as far as it is known without reading it: the
+        # manifest knows the current chain of an incremental profile. Profiles without
+        # manifest only create full backups - unless the manifest is stored on
+        # another host (backends). None: unknown (see get_backup_chains).
+        if manifest is None:
+            return BACKUP_MODE_FULL if self.backend is None else None
+        if backup_time == manifest.full_backup_time:
+            return BACKUP_MODE_FULL
+        if manifest.full_backup_time < backup_time <= manifest.backup_time:
+            return BACKUP_MODE_INCREMENTAL
+        return None
+
+    def add_untracked(self) -> int:
+        # Registers the backup files of the destination that are missing in the catalog
+        # (e.g. the catalog of a run could not be written). Returns their number.
+        known = {filename for filename, in self._connection.execute('SELECT filename FROM backups')}
+        records = [record for record in self._get_stored_backups() if record.filename not in known]
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO backups ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(_RECORD_COLUMNS),
+                [tuple(record) for record in records])
+        return len(records)
+
+    def rebuild(self) -> None:
+        # (Re-)creates the catalog entries from the backup folders of the destination
+        records = self._get_stored_backups()
+        with self._connection:
+            self._connection.execute('DELETE FROM backups')
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO backups ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(_RECORD_COLUMNS),
+                [tuple(record) for record in records])
+
+
+class FileIndexStage:
+    # The file index of an archive while it is written. The files are streamed into
+    # a temporary SQLite file in batches of FILE_INDEX_BATCH_SIZE, so the memory stays
+    # flat however many files a profile has. When the archive is complete, the index
+    # is corrected (skipped files, deltas) and copied into the catalogs of the
+    # destinations (see Catalog.add_files). The positions of the files follow the
+    # order they were added in: the files of a volume are a range of positions.
+    #
+    # Example usage:
+    #    with FileIndexStage(['/destination/BACKUP_profile']) as index:
+    #        for entry in files:
+    #            index.add(FileRecord(arcname, size, mtime_ns))
+    #        ...
+    #        catalog.add_files(filename, index.iter_files())
+
+    def __init__(self, directories: list[str]):
+        # hidden temporary file next to the backups (see utils.get_temp_filepath) in the
+        # first of the directories that can be written; the leftover of an interrupted
+        # run is replaced
+        for i, directory in enumerate(directories):
+            self.filepath: str = get_temp_filepath(os.path.join(directory, FILE_INDEX_STAGING_FILENAME))
+            try:
+                self._connection = self._create(directory, self.filepath)
+                break
+            except (OSError, sqlite3.Error):
+                if i == len(directories) - 1:
+                    raise
+        self._batch: list[tuple] = []
+        self.count: int = 0     # number of files added
+
+    @staticmethod
+    def _create(directory: str, filepath: str) -> sqlite3.Connection:
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        connection = sqlite3.connect(filepath)
+        try:
+            for statement in _STAGING_SCHEMA:
+                connection.execute(statement)
+        except sqlite3.Error:
+            connection.close()
+            raise
+        return connection
+
+    def __enter__(self) -> 'FileIndexStage':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+        try:
+            os.remove(self.filepath)
+        except OSError:
+            pass
+
+    def add(self, file: FileRecord) -> None:
+        self._batch.append((self.count, file.arcname, file.size, file.mtime_ns, 1 if file.deleted else 0, 1 if file.delta else 0))
+        self.count += 1
+        if len(self._batch) >= FILE_INDEX_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self._batch) == 0:
+            return
+        with self._connection:
+            self._connection.executemany('INSERT INTO files (position, arcname, size, mtime_ns, deleted, delta) VALUES (?, ?, ?, ?, ?, ?)', self._batch)
+        self._batch = []
+
+    def remove(self, arcnames: typing.Iterable[str]) -> None:
+        # e.g. files that could not be archived
+        self.flush()
+        with self._connection:
+            self._connection.executemany('DELETE FROM files WHERE arcname = ?', ((arcname,) for arcname in arcnames))
+
+    def set_delta(self, arcnames: typing.Iterable[str]) -> None:
+        # files stored as deltas (see delta.DeltaEncoder)
+        self.flush()
+        with self._connection:
+            self._connection.executemany('UPDATE files SET delta = 1 WHERE arcname = ?', ((arcname,) for arcname in arcnames))
+
+    def iter_files(self, start: int = 0, stop: int = None) -> typing.Iterator[FileRecord]:
+        # the files at the positions start to stop - 1, in the order they were added
+        self.flush()
+        rows = self._connection.execute('SELECT arcname, size, mtime_ns, deleted, delta FROM files WHERE position >= ? AND position < ? ORDER BY position',
+                                        (start, stop if stop is not None else self.count))
+        for arcname, size, mtime_ns, deleted, delta in rows:
+            yield FileRecord(arcname, size, mtime_ns, deleted == 1, delta == 1)
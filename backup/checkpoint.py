@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import glob
+import typing
+import zipfile
+
+CHECKPOINT_SUFFIX = '.checkpoint'
+CHECKPOINT_VERSION = 1
+DEFAULT_CHECKPOINT_INTERVAL = 300       # seconds; 0: no checkpoints
+
+# ZipInfo attributes that are needed to write the central directory again
+_ZIPINFO_FIELDS = ('compress_type', 'CRC', 'compress_size', 'file_size', 'header_offset', 'flag_bits',
+                   'external_attr', 'internal_attr', 'create_system', 'create_version', 'extract_version')
+
+
+class CommittedMember(typing.NamedTuple):
+    zinfo: zipfile.ZipInfo
+    size: int                   # size and mtime of the file when it was archived
+    mtime_ns: int
+
+
+class Checkpoint:
+    # State of an interrupted archive: the archive is complete up to offset and
+    # contains the committed members (the temporary files of the destinations may
+    # be longer - everything after offset is written again).
+
+    def __init__(self, checkpoint_file: str, header: dict):
+        self.checkpoint_file: str = checkpoint_file
+        self.header: dict = header
+        self.filename: str = header['filename']
+        self.profile: str = header['profile']
+        self.backup_time: str = header['backup_time']
+        self.mode: str = header['mode']
+        self.format: str = header['format']
+        self.offset: int = 0
+        self.members: dict[str, CommittedMember] = {}
+
+
+def get_checkpoint_filepath(backup_file: str) -> str:
+    # hidden file next to the temporary file of the archive (see utils.get_temp_filepath)
+    return os.path.join(os.path.dirname(backup_file), '.' + os.path.basename(backup_file) + CHECKPOINT_SUFFIX)
+
+
+def get_checkpoint_temp_filepath(checkpoint_file: str) -> str:
+    # temporary file of the archive the checkpoint belongs to
+    return checkpoint_file[:-len(CHECKPOINT_SUFFIX)] + '.part'
+
+
+def _zinfo_to_dict(zinfo: zipfile.ZipInfo) -> dict:
+    data = {field: getattr(zinfo, field) for field in _ZIPINFO_FIELDS}
+    data['filename'] = zinfo.filename
+    data['date_time'] = list(zinfo.date_time)
+    data['extra'] = zinfo.extra.hex()
+    return data
+
+
+def _member_to_dict(zinfo: zipfile.ZipInfo, size: int, mtime_ns: int) -> dict:
+    member = _zinfo_to_dict(zinfo)
+    member['size'] = size
+    member['mtime_ns'] = mtime_ns
+    return member
+
+
+def _zinfo_from_dict(data: dict) -> zipfile.ZipInfo:
+    zinfo = zipfile.ZipInfo(data['filename'], tuple(data['date_time']))
+    for field in _ZIPINFO_FIELDS:
+        setattr(zinfo, field, data[field])
+    zinfo.extra = bytes.fromhex(data['extra'])
+    return zinfo
+
+
+def load_checkpoint(checkpoint_file: str) -> typing.Optional[Checkpoint]:
+    # The checkpoint file is append-only (json lines); a line that was only
+    # partly written when the backup was interrupted ends the checkpoint.
+    # Returns None if there is nothing to resume.
+    try:
+        with open(checkpoint_file, 'r', encoding='utf-8') as f:
+            lines = f.read().split('\n')
+    except OSError:
+        return None
+    checkpoint = None
+    for line in lines:
+        try:
+            data = json.loads(line)
+        except ValueError:
+            break
+        if checkpoint is None:
+            if data.get('version') != CHECKPOINT_VERSION:
+                return None
+            checkpoint = Checkpoint(checkpoint_file, data)
+            continue
+        for member in data['members']:
+            checkpoint.members[member['filename']] = CommittedMember(_zinfo_from_dict(member), member['size'], member['mtime_ns'])
+        checkpoint.offset = data['offset']
+    if (checkpoint is None) or (checkpoint.offset == 0):
+        return None
+    # the archive itself must (still) be complete up to the offset
+    temp_file = get_checkpoint_temp_filepath(checkpoint_file)
+    if (not os.path.isfile(temp_file)) or (os.path.getsize(temp_file) < checkpoint.offset):
+        return None
+    return checkpoint
+
+
+def find_checkpoint(directories: list[str]) -> typing.Optional[Checkpoint]:
+    # the most recent checkpoint in the (backup) directories
+    checkpoints: list[Checkpoint] = []
+    for directory in directories:
+        for checkpoint_file in glob.glob(os.path.join(glob.escape(directory), '.*' + CHECKPOINT_SUFFIX)):
+            checkpoint = load_checkpoint(checkpoint_file)
+            if checkpoint is not None:
+                checkpoints.append(checkpoint)
+    if len(checkpoints) == 0:
+        return None
+    return max(checkpoints, key=lambda checkpoint: (checkpoint.backup_time, checkpoint.offset))
+
+
+def discard_checkpoints(directories: list[str], keep: str = None) -> list[str]:
+    # Deletes the checkpoints and the temporary files of interrupted archives
+    # (except those of the archive keep). Returns the deleted checkpoint files.
+    discarded: list[str] = []
+    for directory in directories:
+        for checkpoint_file in glob.glob(os.path.join(glob.escape(directory), '.*' + CHECKPOINT_SUFFIX)):
+            if (keep is not None) and (os.path.basename(checkpoint_file) == os.path.basename(get_checkpoint_filepath(keep))):
+                continue
+            for filepath in (get_checkpoint_temp_filepath(checkpoint_file), checkpoint_file):
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            discarded.append(checkpoint_file)
+    return discarded
+
+
+class CheckpointWriter:
+    # Appends a checkpoint to the checkpoint files every interval seconds: the
+    # members finished since the last checkpoint and the current offset of the
+    # archive. sync() must make the archive durable up to that offset before the
+    # checkpoint is written.
+    #
+    # Example usage:
+    #    checkpoint = CheckpointWriter(['/dest/.archive20250101120000.zip.checkpoint'], header, 300, tee.sync)
+    #    checkpoint.add_member(zinfo, size, mtime_ns, tee.tell())
+
+    def __init__(self, checkpoint_files: list[str], header: dict, interval: float, sync: typing.Callable[[], None], resume: Checkpoint = None):
+        self.checkpoint_files: list[str] = checkpoint_files
+        self.interval: float = interval
+        self._sync = sync
+        self._members: list[dict] = []
+        self._last: float = time.monotonic()
+        # the checkpoint files are written anew (a resumed checkpoint may end with a partly written line)
+        lines = [dict(header, version=CHECKPOINT_VERSION)]
+        if resume is not None:
+            members = [_member_to_dict(member.zinfo, member.size, member.mtime_ns) for member in resume.members.values()]
+            lines.append({'offset': resume.offset, 'members': members})
+        self._write(lines, replace=True)
+
+    def add_member(self, zinfo: zipfile.ZipInfo, size: int, mtime_ns: int, offset: int) -> None:
+        # called when a member is completely written; offset: end of the member
+        self._members.append(_member_to_dict(zinfo, size, mtime_ns))
+        if time.monotonic() - self._last >= self.interval:
+            self._sync()
+            self._write([{'offset': offset, 'members': self._members}])
+            self._members = []
+            self._last = time.monotonic()
+
+    def remove(self) -> None:
+        for checkpoint_file in self.checkpoint_files:
+            if os.path.exists(checkpoint_file):
+                os.remove(checkpoint_file)
+
+    def _write(self, lines: list[dict], replace: bool = False) -> None:
+        # appends the lines; replace: the checkpoint files are replaced atomically
+        text = ''.join(json.dumps(data) + '\n' for data in lines)
+        for checkpoint_file in self.checkpoint_files:
+            try:
+                filepath = checkpoint_file + '.tmp' if replace else checkpoint_file
+                with open(filepath, 'w' if replace else 'a', encoding='utf-8') as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if replace:
+                    os.replace(filepath, checkpoint_file)
+            except OSError:
+                # the checkpoint of this destination is lost - the archive itself is not affected
+                pass
@@ -0,0 +1,290 @@
+import os
+import json
+import zlib
+import hashlib
+import typing
+import threading
+import contextlib
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from .archive import get_default_workers
+from .scanner import ScanEntry
+from .throttle import ThrottleGroup
+from .utils import BACKUP_DIR_PREFIX, BACKUP_FILENAME_FORMAT_DATETIMESTAMP
+
+STORAGE_ARCHIVE = 'archive'
+STORAGE_CHUNKS = 'chunks'
+
+CHUNK_DIRECTORY = 'CHUNKS'
+SNAPSHOT_FILENAME_PREFIX = 'snapshot'
+SNAPSHOT_FILENAME_SUFFIX = '.json'
+
+# content defined chunking: chunk boundaries depend on the content only, so an
+# insertion at the beginning of a file does not shift all chunks. Every byte is
+# mapped to one of 4 symbols and a chunk ends after the first occurrence of
+# CHUNK_PATTERN (10 symbols, probability 4^-10 => average chunk size ~1 MiB).
+# bytes.translate and bytes.find search the boundaries at C speed.
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_SEARCH_SIZE = 1024 * 1024
+CHUNK_READ_SIZE = 8 * 1024 * 1024
+CHUNK_COMPRESSION_LEVEL = 6
+# files chunked ahead of the snapshot index (per worker)
+CHUNK_FILES_AHEAD = 4
+
+# the symbol table and the pattern must never change - otherwise chunk boundaries
+# (and thereby the deduplication against existing chunks) change as well.
+# 64 bytes per symbol; the pattern has no self-overlap and does not match runs
+# of a single byte value (e.g. zero filled regions are cut at CHUNK_MAX_SIZE).
+def _get_symbols() -> bytes:
+    # ranks the byte values by their sha256 hash
+    symbols = bytearray(256)
+    for rank, value in enumerate(sorted(range(256), key=lambda i: hashlib.sha256(i.to_bytes(2, 'big')).digest())):
+        symbols[value] = rank % 4
+    return bytes(symbols)
+
+
+_SYMBOLS = _get_symbols()
+CHUNK_PATTERN = bytes([0, 0, 1, 2, 3, 1, 3, 2, 2, 3])
+
+
+def _find_boundary(data: bytearray) -> int:
+    length = len(data)
+    if length <= CHUNK_MIN_SIZE:
+        return length
+    limit = min(length, CHUNK_MAX_SIZE)
+    # the pattern has to end at CHUNK_MIN_SIZE or later; the windows are searched
+    # one after another, overlapping by the pattern length - 1
+    overlap = len(CHUNK_PATTERN) - 1
+    view = memoryview(data)
+    start = CHUNK_MIN_SIZE - overlap
+    while start + overlap < limit:
+        end = min(limit, start + CHUNK_SEARCH_SIZE)
+        index = bytes(view[start:end]).translate(_SYMBOLS).find(CHUNK_PATTERN)
+        if index >= 0:
+            return start + index + len(CHUNK_PATTERN)
+        start = end - overlap
+    return limit
+
+
+def iter_chunks(f: typing.BinaryIO) -> typing.Iterator[bytes]:
+    buffer = bytearray()
+    eof = False
+    while True:
+        while (not eof) and (len(buffer) < CHUNK_MAX_SIZE):
+            data = f.read(CHUNK_READ_SIZE)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        cut = _find_boundary(buffer)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def get_chunk_file(destination_directory: str, chunk_hash: str) -> str:
+    return os.path.join(destination_directory, CHUNK_DIRECTORY, chunk_hash[:2], chunk_hash)
+
+
+def write_chunk(destination_directory: str, chunk: bytes, throttle: ThrottleGroup = None, chunk_hash: str = None) -> tuple[str, bool]:
+    # Stores the chunk under its hash, unless it is already present.
+    # Returns the hash and whether the chunk had to be written.
+    if chunk_hash is None:
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+    chunk_file = get_chunk_file(destination_directory, chunk_hash)
+    if os.path.exists(chunk_file):
+        return chunk_hash, False
+
+    chunk_dir = os.path.dirname(chunk_file)
+    if not os.path.exists(chunk_dir):
+        os.makedirs(chunk_dir, exist_ok=True)
+    # concurrent profiles may write the same chunk - each writer has its own temporary file
+    temp_file = '{}.{}.tmp'.format(chunk_file, threading.get_ident())
+    f = open(temp_file, 'wb')
+    with throttle.wrap_destination(destination_directory, f) if throttle is not None else f as f:
+        f.write(zlib.compress(chunk, CHUNK_COMPRESSION_LEVEL))
+    os.replace(temp_file, chunk_file)
+    return chunk_hash, True
+
+
+def read_chunk(destination_directory: str, chunk_hash: str) -> bytes:
+    with open(get_chunk_file(destination_directory, chunk_hash), 'rb') as f:
+        return zlib.decompress(f.read())
+
+
+def get_snapshot_dir(destination_directory: str, profile_id: str) -> str:
+    return os.path.join(destination_directory, BACKUP_DIR_PREFIX + profile_id)
+
+
+def parse_snapshot_time(filename: str) -> typing.Optional[datetime]:
+    if not (filename.startswith(SNAPSHOT_FILENAME_PREFIX) and filename.endswith(SNAPSHOT_FILENAME_SUFFIX)):
+        return None
+    try:
+        return datetime.strptime(filename[len(SNAPSHOT_FILENAME_PREFIX):-len(SNAPSHOT_FILENAME_SUFFIX)], BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+    except ValueError:
+        return None
+
+
+def list_snapshots(destination_directory: str, profile_id: str = None) -> list[str]:
+    # Returns the snapshot files (oldest first) of one or - if no profile_id is
+    # given - of all profiles stored in the destination.
+    if profile_id is not None:
+        snapshot_dirs = [get_snapshot_dir(destination_directory, profile_id)]
+    elif os.path.isdir(destination_directory):
+        snapshot_dirs = [entry.path for entry in os.scandir(destination_directory) if entry.is_dir() and entry.name.startswith(BACKUP_DIR_PREFIX)]
+    else:
+        snapshot_dirs = []
+
+    snapshots: list[str] = []
+    for snapshot_dir in snapshot_dirs:
+        if not os.path.isdir(snapshot_dir):
+            continue
+        for filename in sorted(os.listdir(snapshot_dir)):
+            if parse_snapshot_time(filename) is not None:
+                snapshots.append(os.path.join(snapshot_dir, filename))
+    return snapshots
+
+
+def load_snapshot(snapshot_file: str) -> dict:
+    with open(snapshot_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _store_file(filepath: str, destination_directories: list[str], throttle: ThrottleGroup = None) -> list[str]:
+    # the file is read once, its chunks are stored in all the chunk stores
+    chunks = []
+    with throttle.open_source(filepath) if throttle is not None else open(filepath, 'rb') as source:
+        for chunk in iter_chunks(source):
+            chunk_hash = hashlib.sha256(chunk).hexdigest()
+            for destination_directory in destination_directories:
+                write_chunk(destination_directory, chunk, throttle, chunk_hash)
+            chunks.append(chunk_hash)
+    return chunks
+
+
+def _load_previous_files(destination_directory: str, profile_id: str) -> dict:
+    # the files of the last snapshot of the profile ({}: none or unreadable)
+    snapshots = list_snapshots(destination_directory, profile_id)
+    if len(snapshots) == 0:
+        return {}
+    try:
+        return load_snapshot(snapshots[-1]).get('files', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _get_unchanged_chunks(previous_files: dict, entry: ScanEntry) -> typing.Optional[list[str]]:
+    previous = previous_files.get(entry.path)
+    if (previous is not None) and (previous['size'] == entry.size) and (previous['mtime_ns'] == entry.mtime_ns) and (previous['inode'] == entry.inode):
+        return previous['chunks']
+    return None
+
+
+def store_snapshot(files: typing.Iterable[ScanEntry], destination_directories: list[str], profile_id: str, backup_time: str, log, throttle: ThrottleGroup = None, workers: int = 0) -> list[tuple[str, int]]:
+    # Splits all files into chunks, stores new chunks in the (shared) chunk stores of
+    # the destinations and writes a snapshot index per destination that references
+    # these chunks. The files are scanned and read once for all destinations.
+    # Files that did not change since the last snapshot of the profile in a
+    # destination are not read for it - their chunk list is taken over from there.
+    # The snapshot indexes are written while the files are processed.
+    # throttle: limits the reads of the files and the writes of the chunks.
+    # workers: number of files chunked in parallel (0: one per cpu core).
+    #
+    # Returns the snapshot file and the number of files in the snapshot per destination.
+    previous_files = [_load_previous_files(destination_directory, profile_id) for destination_directory in destination_directories]
+    snapshot_files: list[str] = []
+    for destination_directory in destination_directories:
+        snapshot_dir = get_snapshot_dir(destination_directory, profile_id)
+        if not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        snapshot_files.append(os.path.join(snapshot_dir, SNAPSHOT_FILENAME_PREFIX + backup_time + SNAPSHOT_FILENAME_SUFFIX))
+    workers = workers if workers > 0 else get_default_workers()
+
+    counts = [0] * len(destination_directories)
+
+    def write_file(indexes: list, entry: ScanEntry, known: list, future) -> None:
+        # known: the chunk list of the unchanged file per destination (None: taken
+        # from the future of the chunked file)
+        filepath = entry.path
+        chunks = None
+        if future is not None:
+            try:
+                chunks = future.result()
+            except OSError as e:
+                log.log_error('Cannot back up file {}: {}'.format(filepath, e), profile=profile_id, path=filepath)
+        file_info = {
+            'size': entry.size,
+            'mtime_ns': entry.mtime_ns,
+            'inode': entry.inode,
+            'mode': entry.mode,
+        }
+        for i, f in enumerate(indexes):
+            file_chunks = known[i] if known[i] is not None else chunks
+            if file_chunks is None:
+                continue
+            if counts[i] > 0:
+                f.write(', ')
+            f.write('{}: {}'.format(json.dumps(filepath), json.dumps(dict(file_info, chunks=file_chunks))))
+            counts[i] += 1
+
+    with contextlib.ExitStack() as stack:
+        indexes = [stack.enter_context(open(snapshot_file + '.tmp', 'w', encoding='utf-8')) for snapshot_file in snapshot_files]
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        for f in indexes:
+            f.write('{{"profile": {}, "backup_time": {}, "files": {{'.format(json.dumps(profile_id), json.dumps(backup_time)))
+        # the files are chunked on the pool, the indexes are written in the order of the files
+        window: deque = deque()
+        for entry in files:
+            known = [_get_unchanged_chunks(previous, entry) for previous in previous_files]
+            missing = [destination_directory for destination_directory, chunks in zip(destination_directories, known) if chunks is None]
+            future = executor.submit(_store_file, entry.path, missing, throttle) if len(missing) > 0 else None
+            window.append((entry, known, future))
+            while len(window) > workers * CHUNK_FILES_AHEAD:
+                write_file(indexes, *window.popleft())
+        while len(window) > 0:
+            write_file(indexes, *window.popleft())
+        for f in indexes:
+            f.write('}}')
+    for snapshot_file in snapshot_files:
+        os.replace(snapshot_file + '.tmp', snapshot_file)
+    return list(zip(snapshot_files, counts))
+
+
+def cleanup_chunk_store(destination_directory: str, days_to_keep: int) -> None:
+    # Deletes expired snapshots (looked up in the catalog of the destination) and
+    # afterwards all chunks that are no longer referenced by any remaining snapshot
+    # (of any profile).
+    from .catalog import Catalog, BACKUP_KIND_SNAPSHOT
+    if (days_to_keep < 1) or (not os.path.isdir(destination_directory)):
+        return
+
+    cutoff = datetime.now() - timedelta(days=days_to_keep + 1)
+    with Catalog(destination_directory) as catalog:
+        # snapshots whose registration failed expire as well
+        catalog.add_untracked()
+        expired = catalog.get_expired_backups(cutoff, BACKUP_KIND_SNAPSHOT)
+        for record in expired:
+            snapshot_file = catalog.get_file(record)
+            if os.path.exists(snapshot_file):
+                os.remove(snapshot_file)
+            catalog.remove_backup(record.filename)
+    if len(expired) == 0:
+        return
+
+    references: Counter = Counter()
+    for snapshot_file in list_snapshots(destination_directory):
+        for file_info in load_snapshot(snapshot_file).get('files', {}).values():
+            references.update(file_info['chunks'])
+
+    chunk_root = os.path.join(destination_directory, CHUNK_DIRECTORY)
+    if not os.path.isdir(chunk_root):
+        return
+    for chunk_dir in os.scandir(chunk_root):
+        if not chunk_dir.is_dir():
+            continue
+        for chunk_file in os.scandir(chunk_dir.path):
+            if references[chunk_file.name] == 0:
+                os.remove(chunk_file.path)
@@ -2,6 +2,7 @@
 
 import argparse
 from backup.backupmgr import BackupManager
+from backup.journal import DEFAULT_POLL_INTERVAL
 
 def main() -> int:
     """Setup and read command line arguments; run the backup manager"""
@@ -19,11 +20,54 @@ def main() -> int:
     parser.add_argument('-t', '--dryrun', action='store_true', help='Perform a dry run to test configs and permissions without creating a backup')
     parser.add_argument('-p', '--profile', type=str, default='', help='Id of the profile that should be to back up')
     parser.add_argument('-d', '--destinations', nargs="*", default=[], help='List of destination ids')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of compression threads (overrides the "workers" of the profiles)')
+    parser.add_argument('-c', '--config', type=str, default=None, help='Path of the config file (default: config.json next to the backup package)')
+    parser.add_argument('--profile-run', action='store_true', help='Profile the run (cProfile and tracemalloc); the results are written next to the run reports')
+    parser.add_argument('-r', '--resume', action='store_true', help='Continue interrupted backups from their last checkpoint (otherwise they are discarded)')
+    parser.add_argument('--scan', action='store_true', help='Scan the sources even if the change journal of the watch daemon could be used')
+    parser.add_argument('-l', '--list', action='store_true', help='List the backups stored in the destinations (filtered by --profile)')
+
+    # subcommand "restore": restore files from the backups (without subcommand: backup)
+    subparsers = parser.add_subparsers(dest='command')
+    restore_parser = subparsers.add_parser('restore', help='Restore files from the backups (see "restore -h")')
+    restore_parser.add_argument('paths', nargs='*', default=[], help='Files or directories (paths as they were backed up) to restore, wildcards are supported; default: all files')
+    restore_parser.add_argument('-p', '--profile', type=str, required=True, help='Id of the profile whose backups are restored')
+    restore_parser.add_argument('-d', '--destinations', nargs="*", default=[], help='Destination ids to restore from (default: the first active destination with backups)')
+    restore_parser.add_argument('-T', '--time', type=str, default=None, help='Point in time, e.g. 20250131 or 20250131120000 (default: the latest backup)')
+    restore_parser.add_argument('--target', type=str, default=None, help='Restore into this directory (default: the original location)')
+    restore_parser.add_argument('--overwrite', action='store_true', help='Replace existing files')
+    restore_parser.add_argument('-w', '--workers', type=int, default=argparse.SUPPRESS, help='Number of extraction threads')
+    restore_parser.add_argument('-l', '--list', action='store_true', help='Only list the files that would be restored')
+
+    # subcommand "verify": check the stored backups against the checksums of the catalogs
+    verify_parser = subparsers.add_parser('verify', help='Verify the backups stored in the destinations (see "verify -h")')
+    verify_parser.add_argument('-p', '--profile', type=str, default='', help='Id of the profile whose backups are verified (default: all)')
+    verify_parser.add_argument('-d', '--destinations', nargs="*", default=[], help='Destination ids to verify (default: all active destinations)')
+    verify_parser.add_argument('-s', '--sample', type=float, default=100, help='Percentage of the blocks (or chunks) of each backup that are checked (default: 100)')
+    verify_parser.add_argument('-w', '--workers', type=int, default=argparse.SUPPRESS, help='Number of threads reading the backups')
+
+    # subcommand "watch": daemon that keeps a change journal of the sources (incremental profiles)
+    watch_parser = subparsers.add_parser('watch', help='Watch the sources and keep a change journal, so backups do not have to scan (see "watch -h")')
+    watch_parser.add_argument('-p', '--profile', type=str, default='', help='Id of the profile that is watched (default: all active incremental profiles)')
+    watch_parser.add_argument('-d', '--destinations', nargs="*", default=[], help='Destination ids of the backups started by the daemon')
+    watch_parser.add_argument('-i', '--interval', type=float, default=0, help='Run a backup every INTERVAL seconds (default: 0 - only keep the journal, backups are scheduled as usual)')
+    watch_parser.add_argument('-w', '--workers', type=int, default=argparse.SUPPRESS, help='Number of compression threads of the backups started by the daemon')
+    watch_parser.add_argument('--poll', action='store_true', help='Poll the sources instead of using inotify')
+    watch_parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL, help='Seconds between two polls (default: {:.0f})'.format(DEFAULT_POLL_INTERVAL))
 
     # read argument input
     args = parser.parse_args() 
 
     # create and run job
+    if args.command == 'restore':
+        from backup.restore import RestoreManager
+        return RestoreManager(args).run()
+    if args.command == 'watch':
+        from backup.watch import WatchManager
+        return WatchManager(args).run()
+    if args.command == 'verify':
+        from backup.verify import VerifyManager
+        return VerifyManager(args).run()
     backup_manager = BackupManager(args)
     return backup_manager.run()
 
@@ -0,0 +1,167 @@
+import os
+import io
+import gzip
+import lzma
+import math
+import typing
+import tarfile
+from collections import Counter
+
+# zstandard is optional - only needed for the tar.zst format
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMAT_ZIP = 'zip'
+FORMAT_TAR_GZ = 'tar.gz'
+FORMAT_TAR_XZ = 'tar.xz'
+FORMAT_TAR_ZST = 'tar.zst'
+FORMATS = (FORMAT_ZIP, FORMAT_TAR_GZ, FORMAT_TAR_XZ, FORMAT_TAR_ZST)
+
+# codecs of the members of zip archives
+CODEC_STORE = 'store'
+CODEC_DEFLATE = 'deflate'
+CODEC_LZMA = 'lzma'
+CODECS = (CODEC_STORE, CODEC_DEFLATE, CODEC_LZMA)
+
+# default compression level per format; zip: per codec
+DEFAULT_LEVELS = {
+    CODEC_DEFLATE: 6,
+    CODEC_LZMA: 6,
+    FORMAT_TAR_GZ: 6,
+    FORMAT_TAR_XZ: 6,
+    FORMAT_TAR_ZST: 3,
+}
+LEVEL_RANGES = {
+    CODEC_STORE: (0, 9),
+    CODEC_DEFLATE: (0, 9),
+    CODEC_LZMA: (0, 9),
+    FORMAT_TAR_GZ: (0, 9),
+    FORMAT_TAR_XZ: (0, 9),
+    FORMAT_TAR_ZST: (1, 22),
+}
+
+# files that are already compressed - trying to compress them wastes cpu time
+DEFAULT_STORE_EXTENSIONS = [
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.aac', '.ogg', '.flac', '.m4a', '.opus',
+    '.mp4', '.m4v', '.mkv', '.avi', '.mov', '.webm',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.7z', '.rar', '.lz4',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.jar', '.apk', '.whl',
+]
+# files with a higher entropy (bits per byte) of their first block are stored
+DEFAULT_ENTROPY_THRESHOLD = 7.5
+ENTROPY_SAMPLE_SIZE = 16 * 1024
+ENTROPY_MIN_FILE_SIZE = 4 * 1024
+
+
+def get_archive_extension(format: str) -> str:
+    return '.' + format
+
+
+def get_archive_format(filename: str) -> typing.Optional[str]:
+    for format in FORMATS:
+        if filename.endswith(get_archive_extension(format)):
+            return format
+    return None
+
+
+def estimate_entropy(sample: bytes) -> float:
+    # Shannon entropy in bits per byte (0: constant data, 8: random data)
+    length = len(sample)
+    if length == 0:
+        return 0.0
+    return -sum((count / length) * math.log2(count / length) for count in Counter(sample).values())
+
+
+class CompressionPolicy:
+    # Decides per file, how a member of a zip archive is compressed.
+    #
+    # Already compressed files (by extension) and files whose first block looks
+    # random (entropy sample) are stored, everything else uses the codec.
+
+    def __init__(self, codec: str = CODEC_DEFLATE, level: int = None, store_extensions: list[str] = None, entropy_threshold: float = DEFAULT_ENTROPY_THRESHOLD):
+        self.codec: str = codec
+        self.level: int = level if level is not None else DEFAULT_LEVELS.get(codec, 0)
+        extensions = store_extensions if store_extensions is not None else DEFAULT_STORE_EXTENSIONS
+        self.store_extensions: set[str] = {extension.lower() for extension in extensions}
+        self.entropy_threshold: float = entropy_threshold
+
+    def get_codec(self, filepath: str, file_size: int, first_block: bytes) -> str:
+        if self.codec == CODEC_STORE:
+            return CODEC_STORE
+        if os.path.splitext(filepath)[1].lower() in self.store_extensions:
+            return CODEC_STORE
+        if (self.entropy_threshold > 0) and (file_size >= ENTROPY_MIN_FILE_SIZE):
+            if estimate_entropy(first_block[:ENTROPY_SAMPLE_SIZE]) >= self.entropy_threshold:
+                return CODEC_STORE
+        return self.codec
+
+
+def open_compressed_stream(fileobj: typing.BinaryIO, format: str, level: int = None, workers: int = None) -> typing.BinaryIO:
+    # Returns a (non-seekable) stream that compresses everything written to it
+    # into fileobj. The tar archive is written into this stream.
+    if level is None:
+        level = DEFAULT_LEVELS[format]
+    if format == FORMAT_TAR_GZ:
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level)
+    if format == FORMAT_TAR_XZ:
+        return lzma.LZMAFile(fileobj, 'wb', preset=level)
+    if format == FORMAT_TAR_ZST:
+        if zstandard is None:
+            raise Exception('The format "{}" requires the python package "zstandard"'.format(format))
+        # zstd compresses on several threads itself
+        compressor = zstandard.ZstdCompressor(level=level, threads=workers if workers else -1)
+        return compressor.stream_writer(fileobj, closefd=False)
+    raise ValueError('Unknown archive format: {}'.format(format))
+
+
+def open_decompressed_stream(fileobj: typing.BinaryIO, format: str) -> typing.BinaryIO:
+    # counterpart of open_compressed_stream (for reading tar archives as a stream)
+    if format == FORMAT_TAR_GZ:
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if format == FORMAT_TAR_XZ:
+        return lzma.LZMAFile(fileobj, 'rb')
+    if format == FORMAT_TAR_ZST:
+        if zstandard is None:
+            raise Exception('The format "{}" requires the python package "zstandard"'.format(format))
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+    raise ValueError('Unknown archive format: {}'.format(format))
+
+
+def write_tar(fileobj: typing.BinaryIO, filepaths: typing.Iterable[str], format: str, level: int = None, workers: int = None, extra_members: typing.Callable[[], dict[str, bytes]] = None, opener: typing.Callable[[str], typing.BinaryIO] = None, on_skipped: typing.Callable[[str, OSError], None] = None) -> None:
+    # Writes a compressed tar archive as a stream (no seeking needed).
+    # extra_members is called after all files have been added.
+    # opener: opens the files for reading (e.g. throttle.ThrottleGroup.open_source)
+    # on_skipped: files that vanished or became unreadable are left out and reported
+    # with the error (default: the error is raised).
+    if opener is None:
+        opener = lambda filepath: open(filepath, 'rb')
+    stream = open_compressed_stream(fileobj, format, level, workers)
+    try:
+        with tarfile.open(fileobj=stream, mode='w|') as tar:
+            for filepath in filepaths:
+                # same as tar.add for a single file
+                try:
+                    tarinfo = tar.gettarinfo(filepath, arcname=filepath)
+                    f = opener(filepath) if (tarinfo is not None) and tarinfo.isreg() else None
+                except OSError as e:
+                    if on_skipped is None:
+                        raise
+                    on_skipped(filepath, e)
+                    continue
+                if tarinfo is None:
+                    continue
+                if f is not None:
+                    with f:
+                        tar.addfile(tarinfo, f)
+                else:
+                    tar.addfile(tarinfo)
+            members = extra_members() if extra_members is not None else {}
+            for arcname, data in members.items():
+                tarinfo = tarfile.TarInfo(arcname)
+                tarinfo.size = len(data)
+                tar.addfile(tarinfo, io.BytesIO(data))
+    finally:
+        stream.close()
@@ -1,15 +1,197 @@
-from .logmgr import LogManager
+import os
+import typing
+from .logmgr import LogManager, ERRORLOG_DIRECTORY, DEFAULT_LOG_LEVEL, LOG_LEVELS
+from .manifest import BACKUP_MODE_FULL, BACKUP_MODE_INCREMENTAL
+from .chunkstore import STORAGE_ARCHIVE, STORAGE_CHUNKS
+from .metrics import DEFAULT_REPORT_DIRECTORY, DEFAULT_SLOWEST_FILES
+from .checkpoint import DEFAULT_CHECKPOINT_INTERVAL
+from .journal import JOURNAL_DIRECTORY
+from .throttle import Throttle, MIB, parse_io_priority
+from .backends import DestinationBackend, S3Backend, BACKENDS, BACKEND_LOCAL, BACKEND_S3, DEFAULT_PART_SIZE_MB, MIN_PART_SIZE_MB, DEFAULT_MAX_CONNECTIONS, boto3
+from .compression import CompressionPolicy, FORMATS, FORMAT_ZIP, FORMAT_TAR_ZST, CODECS, CODEC_DEFLATE, LEVEL_RANGES, DEFAULT_ENTROPY_THRESHOLD, zstandard
+
+
+class Compression:
+    # "compression" section of a profile: archive format, codec and level
+
+    def __init__(self):
+        self.format: str = FORMAT_ZIP
+        self.codec: str = CODEC_DEFLATE       # codec of the zip members
+        self.level: int = None                # None: default level of the codec/format
+        self.store_extensions: list[str] = None     # None: compression.DEFAULT_STORE_EXTENSIONS
+        self.entropy_threshold: float = DEFAULT_ENTROPY_THRESHOLD
+
+    def get_policy(self) -> CompressionPolicy:
+        return CompressionPolicy(self.codec, self.level, self.store_extensions, self.entropy_threshold)
+
+    def is_valid(self, log: LogManager, profile_id: str) -> bool:
+        result = True
+        if self.format not in FORMATS:
+            log.log_error('The value of "{}" has to be one of {}. Error occured in profile: {}'.format(COMPRESSION_FORMAT, ', '.join(FORMATS), profile_id))
+            return False
+        if (self.format == FORMAT_TAR_ZST) and (zstandard is None):
+            log.log_error('The format "{}" requires the python package "zstandard". Error occured in profile: {}'.format(FORMAT_TAR_ZST, profile_id))
+            result = False
+
+        if self.codec not in CODECS:
+            log.log_error('The value of "{}" has to be one of {}. Error occured in profile: {}'.format(COMPRESSION_CODEC, ', '.join(CODECS), profile_id))
+            return False
+
+        if self.level is not None:
+            minimum, maximum = LEVEL_RANGES[self.codec if self.format == FORMAT_ZIP else self.format]
+            if (type(self.level) != int) or (self.level < minimum) or (self.level > maximum):
+                log.log_error('The value of "{}" has to be an int between {} and {}. Error occured in profile: {}'.format(COMPRESSION_LEVEL, minimum, maximum, profile_id))
+                result = False
+
+        if (self.store_extensions is not None) and (type(self.store_extensions) != list):
+            log.log_error('The value of "{}" has to be of type list. Error occured in profile: {}'.format(COMPRESSION_STORE_EXTENSIONS, profile_id))
+            result = False
+
+        if type(self.entropy_threshold) not in (int, float):
+            log.log_error('The value of "{}" has to be a number (0: no entropy check). Error occured in profile: {}'.format(COMPRESSION_ENTROPY_THRESHOLD, profile_id))
+            result = False
+
+        return result
+
+
+class Limits:
+    # optional "limits" section of a profile or a destination (see throttle.Throttle).
+    # Destinations only use write_mbps, iops and adaptive.
+
+    def __init__(self):
+        self.read_mbps: float = 0       # MiB/s read from the sources; 0: no limit
+        self.write_mbps: float = 0      # MiB/s written
+        self.iops: float = 0            # read and write operations per second
+        self.max_workers: int = 0       # cap on the compression and scan threads; 0: no cap
+        self.adaptive: bool = False     # back off when the I/O latency rises
+
+    def get_throttle(self) -> Throttle:
+        return Throttle(self.read_mbps * MIB, self.write_mbps * MIB, self.iops, self.adaptive)
+
+    def is_valid(self, log: LogManager, section: str) -> bool:
+        # section: e.g. "profile: my_profile"
+        result = True
+        for key, value in ((LIMITS_READ_MBPS, self.read_mbps), (LIMITS_WRITE_MBPS, self.write_mbps), (LIMITS_IOPS, self.iops)):
+            if (type(value) not in (int, float)) or (value < 0):
+                log.log_error('The value of "{}" has to be a positive number (0: no limit). Error occured in {}'.format(key, section))
+                result = False
+
+        if (type(self.max_workers) != int) or (self.max_workers < 0):
+            log.log_error('The value of "{}" has to be a positive int (0: no limit). Error occured in {}'.format(LIMITS_MAX_WORKERS, section))
+            result = False
+
+        if type(self.adaptive) != bool:
+            log.log_error('The value of "{}" has to be of type bool. Error occured in {}'.format(LIMITS_ADAPTIVE, section))
+            result = False
+
+        return result
+
+
+class Backend:
+    # optional "backend" section of a destination: where the backup files are stored
+    # (see backends). The catalog, manifests and checkpoints stay in the directory.
+
+    def __init__(self):
+        self.type: str = BACKEND_LOCAL
+        self.bucket: str = ''
+        self.prefix: str = ''                       # key prefix of the backup files in the bucket
+        self.endpoint_url: str = None               # None: AWS
+        self.region: str = None
+        self.access_key_id: str = None              # None: default credential chain of boto3
+        self.secret_access_key: str = None
+        self.part_size_mb: int = DEFAULT_PART_SIZE_MB
+        self.max_connections: int = DEFAULT_MAX_CONNECTIONS
+
+    def get_backend(self, directory: str) -> typing.Optional[DestinationBackend]:
+        # None: the backup files are written into the directory itself
+        if self.type == BACKEND_S3:
+            return S3Backend(directory, self.bucket, self.prefix, self.endpoint_url, self.region, self.access_key_id, self.secret_access_key,
+                             self.part_size_mb * MIB, self.max_connections)
+        return None
+
+    def is_valid(self, log: LogManager, destination_id: str) -> bool:
+        if self.type not in BACKENDS:
+            log.log_error('The value of "{}" has to be one of {}. Error occured in destination index: {}'.format(BACKEND_TYPE, ', '.join(BACKENDS), destination_id))
+            return False
+        if self.type == BACKEND_LOCAL:
+            return True
+
+        result = True
+        if boto3 is None:
+            log.log_error('The backend "{}" requires the python package "boto3". Error occured in destination index: {}'.format(BACKEND_S3, destination_id))
+            result = False
+
+        if (type(self.bucket) != str) or (self.bucket == ''):
+            log.log_error('Please define "{}" in the backend of destination index: {}'.format(BACKEND_BUCKET, destination_id))
+            result = False
+
+        for key, value in ((BACKEND_PREFIX, self.prefix), (BACKEND_ENDPOINT_URL, self.endpoint_url), (BACKEND_REGION, self.region),
+                           (BACKEND_ACCESS_KEY_ID, self.access_key_id), (BACKEND_SECRET_ACCESS_KEY, self.secret_access_key)):
+            if (value is not None) and (type(value) != str):
+                log.log_error('The value of "{}" has to be of type str. Error occured in destination index: {}'.format(key, destination_id))
+                result = False
+
+        if (type(self.part_size_mb) != int) or (self.part_size_mb < MIN_PART_SIZE_MB):
+            log.log_error('The value of "{}" has to be an int of at least {} (MiB). Error occured in destination index: {}'.format(BACKEND_PART_SIZE_MB, MIN_PART_SIZE_MB, destination_id))
+            result = False
+
+        if (type(self.max_connections) != int) or (self.max_connections < 1):
+            log.log_error('The value of "{}" has to be a positive int. Error occured in destination index: {}'.format(BACKEND_MAX_CONNECTIONS, destination_id))
+            result = False
+
+        return result
 
 BACKUP_PROFILES = 'backup_profiles'
 BACKUP_DESTINATINS = 'backup_destinations'
+BACKUP_SETTINGS = 'settings'
+SETTINGS_REPORT_DIRECTORY = 'report_directory'
+SETTINGS_PROMETHEUS_TEXTFILE = 'prometheus_textfile'
+SETTINGS_SLOWEST_FILES = 'slowest_files'
+SETTINGS_LOG_DIRECTORY = 'log_directory'
+SETTINGS_LOG_LEVEL = 'log_level'
+SETTINGS_CHECKPOINT_INTERVAL = 'checkpoint_interval'
+SETTINGS_JOURNAL_DIRECTORY = 'journal_directory'
+SETTINGS_NICE = 'nice'
+SETTINGS_IO_PRIORITY = 'io_priority'
+SETTINGS_CONCURRENT_PROFILES = 'concurrent_profiles'
 PROFILE_IDENT  = 'id'
 PROFILE_ACTIVE = 'active'
 PROFILE_SOURCE = 'source'
 PROFILE_IGNORE = 'ignore'
+PROFILE_MODE = 'mode'
+PROFILE_DAYS_BETWEEN_FULL = 'days_between_full'
+PROFILE_MANIFEST_HASH = 'manifest_hash'
+PROFILE_WORKERS = 'workers'
+PROFILE_COMPRESSION = 'compression'
+PROFILE_VOLUME_SIZE = 'volume_size'
+PROFILE_DELTA_MIN_SIZE = 'delta_min_size'
+PROFILE_LIMITS = 'limits'
+COMPRESSION_FORMAT = 'format'
+COMPRESSION_CODEC = 'codec'
+COMPRESSION_LEVEL = 'level'
+COMPRESSION_STORE_EXTENSIONS = 'store_extensions'
+COMPRESSION_ENTROPY_THRESHOLD = 'entropy_threshold'
+LIMITS_READ_MBPS = 'read_mbps'
+LIMITS_WRITE_MBPS = 'write_mbps'
+LIMITS_IOPS = 'iops'
+LIMITS_MAX_WORKERS = 'max_workers'
+LIMITS_ADAPTIVE = 'adaptive'
 DESTINATION_IDENT = 'id'
 DESTINATION_ACTIVE = 'active'
 DESTINATION_DIRECTORY = 'directory'
 DESTINATION_DAYS_TO_KEEP = 'days_to_keep'
+DESTINATION_STORAGE = 'storage'
+DESTINATION_LIMITS = 'limits'
+DESTINATION_BACKEND = 'backend'
+BACKEND_TYPE = 'type'
+BACKEND_BUCKET = 'bucket'
+BACKEND_PREFIX = 'prefix'
+BACKEND_ENDPOINT_URL = 'endpoint_url'
+BACKEND_REGION = 'region'
+BACKEND_ACCESS_KEY_ID = 'access_key_id'
+BACKEND_SECRET_ACCESS_KEY = 'secret_access_key'
+BACKEND_PART_SIZE_MB = 'part_size_mb'
+BACKEND_MAX_CONNECTIONS = 'max_connections'
 
 
 class Profile:
@@ -19,6 +201,20 @@ class Profile:
         self.id: str = ''
         self.source: list[str] = []
         self.ignore: list[str] = []
+        self.mode: str = BACKUP_MODE_FULL
+        self.days_between_full: int = 7
+        self.manifest_hash: bool = False
+        self.workers: int = 0       # number of compression threads; 0: one per cpu core
+        self.compression: Compression = Compression()
+        self.volume_size: int = 0   # MiB per volume of a multi-volume archive; 0: a single archive
+        self.delta_min_size: int = 0    # MiB; larger files are stored as deltas (incremental zip backups); 0: no delta mode
+        self.limits: Limits = Limits()
+
+    def get_volume_size(self) -> int:
+        return self.volume_size * 1024 * 1024
+
+    def get_delta_min_size(self) -> int:
+        return self.delta_min_size * 1024 * 1024
 
     def is_valid(self, log: LogManager) -> bool:
         result = True
@@ -38,6 +234,39 @@ class Profile:
                 log.log_error('Please define "{}" in profile: {}'. format(PROFILE_SOURCE, self.id))
                 result = False
 
+        if self.mode not in (BACKUP_MODE_FULL, BACKUP_MODE_INCREMENTAL):
+            log.log_error('The value of "{}" has to be "{}" or "{}". Error occured in profile: {}'. format(PROFILE_MODE, BACKUP_MODE_FULL, BACKUP_MODE_INCREMENTAL, self.id))
+            result = False
+
+        if type(self.days_between_full) != int:
+            log.log_error('The value of "{}" has to be of type int. Error occured in profile: {}'. format(PROFILE_DAYS_BETWEEN_FULL, self.id))
+            result = False
+
+        if type(self.manifest_hash) != bool:
+            log.log_error('The value of "{}" has to be of type bool. Error occured in profile: {}'. format(PROFILE_MANIFEST_HASH, self.id))
+            result = False
+
+        if (type(self.workers) != int) or (self.workers < 0):
+            log.log_error('The value of "{}" has to be a positive int (0: one worker per cpu core). Error occured in profile: {}'. format(PROFILE_WORKERS, self.id))
+            result = False
+
+        if (type(self.volume_size) != int) or (self.volume_size < 0):
+            log.log_error('The value of "{}" has to be a positive int (MiB; 0: a single archive). Error occured in profile: {}'. format(PROFILE_VOLUME_SIZE, self.id))
+            result = False
+
+        if (type(self.delta_min_size) != int) or (self.delta_min_size < 0):
+            log.log_error('The value of "{}" has to be a positive int (MiB; 0: no delta mode). Error occured in profile: {}'. format(PROFILE_DELTA_MIN_SIZE, self.id))
+            result = False
+        elif (self.delta_min_size > 0) and ((self.mode != BACKUP_MODE_INCREMENTAL) or (self.compression.format != FORMAT_ZIP)):
+            log.log_error('The delta mode ("{}") requires the mode "{}" and the format "{}". Error occured in profile: {}'. format(PROFILE_DELTA_MIN_SIZE, BACKUP_MODE_INCREMENTAL, FORMAT_ZIP, self.id))
+            result = False
+
+        if not self.compression.is_valid(log, self.id):
+            result = False
+
+        if not self.limits.is_valid(log, 'profile: {}'.format(self.id)):
+            result = False
+
         return result        
     
 
@@ -49,6 +278,9 @@ class Destination:
         self.id: str = ''
         self.directory: str = ''    
         self.days_to_keep: int = -1    
+        self.storage: str = STORAGE_ARCHIVE
+        self.limits: Limits = Limits()
+        self.backend: Backend = Backend()
 
     def is_valid(self, log: LogManager) -> bool:
         import os
@@ -68,10 +300,98 @@ class Destination:
                 if not os.access(os.path.dirname(self.directory), os.W_OK):
                     log.log_error('Write privileges are not given at destination {}: {}. Error occured in destination index: {}'.format(DESTINATION_DIRECTORY, self.directory, self.id))
                     result = False
+
+        if self.storage not in (STORAGE_ARCHIVE, STORAGE_CHUNKS):
+            log.log_error('The value of "{}" has to be "{}" or "{}". Error occured in destination index: {}'.format(DESTINATION_STORAGE, STORAGE_ARCHIVE, STORAGE_CHUNKS, self.id))
+            result = False
+
+        if not self.limits.is_valid(log, 'destination index: {}'.format(self.id)):
+            result = False
+
+        if not self.backend.is_valid(log, self.id):
+            result = False
+        elif (self.backend.type != BACKEND_LOCAL) and (self.storage == STORAGE_CHUNKS):
+            log.log_error('The storage "{}" is only supported in local directories. Error occured in destination index: {}'.format(STORAGE_CHUNKS, self.id))
+            result = False
         
         return result
 
 
+class Settings:
+    # optional "settings" section: options that apply to the whole backup run
+    # (relative paths are relative to the directory of the config file)
+
+    def __init__(self):
+        self.report_directory: str = DEFAULT_REPORT_DIRECTORY        # JSON run reports
+        self.prometheus_textfile: str = None                         # None: no prometheus metrics
+        self.slowest_files: int = DEFAULT_SLOWEST_FILES              # number of slowest files in the report
+        self.log_directory: str = ERRORLOG_DIRECTORY                 # error log and event log
+        self.log_level: str = DEFAULT_LOG_LEVEL                      # minimum level of the event log
+        self.checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL  # seconds between checkpoints of zip archives; 0: none
+        self.journal_directory: str = JOURNAL_DIRECTORY              # change journals of the watch daemon
+        self.nice: int = None                                        # CPU priority of the backup run; None: unchanged
+        self.io_priority: str = None                                 # I/O priority, e.g. "idle" or "best-effort:7"; None: unchanged
+        self.concurrent_profiles: bool = True                        # one scan for all profiles, archived at the same time
+
+    def is_valid(self, log: LogManager) -> bool:
+        result = True
+        if (type(self.report_directory) != str) or (self.report_directory == ''):
+            log.log_error('The value of "{}" has to be a directory. Error occured in section: {}'.format(SETTINGS_REPORT_DIRECTORY, BACKUP_SETTINGS))
+            result = False
+
+        if (self.prometheus_textfile is not None) and (type(self.prometheus_textfile) != str):
+            log.log_error('The value of "{}" has to be of type str. Error occured in section: {}'.format(SETTINGS_PROMETHEUS_TEXTFILE, BACKUP_SETTINGS))
+            result = False
+
+        if (type(self.slowest_files) != int) or (self.slowest_files < 0):
+            log.log_error('The value of "{}" has to be a positive int. Error occured in section: {}'.format(SETTINGS_SLOWEST_FILES, BACKUP_SETTINGS))
+            result = False
+
+        if (type(self.log_directory) != str) or (self.log_directory == ''):
+            log.log_error('The value of "{}" has to be a directory. Error occured in section: {}'.format(SETTINGS_LOG_DIRECTORY, BACKUP_SETTINGS))
+            result = False
+
+        if (type(self.journal_directory) != str) or (self.journal_directory == ''):
+            log.log_error('The value of "{}" has to be a directory. Error occured in section: {}'.format(SETTINGS_JOURNAL_DIRECTORY, BACKUP_SETTINGS))
+            result = False
+
+        if self.log_level not in LOG_LEVELS:
+            log.log_error('The value of "{}" has to be one of {}. Error occured in section: {}'.format(SETTINGS_LOG_LEVEL, ', '.join(LOG_LEVELS), BACKUP_SETTINGS))
+            result = False
+
+        if (self.nice is not None) and ((type(self.nice) != int) or (self.nice < -20) or (self.nice > 19)):
+            log.log_error('The value of "{}" has to be an int between -20 and 19. Error occured in section: {}'.format(SETTINGS_NICE, BACKUP_SETTINGS))
+            result = False
+
+        if (self.io_priority is not None) and ((type(self.io_priority) != str) or (parse_io_priority(self.io_priority) is None)):
+            log.log_error('The value of "{}" has to be "idle", "best-effort" or "realtime", optionally with a level 0-7 (e.g. "best-effort:7"). Error occured in section: {}'.format(SETTINGS_IO_PRIORITY, BACKUP_SETTINGS))
+            result = False
+
+        if type(self.concurrent_profiles) != bool:
+            log.log_error('The value of "{}" has to be of type bool. Error occured in section: {}'.format(SETTINGS_CONCURRENT_PROFILES, BACKUP_SETTINGS))
+            result = False
+
+        if (type(self.checkpoint_interval) not in (int, float)) or (self.checkpoint_interval < 0):
+            log.log_error('The value of "{}" has to be a positive number (seconds). Error occured in section: {}'.format(SETTINGS_CHECKPOINT_INTERVAL, BACKUP_SETTINGS))
+            result = False
+
+        return result
+
+
+def resolve_source(source: str) -> str:
+    # Relative sources (e.g. "**/sample/") are relative to the working directory of
+    # the run. They are resolved, so the files are archived with their absolute path
+    # and a restore writes them back to where they came from.
+    return source if os.path.isabs(source) else os.path.join(os.getcwd(), source)
+
+
+def get_config_filepath(config_filepath: str = None) -> str:
+    # default: config.json next to the backup package
+    if config_filepath:
+        return os.path.abspath(config_filepath)
+    return os.path.join(os.path.dirname(__file__), 'config.json')
+
+
 class ConfigObject:
 
     def __init__(self, config_filepath: str, log: LogManager):
@@ -84,6 +404,7 @@ class ConfigObject:
         configs = self._loadConfigs()
         self.profiles: dict[str, Profile] = self._extract_profiles(configs)
         self.destinations: dict[str, Destination] = self._extract_destinations(configs)
+        self.settings: Settings = self._extract_settings(configs)
 
 
     def _loadConfigs(self) -> dict:
@@ -102,11 +423,25 @@ class ConfigObject:
                 profile.active = elemnt.get(PROFILE_ACTIVE)
                 profile.source = elemnt.get(PROFILE_SOURCE)
                 profile.ignore = elemnt.get(PROFILE_IGNORE)
+                profile.mode = elemnt.get(PROFILE_MODE, profile.mode)
+                profile.days_between_full = elemnt.get(PROFILE_DAYS_BETWEEN_FULL, profile.days_between_full)
+                profile.manifest_hash = elemnt.get(PROFILE_MANIFEST_HASH, profile.manifest_hash)
+                profile.workers = elemnt.get(PROFILE_WORKERS, profile.workers)
+                profile.volume_size = elemnt.get(PROFILE_VOLUME_SIZE, profile.volume_size)
+                profile.delta_min_size = elemnt.get(PROFILE_DELTA_MIN_SIZE, profile.delta_min_size)
+                compression = elemnt.get(PROFILE_COMPRESSION, {})
+                profile.compression.format = compression.get(COMPRESSION_FORMAT, profile.compression.format)
+                profile.compression.codec = compression.get(COMPRESSION_CODEC, profile.compression.codec)
+                profile.compression.level = compression.get(COMPRESSION_LEVEL, profile.compression.level)
+                profile.compression.store_extensions = compression.get(COMPRESSION_STORE_EXTENSIONS, profile.compression.store_extensions)
+                profile.compression.entropy_threshold = compression.get(COMPRESSION_ENTROPY_THRESHOLD, profile.compression.entropy_threshold)
+                self._extract_limits(elemnt.get(PROFILE_LIMITS, {}), profile.limits)
 
                 if (profile.id is None) or (profile.id in profiles):    
                     profile.id += '_' + str(i)  
 
                 if profile.is_valid(self.log):
+                    profile.source = [resolve_source(source) if type(source) == str else source for source in profile.source]
                     profiles[profile.id] = profile   
 
             return profiles   
@@ -129,6 +464,9 @@ class ConfigObject:
                 destination.active = elemnt.get(DESTINATION_ACTIVE)
                 destination.directory = elemnt.get(DESTINATION_DIRECTORY)
                 destination.days_to_keep = elemnt.get(DESTINATION_DAYS_TO_KEEP)
+                destination.storage = elemnt.get(DESTINATION_STORAGE, destination.storage)
+                self._extract_limits(elemnt.get(DESTINATION_LIMITS, {}), destination.limits)
+                self._extract_backend(elemnt.get(DESTINATION_BACKEND, {}), destination.backend)
 
                 if (destination.id is None) or (destination.id in destinations):
                     destination.id += '_' + str(i)  
@@ -143,5 +481,54 @@ class ConfigObject:
             self.log.log_error('Either: Backup destination key "{}" not found in configuration'.format(BACKUP_DESTINATINS))
             self.log.log_error('Or: The value for "{}" in the configuration is not a list.'.format(BACKUP_DESTINATINS))
             self.log.log_error(f'Error: {e}')
-            return {}    
-   
\ No newline at end of file
+            return {}
+
+
+    def _extract_limits(self, elemnt: dict, limits: Limits) -> None:
+        limits.read_mbps = elemnt.get(LIMITS_READ_MBPS, limits.read_mbps)
+        limits.write_mbps = elemnt.get(LIMITS_WRITE_MBPS, limits.write_mbps)
+        limits.iops = elemnt.get(LIMITS_IOPS, limits.iops)
+        limits.max_workers = elemnt.get(LIMITS_MAX_WORKERS, limits.max_workers)
+        limits.adaptive = elemnt.get(LIMITS_ADAPTIVE, limits.adaptive)
+
+
+    def _extract_backend(self, elemnt: dict, backend: Backend) -> None:
+        backend.type = elemnt.get(BACKEND_TYPE, backend.type)
+        backend.bucket = elemnt.get(BACKEND_BUCKET, backend.bucket)
+        backend.prefix = elemnt.get(BACKEND_PREFIX, backend.prefix)
+        backend.endpoint_url = elemnt.get(BACKEND_ENDPOINT_URL, backend.endpoint_url)
+        backend.region = elemnt.get(BACKEND_REGION, backend.region)
+        backend.access_key_id = elemnt.get(BACKEND_ACCESS_KEY_ID, backend.access_key_id)
+        backend.secret_access_key = elemnt.get(BACKEND_SECRET_ACCESS_KEY, backend.secret_access_key)
+        backend.part_size_mb = elemnt.get(BACKEND_PART_SIZE_MB, backend.part_size_mb)
+        backend.max_connections = elemnt.get(BACKEND_MAX_CONNECTIONS, backend.max_connections)
+
+
+    def _extract_settings(self, configs: dict) -> Settings:
+        # the settings section is optional; invalid settings fall back to the defaults
+        settings = Settings()
+        elemnt = configs.get(BACKUP_SETTINGS, {})
+        if type(elemnt) != dict:
+            self.log.log_error('Invalid config file. The value for "{}" in the configuration is not an object.'.format(BACKUP_SETTINGS))
+            elemnt = {}
+        settings.report_directory = elemnt.get(SETTINGS_REPORT_DIRECTORY, settings.report_directory)
+        settings.prometheus_textfile = elemnt.get(SETTINGS_PROMETHEUS_TEXTFILE, settings.prometheus_textfile)
+        settings.slowest_files = elemnt.get(SETTINGS_SLOWEST_FILES, settings.slowest_files)
+        settings.log_directory = elemnt.get(SETTINGS_LOG_DIRECTORY, settings.log_directory)
+        settings.log_level = elemnt.get(SETTINGS_LOG_LEVEL, settings.log_level)
+        settings.checkpoint_interval = elemnt.get(SETTINGS_CHECKPOINT_INTERVAL, settings.checkpoint_interval)
+        settings.journal_directory = elemnt.get(SETTINGS_JOURNAL_DIRECTORY, settings.journal_directory)
+        settings.nice = elemnt.get(SETTINGS_NICE, settings.nice)
+        settings.io_priority = elemnt.get(SETTINGS_IO_PRIORITY, settings.io_priority)
+        settings.concurrent_profiles = elemnt.get(SETTINGS_CONCURRENT_PROFILES, settings.concurrent_profiles)
+        if not settings.is_valid(self.log):
+            settings = Settings()
+
+        # paths do not depend on the working directory
+        config_directory = os.path.dirname(os.path.abspath(self.config_filepath))
+        settings.report_directory = os.path.join(config_directory, settings.report_directory)
+        settings.log_directory = os.path.join(config_directory, settings.log_directory)
+        settings.journal_directory = os.path.join(config_directory, settings.journal_directory)
+        if settings.prometheus_textfile is not None:
+            settings.prometheus_textfile = os.path.join(config_directory, settings.prometheus_textfile)
+        return settings
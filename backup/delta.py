@@ -0,0 +1,516 @@
+import os
+import zlib
+import struct
+import hashlib
+import typing
+import zipfile
+import threading
+
+from .manifest import Manifest, STATE_SIZE, STATE_MTIME
+
+# Delta mode (rsync style) for large files of incremental backups: the block
+# signatures of the version in the last backup are kept next to the manifest
+# (BACKUP_<profile>/signatures/). A changed file is compared with them using a
+# rolling checksum, only the changed data is stored - as the member
+# DELTA_ARCNAME_PREFIX + arcname of the archive. The signatures of the new version
+# are calculated while the file is read; they replace the old ones when the
+# manifest of the backup is saved. A restore rebuilds the file from its version in
+# an older backup of the chain and the deltas after it.
+DELTA_ARCNAME_PREFIX = '.backup_delta/'
+SIGNATURE_DIRECTORY = 'signatures'
+SIGNATURE_STAGING_DIRECTORY = '.signatures.part'
+SIGNATURE_SUFFIX = '.sig'
+
+# the block size grows with the file, so a signature has at most DELTA_MAX_BLOCKS blocks
+DELTA_BLOCK_SIZE = 64 * 1024
+DELTA_MAX_BLOCKS = 256 * 1024
+DELTA_READ_SIZE = 8 * 1024 * 1024
+# changed data is searched byte by byte for at most DELTA_SEARCH_LIMIT bytes after
+# the last match; after that only the block boundaries are compared (a rewritten
+# file is not searched as a whole)
+DELTA_SEARCH_LIMIT = 8 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+_ADLER_MOD = 65521
+_STRONG_DIGEST_SIZE = 16
+_SIGNATURE_MAGIC = b'BKSIGN01'
+_SIGNATURE_HEADER = struct.Struct('<8sIQQQ14sH')      # magic, block size, size, mtime_ns, length, backup time, path length
+_SIGNATURE_BLOCK = struct.Struct('<I16s')             # weak, strong
+_DELTA_MAGIC = b'BKDELTA1'
+_DELTA_HEADER = struct.Struct('<8sIQQ14s')            # magic, block size, size, base length, base backup time
+_OP_COPY = b'C'
+_OP_DATA = b'D'
+_OP_END = b'E'
+_COPY = struct.Struct('<QI')                          # first block, number of blocks
+_DATA = struct.Struct('<I')                           # length
+_END = struct.Struct('<32sQ')                         # blake2b of the file, length
+
+
+def get_delta_arcname(arcname: str) -> str:
+    return DELTA_ARCNAME_PREFIX + arcname
+
+
+def get_block_size(size: int) -> int:
+    block_size = DELTA_BLOCK_SIZE
+    while size > block_size * DELTA_MAX_BLOCKS:
+        block_size *= 2
+    return block_size
+
+
+def _strong(data) -> bytes:
+    return hashlib.blake2b(data, digest_size=_STRONG_DIGEST_SIZE).digest()
+
+
+class Signature:
+    # The block signatures of one version of a file: a weak (adler32, can be rolled
+    # over the data) and a strong checksum (blake2b) per block. size and mtime_ns are
+    # the state of the file in the manifest; length is the number of bytes read.
+
+    def __init__(self, path: str, size: int, mtime_ns: int, backup_time: str, block_size: int):
+        self.path: str = path
+        self.size: int = size
+        self.mtime_ns: int = mtime_ns
+        self.backup_time: str = backup_time
+        self.block_size: int = block_size
+        self.length: int = 0
+        self.weak: list[int] = []
+        self.strong: list[bytes] = []
+
+    def to_bytes(self) -> bytes:
+        path = self.path.encode('utf-8', 'surrogateescape')
+        header = _SIGNATURE_HEADER.pack(_SIGNATURE_MAGIC, self.block_size, self.size, self.mtime_ns, self.length, self.backup_time.encode('ascii'), len(path))
+        return header + path + b''.join(_SIGNATURE_BLOCK.pack(weak, strong) for weak, strong in zip(self.weak, self.strong))
+
+    def matches(self, state: typing.Optional[list]) -> bool:
+        # whether the signature belongs to the file state of a manifest
+        return (state is not None) and (state[STATE_SIZE] == self.size) and (state[STATE_MTIME] == self.mtime_ns)
+
+
+class SignatureBuilder:
+    # Calculates the signature of a file while it is read (see update).
+
+    def __init__(self, signature: Signature):
+        self.signature: Signature = signature
+        self._pending: bytes = b''
+
+    def update(self, data: bytes) -> None:
+        block_size = self.signature.block_size
+        view = memoryview(data)
+        if len(self._pending) > 0:
+            needed = block_size - len(self._pending)
+            self._pending += bytes(view[:needed])
+            view = view[needed:]
+            if len(self._pending) < block_size:
+                return
+            self._add_block(self._pending)
+            self._pending = b''
+        full = len(view) - len(view) % block_size
+        for offset in range(0, full, block_size):
+            self._add_block(view[offset:offset + block_size])
+        self._pending = bytes(view[full:])
+
+    def finish(self) -> Signature:
+        if len(self._pending) > 0:
+            self._add_block(self._pending)
+            self._pending = b''
+        return self.signature
+
+    def _add_block(self, block) -> None:
+        self.signature.weak.append(zlib.adler32(block))
+        self.signature.strong.append(_strong(block))
+        self.signature.length += len(block)
+
+
+def get_signature_file(directory: str, path: str) -> str:
+    return os.path.join(directory, hashlib.sha256(path.encode('utf-8', 'surrogateescape')).hexdigest()[:32] + SIGNATURE_SUFFIX)
+
+
+def load_signature(filepath: str, header_only: bool = False) -> typing.Optional[Signature]:
+    # None: the signature is missing or damaged
+    try:
+        with open(filepath, 'rb') as f:
+            header = f.read(_SIGNATURE_HEADER.size)
+            if len(header) < _SIGNATURE_HEADER.size:
+                return None
+            magic, block_size, size, mtime_ns, length, backup_time, path_length = _SIGNATURE_HEADER.unpack(header)
+            if magic != _SIGNATURE_MAGIC:
+                return None
+            signature = Signature(f.read(path_length).decode('utf-8', 'surrogateescape'), size, mtime_ns, backup_time.decode('ascii'), block_size)
+            signature.length = length
+            if header_only:
+                return signature
+            blocks = f.read()
+    except (OSError, ValueError):
+        return None
+    if len(blocks) != (length + block_size - 1) // block_size * _SIGNATURE_BLOCK.size:
+        return None
+    for weak, strong in _SIGNATURE_BLOCK.iter_unpack(blocks):
+        signature.weak.append(weak)
+        signature.strong.append(strong)
+    return signature
+
+
+def save_signature(signature: Signature, directory: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    filepath = get_signature_file(directory, signature.path)
+    # like the manifest: an interrupted run never leaves a half written signature behind
+    temp_file = filepath + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(signature.to_bytes())
+    os.replace(temp_file, filepath)
+
+
+def commit_signatures(destination_path: str, manifest: Manifest) -> None:
+    # Called before the manifest of a backup is saved: the signatures calculated by
+    # the backup replace the old ones. Signatures that do not belong to a file state
+    # of the manifest (deleted files, files that are too small now, an interrupted
+    # run) are removed.
+    directory = os.path.join(destination_path, SIGNATURE_DIRECTORY)
+    staging = os.path.join(destination_path, SIGNATURE_STAGING_DIRECTORY)
+    if os.path.isdir(staging):
+        for entry in os.scandir(staging):
+            signature = load_signature(entry.path, True)
+            if (signature is not None) and (signature.backup_time == manifest.backup_time) and signature.matches(manifest.files.get(signature.path)):
+                os.makedirs(directory, exist_ok=True)
+                os.replace(entry.path, os.path.join(directory, entry.name))
+            else:
+                os.remove(entry.path)
+        os.rmdir(staging)
+    if os.path.isdir(directory):
+        for entry in os.scandir(directory):
+            signature = load_signature(entry.path, True)
+            if (signature is None) or (not signature.matches(manifest.files.get(signature.path))):
+                os.remove(entry.path)
+
+
+def discard_signatures(destination_path: str) -> None:
+    # the signatures staged by a backup that failed (or will not be resumed)
+    staging = os.path.join(destination_path, SIGNATURE_STAGING_DIRECTORY)
+    if os.path.isdir(staging):
+        for entry in os.scandir(staging):
+            os.remove(entry.path)
+        os.rmdir(staging)
+
+
+class DeltaEncoder:
+    # The delta mode of one backup run of a profile. The archive writer opens the
+    # files through it (see open): a file of at least min_size bytes is stored as a
+    # delta if the signatures of its version in the last backup are known, otherwise
+    # as a whole. Either way its new signatures are staged in all destinations
+    # (see commit_signatures).
+    #
+    # Example usage:
+    #    delta = DeltaEncoder(destination_paths, 64 * MIB, backup_time, previous_manifest)
+    #    create_zip(files, destination_paths, ..., delta=delta)
+    #    file_index.set_delta(delta.arcnames)      # see catalog.FileIndexStage
+    #    commit_signatures(destination_path, manifest)
+
+    def __init__(self, destination_paths: list[str], min_size: int, backup_time: str, previous: typing.Optional[Manifest]):
+        self.min_size: int = min_size
+        self.backup_time: str = backup_time
+        # the destinations agree on the previous manifest (see manifest.load_manifest)
+        self._directory: str = os.path.join(destination_paths[0], SIGNATURE_DIRECTORY)
+        self._staging: list[str] = [os.path.join(destination_path, SIGNATURE_STAGING_DIRECTORY) for destination_path in destination_paths]
+        self._previous: dict[str, list] = previous.files if previous is not None else {}
+        # the arcnames of the files stored as deltas; size of these files and of their deltas
+        self.arcnames: set[str] = set()
+        self.input_size: int = 0
+        self.output_size: int = 0
+        self._lock = threading.Lock()
+
+    def open(self, filepath: str, zinfo: zipfile.ZipInfo, size: int, mtime_ns: int, f: typing.BinaryIO) -> typing.BinaryIO:
+        # The stream to archive instead of f: the file itself or its delta - then the
+        # member is renamed (see get_delta_arcname). size, mtime_ns: the file state of the manifest.
+        if size < self.min_size:
+            return f
+        builder = SignatureBuilder(Signature(filepath, size, mtime_ns, self.backup_time, get_block_size(size)))
+        base = self._load_base(filepath)
+        if base is None:
+            return _StreamReader(f, self._iter_file(f, builder))
+        self.add_delta(zinfo.filename)
+        zinfo.filename = get_delta_arcname(zinfo.filename)
+        return _StreamReader(f, self._iter_delta(f, base, builder))
+
+    def add_delta(self, arcname: str) -> None:
+        # the file is stored as a delta (e.g. a member taken over from an interrupted run)
+        with self._lock:
+            self.arcnames.add(arcname)
+
+    def _load_base(self, filepath: str) -> typing.Optional[Signature]:
+        # the signatures of the version in the last backup (None: unknown)
+        state = self._previous.get(filepath)
+        if state is None:
+            return None
+        signature = load_signature(get_signature_file(self._directory, filepath))
+        if (signature is None) or (signature.path != filepath) or (not signature.matches(state)):
+            return None
+        return signature
+
+    def _iter_file(self, f: typing.BinaryIO, builder: SignatureBuilder) -> typing.Iterator[bytes]:
+        for data in iter(lambda: f.read(DELTA_READ_SIZE), b''):
+            builder.update(data)
+            yield data
+        self._stage(builder.finish())
+
+    def _iter_delta(self, f: typing.BinaryIO, base: Signature, builder: SignatureBuilder) -> typing.Iterator[bytes]:
+        size = 0
+        for data in iter_delta(f, base, builder):
+            size += len(data)
+            yield data
+        signature = builder.finish()
+        with self._lock:
+            self.input_size += signature.length
+            self.output_size += size
+        self._stage(signature)
+
+    def _stage(self, signature: Signature) -> None:
+        # only complete signatures are staged (the file has been read to its end)
+        for staging in self._staging:
+            try:
+                save_signature(signature, staging)
+            except OSError:
+                # the file is stored as a whole next time
+                pass
+
+
+class _StreamReader:
+    # File like object (read only) over a generator of byte strings; like a file,
+    # read returns less than size bytes only at the end.
+
+    def __init__(self, f: typing.BinaryIO, chunks: typing.Iterator[bytes]):
+        self._file: typing.BinaryIO = f
+        self._chunks: typing.Iterator[bytes] = chunks
+        self._chunk: bytes = b''
+        self._offset: int = 0
+
+    def read(self, size: int = -1) -> bytes:
+        parts: list[bytes] = []
+        length = 0
+        while (size < 0) or (length < size):
+            if self._offset >= len(self._chunk):
+                self._chunk, self._offset = next(self._chunks, b''), 0
+                if not self._chunk:
+                    break
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size - length)
+            parts.append(self._chunk[self._offset:end])
+            length += end - self._offset
+            self._offset = end
+        return b''.join(parts)
+
+    def close(self) -> None:
+        self._chunks.close()
+        self._file.close()
+
+    def __enter__(self) -> '_StreamReader':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class DeltaHeader(typing.NamedTuple):
+    block_size: int
+    size: int               # size of the file (state of the manifest)
+    base_length: int
+    base_backup_time: str   # the backup that holds the base version
+
+
+def read_delta_header(f: typing.BinaryIO) -> DeltaHeader:
+    data = _read_exactly(f, _DELTA_HEADER.size)
+    magic, block_size, size, base_length, base_backup_time = _DELTA_HEADER.unpack(data)
+    if magic != _DELTA_MAGIC:
+        raise ValueError('Invalid delta: unknown format')
+    return DeltaHeader(block_size, size, base_length, base_backup_time.decode('ascii'))
+
+
+def _read_exactly(f: typing.BinaryIO, length: int) -> bytes:
+    data = f.read(length)
+    if len(data) != length:
+        raise ValueError('Invalid delta: unexpected end of data')
+    return data
+
+
+def apply_delta(base: typing.BinaryIO, delta: typing.BinaryIO, out: typing.BinaryIO, base_backup_time: str = None) -> None:
+    # Writes the file described by the delta (base: the base version, seekable).
+    # Raises ValueError if the delta does not belong to the base or the result is wrong.
+    header = read_delta_header(delta)
+    if (base_backup_time is not None) and (header.base_backup_time != base_backup_time):
+        raise ValueError('Invalid delta: the base version is from backup {} instead of {}'.format(header.base_backup_time, base_backup_time))
+    digest = hashlib.blake2b(digest_size=32)
+    length = 0
+    while True:
+        op = _read_exactly(delta, 1)
+        if op == _OP_COPY:
+            first, count = _COPY.unpack(_read_exactly(delta, _COPY.size))
+            start = first * header.block_size
+            remaining = min((first + count) * header.block_size, header.base_length) - start
+            base.seek(start)
+            while remaining > 0:
+                data = base.read(min(remaining, COPY_BUFFER_SIZE))
+                if not data:
+                    raise ValueError('Invalid delta: the base version is too short')
+                out.write(data)
+                digest.update(data)
+                length += len(data)
+                remaining -= len(data)
+        elif op == _OP_DATA:
+            remaining, = _DATA.unpack(_read_exactly(delta, _DATA.size))
+            while remaining > 0:
+                data = _read_exactly(delta, min(remaining, COPY_BUFFER_SIZE))
+                out.write(data)
+                digest.update(data)
+                length += len(data)
+                remaining -= len(data)
+        elif op == _OP_END:
+            expected_digest, expected_length = _END.unpack(_read_exactly(delta, _END.size))
+            if (length != expected_length) or (digest.digest() != expected_digest):
+                raise ValueError('Invalid delta: the rebuilt file does not match')
+            return
+        else:
+            raise ValueError('Invalid delta: unknown operation')
+
+
+def _find_block(index: dict[int, list[int]], base: Signature, weak: int, view, preferred: int) -> int:
+    # the base block with the same content (the preferred one, if possible); -1: none
+    candidates = index.get(weak)
+    if candidates is None:
+        return -1
+    strong = _strong(view)
+    if (preferred in candidates) and (base.strong[preferred] == strong):
+        return preferred
+    for candidate in candidates:
+        if base.strong[candidate] == strong:
+            return candidate
+    return -1
+
+
+class _DeltaStream:
+    # The delta of a file against the base version (see iter_delta).
+
+    def __init__(self, base: Signature):
+        self.base: Signature = base
+        self.index: dict[int, list[int]] = {}
+        for i, weak in enumerate(base.weak):
+            self.index.setdefault(weak, []).append(i)
+        self.copy_first: int = -1
+        self.copy_count: int = 0
+
+    def find(self, view) -> int:
+        # the base block with the content of view; -1: none
+        return _find_block(self.index, self.base, zlib.adler32(view), view, self.copy_first + self.copy_count)
+
+    def copy(self, block: int) -> list[bytes]:
+        # consecutive blocks are copied with one operation
+        if (self.copy_count > 0) and (self.copy_first + self.copy_count == block):
+            self.copy_count += 1
+            return []
+        ops = self.flush_copy()
+        self.copy_first, self.copy_count = block, 1
+        return ops
+
+    def flush_copy(self) -> list[bytes]:
+        if self.copy_count == 0:
+            return []
+        op = _OP_COPY + _COPY.pack(self.copy_first, self.copy_count)
+        self.copy_first, self.copy_count = -1, 0
+        return [op]
+
+    def data(self, data: bytes) -> list[bytes]:
+        if len(data) == 0:
+            return []
+        return self.flush_copy() + [_OP_DATA + _DATA.pack(len(data)) + data]
+
+
+def iter_delta(f: typing.BinaryIO, base: Signature, builder: SignatureBuilder) -> typing.Iterator[bytes]:
+    # The delta of the file against the base version. Blocks of the file that are
+    # found in the base (at any offset: the weak checksum is rolled over changed
+    # data) are copied from there, everything else is stored as data. The signature
+    # of the file is built at the same time.
+    block_size = base.block_size
+    stream = _DeltaStream(base)
+    yield _DELTA_HEADER.pack(_DELTA_MAGIC, block_size, builder.signature.size, base.length, base.backup_time.encode('ascii'))
+
+    digest = hashlib.blake2b(digest_size=32)
+    length = 0
+    data = b''
+    pos = 0             # position in data
+    literal = 0         # data[literal:pos] has no match in the base
+    eof = False
+    weak: typing.Optional[tuple[int, int]] = None       # rolling checksum (a, b) of data[pos:pos + block_size]; None: not rolled
+    searched = 0        # bytes searched since the last match
+    last_block = len(base.weak) - 1
+    while True:
+        if (not eof) and (len(data) - pos < 2 * block_size):
+            # the changed data is written and the buffer is refilled
+            yield from stream.data(data[literal:pos])
+            chunk = f.read(DELTA_READ_SIZE)
+            if chunk:
+                builder.update(chunk)
+                digest.update(chunk)
+                length += len(chunk)
+            else:
+                eof = True
+            data = data[pos:] + chunk
+            pos = literal = 0
+            continue
+
+        view = memoryview(data)
+        available = len(data) - pos
+        if available < block_size:
+            # the end of the file: it might be the (shorter) last block of the base
+            if (available > 0) and (available == base.length - last_block * block_size) and (stream.find(view[pos:]) == last_block):
+                yield from stream.data(data[literal:pos])
+                yield from stream.copy(last_block)
+                literal = len(data)
+            pos = len(data)
+            break
+
+        if weak is None:
+            block = stream.find(view[pos:pos + block_size])
+        else:
+            a, b = weak
+            block = _find_block(stream.index, base, (b << 16) | a, view[pos:pos + block_size], stream.copy_first + stream.copy_count)
+        if block >= 0:
+            yield from stream.data(data[literal:pos])
+            yield from stream.copy(block)
+            pos += block_size
+            literal = pos
+            weak = None
+            searched = 0
+            continue
+
+        if searched >= DELTA_SEARCH_LIMIT:
+            pos += block_size
+            weak = None
+            continue
+        if (weak is None) and (available >= 2 * block_size) and (stream.find(view[pos + block_size:pos + 2 * block_size]) >= 0):
+            # changed in place: the next block is still at its position
+            pos += block_size
+            searched += block_size
+            continue
+        end = min(len(data) - block_size, pos + DELTA_SEARCH_LIMIT - searched)
+        if end <= pos:
+            # the last block of the file
+            pos = len(data)
+            weak = None
+            continue
+        # the weak checksum is rolled forward until it matches a block of the base
+        if weak is None:
+            checksum = zlib.adler32(view[pos:pos + block_size])
+            a, b = checksum & 0xffff, checksum >> 16
+        index = stream.index
+        start = pos
+        while pos < end:
+            removed = data[pos]
+            added = data[pos + block_size]
+            a = (a - removed + added) % _ADLER_MOD
+            b = (b - block_size * removed + a - 1) % _ADLER_MOD
+            pos += 1
+            if ((b << 16) | a) in index:
+                break
+        searched += pos - start
+        weak = (a, b)
+
+    yield from stream.data(data[literal:pos])
+    yield from stream.flush_copy()
+    yield _OP_END + _END.pack(digest.digest(), length)
@@ -0,0 +1,423 @@
+import os
+import sys
+import json
+import stat
+import time
+import errno
+import select
+import struct
+import typing
+import threading
+
+from .scanner import ScanEntry, IgnoreMatcher, scan_tree, stat_file, get_scan_entry
+from .manifest import Manifest, STATE_SIZE, STATE_MTIME, STATE_INODE
+
+JOURNAL_DIRECTORY = '.backup/Journal'
+JOURNAL_PREFIX = 'journal_'
+JOURNAL_SUFFIX = '.jsonl'
+JOURNAL_MARK_SUFFIX = '.last_backup'
+JOURNAL_VERSION = 1
+# the watch daemon writes the collected changes every FLUSH_INTERVAL seconds and
+# touches the journal every HEARTBEAT_INTERVAL seconds; a journal that was not
+# touched for HEARTBEAT_TIMEOUT seconds belongs to a daemon that is not running
+FLUSH_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 10.0
+HEARTBEAT_TIMEOUT = 60.0
+DEFAULT_POLL_INTERVAL = 60.0
+
+# inotify (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT_HEADER = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def get_journal_file(journal_directory: str, profile_id: str) -> str:
+    return os.path.join(journal_directory, JOURNAL_PREFIX + profile_id + JOURNAL_SUFFIX)
+
+
+def _load_libc():
+    # inotify is only available on Linux; None: use the PollingWatcher
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def _get_errno() -> int:
+    import ctypes
+    return ctypes.get_errno()
+
+
+class Changes(typing.NamedTuple):
+    paths: set[str]             # changed files and directories (a directory: everything below it)
+    overflow: bool = False      # changes were lost - the journal has to be started again
+
+
+class PollingWatcher:
+    # Fallback if inotify is not available: the roots are scanned every interval
+    # seconds and compared with the previous scan. This costs a scan per interval in
+    # the daemon, but the backup runs still only read the changed files.
+
+    def __init__(self, directories: list[str], files: list[str], matcher: IgnoreMatcher, interval: float = DEFAULT_POLL_INTERVAL):
+        self.directories: list[str] = directories
+        self.files: list[str] = files
+        self.matcher: IgnoreMatcher = matcher
+        self.interval: float = interval
+        self._state: dict[str, tuple[int, int, int]] = {}
+        self._next_poll: float = 0
+
+    def _scan(self) -> dict[str, tuple[int, int, int]]:
+        state: dict[str, tuple[int, int, int]] = {}
+        for directory in self.directories:
+            for entry in scan_tree(directory, self.matcher):
+                state[entry.path] = (entry.size, entry.mtime_ns, entry.inode)
+        for file in self.files:
+            entry = stat_file(file)
+            if entry is not None:
+                state[entry.path] = (entry.size, entry.mtime_ns, entry.inode)
+        return state
+
+    def start(self) -> None:
+        self._state = self._scan()
+        self._next_poll = time.monotonic() + self.interval
+
+    def read(self, timeout: float) -> Changes:
+        # waits up to timeout seconds for the next poll
+        remaining = self._next_poll - time.monotonic()
+        if remaining > 0:
+            time.sleep(min(remaining, timeout))
+            if remaining > timeout:
+                return Changes(set())
+        state = self._scan()
+        changed = {path for path, file_state in state.items() if self._state.get(path) != file_state}
+        changed.update(path for path in self._state if path not in state)
+        self._state = state
+        self._next_poll = time.monotonic() + self.interval
+        return Changes(changed)
+
+    def close(self) -> None:
+        self._state = {}
+
+
+class InotifyWatcher:
+    # Watches the roots with Linux inotify: one watch per directory (new directories
+    # are added while they appear). Events are reported as changed paths; for a new,
+    # moved or deleted directory the directory itself is reported.
+    #
+    # Example usage:
+    #    watcher = InotifyWatcher(['/data'], [], IgnoreMatcher(['**/tmp/']))
+    #    watcher.start()
+    #    changes = watcher.read(1.0)
+
+    def __init__(self, directories: list[str], files: list[str], matcher: IgnoreMatcher):
+        # "/data/" is reported as "/data", the parent directory of its files
+        self.directories: list[str] = [directory.rstrip(os.sep) or directory for directory in directories]
+        self.files: list[str] = files
+        self.matcher: IgnoreMatcher = matcher
+        self._libc = _load_libc()
+        self._fd: int = -1
+        self._paths: dict[int, str] = {}        # watch descriptor -> path
+
+    @staticmethod
+    def is_available() -> bool:
+        return _load_libc() is not None
+
+    def _add_watch(self, path: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            error = _get_errno()
+            if error in (errno.ENOENT, errno.EACCES, errno.ENOTDIR):
+                # gone or unreadable (the scanner skips these as well)
+                return
+            raise OSError(error, 'Cannot watch {}: {}'.format(path, os.strerror(error)))
+        self._paths[wd] = path
+
+    def _add_tree(self, directory: str) -> None:
+        # watches the directory and all directories below it (ignored directories are pruned)
+        pending = [directory]
+        while len(pending) > 0:
+            current = pending.pop()
+            self._add_watch(current)
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False) and not self.matcher.match_dir(entry.path):
+                                pending.append(entry.path)
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+
+    def _remove_tree(self, directory: str) -> None:
+        # watches of a directory that was moved away report wrong paths
+        prefix = os.path.join(directory, '')
+        for wd, path in list(self._paths.items()):
+            if (path == directory) or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._paths[wd]
+
+    def start(self) -> None:
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = _get_errno()
+            raise OSError(error, 'inotify_init1 failed: {}'.format(os.strerror(error)))
+        try:
+            for directory in self.directories:
+                self._add_tree(directory)
+            for file in self.files:
+                self._add_watch(file)
+        except OSError:
+            self.close()
+            raise
+
+    def read(self, timeout: float) -> Changes:
+        changed: set[str] = set()
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if len(readable) == 0:
+            return Changes(changed)
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return Changes(changed)
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + _EVENT_HEADER.size:offset + _EVENT_HEADER.size + length].rstrip(b'\0'))
+            offset += _EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                return Changes(changed, True)
+            if mask & IN_IGNORED:
+                watch_path = self._paths.pop(wd, None)
+                if watch_path in self.directories or watch_path in self.files:
+                    # a root was deleted or replaced: it has to be watched again
+                    return Changes(changed | {watch_path}, True)
+                continue
+            watch_path = self._paths.get(wd)
+            if watch_path is None:
+                continue
+            path = os.path.join(watch_path, name) if name else watch_path
+            if mask & IN_ISDIR:
+                if self.matcher.match_dir(path):
+                    continue
+                if mask & IN_MOVED_FROM:
+                    self._remove_tree(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # files created before the watch exists are found by the scan of the directory
+                    try:
+                        self._add_tree(path)
+                    except OSError:
+                        return Changes(changed, True)
+            elif self.matcher.match_file(path):
+                continue
+            changed.add(path)
+        return Changes(changed)
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+        self._paths.clear()
+
+
+def create_watcher(directories: list[str], files: list[str], matcher: IgnoreMatcher, polling: bool = False, poll_interval: float = DEFAULT_POLL_INTERVAL) -> typing.Union[InotifyWatcher, PollingWatcher]:
+    if (not polling) and InotifyWatcher.is_available():
+        return InotifyWatcher(directories, files, matcher)
+    return PollingWatcher(directories, files, matcher, poll_interval)
+
+
+class ChangeJournal:
+    # Persistent journal of the changes below the sources of one profile, written
+    # by the watch daemon (see watch.WatchManager) and read by the backup runs.
+    #
+    # The journal file is json lines: a header (profile, sources, ignore patterns,
+    # the time since when all changes are recorded) followed by one line per batch
+    # of changed paths. Batches older than the last backup are dropped by compact().
+    # When changes were lost (inotify queue overflow) the journal is started again,
+    # so the next backup has to scan. The journal is deleted when the daemon stops.
+
+    def __init__(self, journal_file: str, profile_id: str, source: list[str], ignore: list[str]):
+        self.journal_file: str = journal_file
+        self.profile_id: str = profile_id
+        self.source: list[str] = source
+        self.ignore: list[str] = ignore
+        self._lock = threading.Lock()
+        self._pending: set[str] = set()
+        self._header: dict = {}
+
+    def start(self, watching_since: float) -> None:
+        # (re-)starts the journal: all changes after watching_since are recorded
+        with self._lock:
+            self._header = {'version': JOURNAL_VERSION, 'profile': self.profile_id, 'source': self.source, 'ignore': self.ignore,
+                            'watching_since': watching_since, 'pid': os.getpid()}
+            self._pending.clear()
+            self._rewrite([])
+
+    def add(self, paths: typing.Iterable[str]) -> None:
+        with self._lock:
+            self._pending.update(paths)
+
+    def flush(self) -> None:
+        # appends the collected paths as one batch (one write)
+        with self._lock:
+            if len(self._pending) == 0:
+                return
+            line = json.dumps({'time': time.time(), 'paths': sorted(self._pending)}) + '\n'
+            with open(self.journal_file, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self._pending.clear()
+
+    def touch(self) -> None:
+        # heartbeat: shows the backup runs that the daemon is still watching
+        os.utime(self.journal_file)
+
+    def compact(self, cutoff: float) -> int:
+        # Drops the batches written before cutoff (the start of the last backup of
+        # all destinations - these changes are in the manifest). Returns the number of
+        # remaining batches.
+        with self._lock:
+            batches = [batch for batch in _read_lines(self.journal_file)[1:] if batch.get('time', 0) >= cutoff]
+            self._rewrite(batches)
+            return len(batches)
+
+    def close(self) -> None:
+        # without a running daemon the journal is incomplete - it must not be used
+        with self._lock:
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+
+    def _rewrite(self, batches: list[dict]) -> None:
+        directory = os.path.dirname(self.journal_file)
+        if (directory != '') and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_file = self.journal_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(data) + '\n' for data in [self._header] + batches))
+        os.replace(temp_file, self.journal_file)
+
+
+def _read_lines(journal_file: str) -> list[dict]:
+    # a line that is only partly written ends the journal
+    lines: list[dict] = []
+    with open(journal_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                lines.append(json.loads(line))
+            except ValueError:
+                break
+    return lines
+
+
+def load_journal(journal_file: str, profile_id: str, source: list[str], ignore: list[str], since: float) -> typing.Optional[set[str]]:
+    # Returns the paths changed since `since` (the start of the last backup), or None
+    # if the journal can't be used: no daemon is watching (no journal or no recent
+    # heartbeat), the daemon started watching after `since`, or the profile's sources
+    # or ignore patterns changed.
+    try:
+        if time.time() - os.path.getmtime(journal_file) > HEARTBEAT_TIMEOUT:
+            return None
+        lines = _read_lines(journal_file)
+    except OSError:
+        return None
+    if len(lines) == 0:
+        return None
+    header = lines[0]
+    if (header.get('version') != JOURNAL_VERSION) or (header.get('profile') != profile_id) or (header.get('source') != source) or (header.get('ignore') != ignore):
+        return None
+    if header.get('watching_since', float('inf')) > since:
+        return None
+    changed: set[str] = set()
+    for batch in lines[1:]:
+        changed.update(batch.get('paths', []))
+    return changed
+
+
+def _is_below(path: str, directories: set[str]) -> bool:
+    parent = os.path.dirname(path)
+    while True:
+        if parent in directories:
+            return True
+        next_parent = os.path.dirname(parent)
+        if next_parent == parent:
+            return False
+        parent = next_parent
+
+
+def iter_journal_files(previous: Manifest, changed_paths: set[str], matcher: IgnoreMatcher) -> typing.Iterator[ScanEntry]:
+    # The files of the sources without a scan: the changed paths of the journal are
+    # read from the file system (a changed directory is scanned), all other files
+    # are taken from the manifest of the last backup (see manifest.ChangeDetector -
+    # they are unchanged). Files that no longer exist are not yielded, so they show
+    # up as deleted.
+    seen: set[str] = set()
+    scanned_dirs: set[str] = set()
+    for path in sorted(changed_paths):
+        if _is_below(path, scanned_dirs):
+            continue
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if matcher.match_dir(path):
+                continue
+            scanned_dirs.add(path)
+            for entry in scan_tree(path, matcher):
+                if entry.path not in seen:
+                    seen.add(entry.path)
+                    yield entry
+        elif not matcher.match_file(path):
+            if stat.S_ISLNK(st.st_mode):
+                entry = stat_file(path)
+                if entry is None:
+                    continue
+            elif stat.S_ISREG(st.st_mode):
+                entry = get_scan_entry(path, st)
+            else:
+                continue
+            seen.add(path)
+            yield entry
+
+    for filepath, state in previous.files.items():
+        if (filepath in changed_paths) or (filepath in seen) or _is_below(filepath, changed_paths):
+            continue
+        yield ScanEntry(filepath, state[STATE_SIZE], state[STATE_MTIME], state[STATE_INODE], 0, stat.S_IFREG)
+
+
+def mark_backup(journal_file: str, backup_start: float) -> None:
+    # Records the start of the last backup that used (or could have used) the journal:
+    # the daemon drops the batches before it (see ChangeJournal.compact).
+    mark_file = journal_file + JOURNAL_MARK_SUFFIX
+    with open(mark_file + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'backup_start': backup_start}, f)
+    os.replace(mark_file + '.tmp', mark_file)
+
+
+def get_backup_mark(journal_file: str) -> typing.Optional[float]:
+    try:
+        with open(journal_file + JOURNAL_MARK_SUFFIX, 'r', encoding='utf-8') as f:
+            return json.load(f)['backup_start']
+    except (OSError, ValueError, KeyError):
+        return None
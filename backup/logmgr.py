@@ -1,33 +1,174 @@
 import os
+import csv
+import json
+import queue
+import atexit
+import typing
 import datetime
-from .utils import writeCsv
+import threading
 
 ERRORLOG_DIRECTORY = '.backup/ErrorLog'
 ERRORLOG_PREFIX = 'ERROR_occured_backup'
+EVENTLOG_PREFIX = 'events_backup'
+
+LOG_LEVEL_DEBUG = 'debug'
+LOG_LEVEL_INFO = 'info'
+LOG_LEVEL_WARNING = 'warning'
+LOG_LEVEL_ERROR = 'error'
+LOG_LEVELS = {LOG_LEVEL_DEBUG: 10, LOG_LEVEL_INFO: 20, LOG_LEVEL_WARNING: 30, LOG_LEVEL_ERROR: 40}
+DEFAULT_LOG_LEVEL = LOG_LEVEL_INFO
+
+# the writer thread collects messages for up to FLUSH_INTERVAL seconds (or
+# LOG_BATCH_SIZE messages) and writes them with one write per file
+FLUSH_INTERVAL = 1.0
+LOG_BATCH_SIZE = 1000
+
+_STOP = object()
 
 
 class LogManager():
+    # Messages are printed immediately; writing them to the log files is done by a
+    # background thread in batches, so a profile with thousands of unreadable files
+    # does not open/append/close the error log for every single message.
+    #
+    # Two files are written into the log directory:
+    #    ERROR_occured_backup{backup_time}.log : errors only (csv, as before)
+    #    events_backup{backup_time}.jsonl       : all events >= log_level, one json object per line
+    #
+    # The log directory is fixed when the LogManager is created (it does not depend
+    # on later changes of the working directory) and can be changed once the config
+    # is loaded. Messages are kept in the queue until then. Pending messages are
+    # written on close(), which is also registered with atexit.
 
-    def __init__(self, backup_time: str):
+    def __init__(self, backup_time: str, log_directory: str = ERRORLOG_DIRECTORY, log_level: str = DEFAULT_LOG_LEVEL):
         self.backup_time: str = backup_time
+        self.log_directory: str = os.path.abspath(log_directory)
+        self.log_level: str = log_level
+        self.error_count: int = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._ready = threading.Event()     # set when the log directory is final
+        self._closed: bool = False
+        self._files: dict[str, typing.TextIO] = {}
+        self._writer = threading.Thread(target=self._write_loop, name='LogManager', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
 
-    def log_error(self, msg: str):
+    def configure(self, log_directory: str = None, log_level: str = None) -> None:
+        # called once the settings of the config file are known
+        if log_directory is not None:
+            self.log_directory = os.path.abspath(log_directory)
+        if log_level is not None:
+            self.log_level = log_level
+        self._ready.set()
+
+    def log_error(self, msg: str, **fields):
         print('    ERROR:: {}'.format(msg))
-        timestamp: str = datetime.datetime.now().strftime('%H%M%S')
-        data = []
-        data.append([self.backup_time, timestamp, msg])
-        writeCsv(self.get_errorlog_file(), data)    
+        self.error_count += 1
+        self.log_event(LOG_LEVEL_ERROR, msg, **fields)
+
+
+    def log_warning(self, msg: str, **fields):
+        print('    WARNING:: {}'.format(msg))
+        self.log_event(LOG_LEVEL_WARNING, msg, **fields)
 
 
-    def log_debug(self, msg: str):
+    def log_debug(self, msg: str, **fields):
+        # always printed (as before there were log levels); log_level only applies to the event log
         print('DEBUG:: {}'.format(msg))
-        
+        self.log_event(LOG_LEVEL_DEBUG, msg, **fields)
+
+
+    def log_hint(self, msg: str, **fields):
+        print('{}'.format(msg))
+        if msg.strip() != '':
+            self.log_event(LOG_LEVEL_INFO, msg.strip(), **fields)
+
+
+    def log_event(self, level: str, msg: str, **fields) -> None:
+        # structured event (without console output); fields are added to the json object
+        if self._closed:
+            return
+        if (level != LOG_LEVEL_ERROR) and (LOG_LEVELS[level] < LOG_LEVELS[self.log_level]):
+            return
+        event = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'), 'level': level, 'backup_time': self.backup_time, 'msg': msg}
+        event.update(fields)
+        self._queue.put(event)
+
 
-    def log_hint(self, msg: str):
-        print('{}'.format(msg))    
+    def flush(self) -> None:
+        # blocks until all queued messages are written
+        self._ready.set()
+        self._queue.join()
+
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._ready.set()
+        self._queue.put(_STOP)
+        self._writer.join()
+        atexit.unregister(self.close)
 
 
     def get_errorlog_file(self) -> str:
         filename = ERRORLOG_PREFIX + self.backup_time + '.log'
-        error_file = os.path.join(ERRORLOG_DIRECTORY, filename)
-        return error_file  
+        error_file = os.path.join(self.log_directory, filename)
+        return error_file
+
+
+    def get_eventlog_file(self) -> str:
+        return os.path.join(self.log_directory, EVENTLOG_PREFIX + self.backup_time + '.jsonl')
+
+
+    def _write_loop(self) -> None:
+        self._ready.wait()
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            try:
+                batch.append(self._queue.get(timeout=FLUSH_INTERVAL))
+                while len(batch) < LOG_BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            events = [event for event in batch if event is not _STOP]
+            stop = len(events) < len(batch)
+            try:
+                self._write_batch(events)
+            except Exception as e:
+                print('    ERROR:: Cannot write the log files in {}: {}'.format(self.log_directory, e))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        for f in self._files.values():
+            f.close()
+
+
+    def _write_batch(self, events: list[dict]) -> None:
+        if len(events) == 0:
+            return
+        errors = [[self.backup_time, event['time'][11:19].replace(':', ''), event['msg']] for event in events if event['level'] == LOG_LEVEL_ERROR]
+        if len(errors) > 0:
+            writer = csv.writer(self._get_file(self.get_errorlog_file()), delimiter=";", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            writer.writerows(errors)
+        f = self._get_file(self.get_eventlog_file())
+        f.write(''.join(json.dumps(event, default=str) + '\n' for event in events))
+        for f in self._files.values():
+            f.flush()
+
+
+    def _get_file(self, filepath: str) -> typing.TextIO:
+        # the files are opened once and kept open for the whole run
+        f = self._files.get(filepath)
+        if f is None:
+            if not os.path.isdir(self.log_directory):
+                os.makedirs(self.log_directory)
+            try:
+                f = open(filepath, "a", newline="", encoding="utf-8", errors="backslashreplace")
+            except OSError:
+                # e.g. no write permission for an existing log file
+                root, extension = os.path.splitext(filepath)
+                f = open(root + "-1" + extension, "a", newline="", encoding="utf-8", errors="backslashreplace")
+            self._files[filepath] = f
+        return f
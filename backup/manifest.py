@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import typing
+from datetime import datetime
+
+from .scanner import ScanEntry
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_HASH_BLOCKSIZE = 1024 * 1024
+
+BACKUP_MODE_FULL = 'full'
+BACKUP_MODE_INCREMENTAL = 'incremental'
+
+# index positions of the per-file state stored in the manifest
+STATE_SIZE = 0
+STATE_MTIME = 1
+STATE_INODE = 2
+STATE_HASH = 3
+
+
+class Manifest:
+    # The manifest describes the state of a profile's file system at the time of
+    # the last backup. It is stored next to the archives in every destination
+    # (BACKUP_<profile>/manifest.json) and is used to find new, changed and
+    # deleted files for incremental backups.
+
+    def __init__(self):
+        self.backup_time: str = ''
+        self.full_backup_time: str = ''
+        self.files: dict[str, list] = {}
+
+    def to_dict(self) -> dict:
+        return {
+            'backup_time': self.backup_time,
+            'full_backup_time': self.full_backup_time,
+            'files': self.files
+        }
+
+    @staticmethod
+    def from_dict(data: dict) -> 'Manifest':
+        manifest = Manifest()
+        manifest.backup_time = data.get('backup_time', '')
+        manifest.full_backup_time = data.get('full_backup_time', '')
+        manifest.files = data.get('files', {})
+        return manifest
+
+
+def get_manifest_file(destination_path: str) -> str:
+    return os.path.join(destination_path, MANIFEST_FILENAME)
+
+
+def load_manifest(destination_paths: list[str]) -> typing.Optional[Manifest]:
+    # Returns the manifest of the last backup, if (and only if) all destinations
+    # agree on it. Otherwise at least one destination misses archives of the
+    # last run and a full backup is needed to get a consistent state again.
+    manifest: typing.Optional[Manifest] = None
+    for destination_path in destination_paths:
+        filepath = get_manifest_file(destination_path)
+        if not os.path.isfile(filepath):
+            return None
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                current = Manifest.from_dict(json.load(f))
+        except (OSError, ValueError):
+            return None
+        if manifest is None:
+            manifest = current
+        elif manifest.backup_time != current.backup_time:
+            return None
+    return manifest
+
+
+def save_manifest(manifest: Manifest, destination_path: str) -> None:
+    if not os.path.exists(destination_path):
+        os.makedirs(destination_path)
+    # write to a temporary file first, so an interrupted run never leaves a
+    # half written manifest behind
+    filepath = get_manifest_file(destination_path)
+    temp_filepath = filepath + '.tmp'
+    with open(temp_filepath, 'w', encoding='utf-8') as f:
+        json.dump(manifest.to_dict(), f)
+    os.replace(temp_filepath, filepath)
+
+
+def needs_full_backup(manifest: typing.Optional[Manifest], days_between_full: int, now: datetime, timestamp_format: str) -> bool:
+    if (manifest is None) or (manifest.full_backup_time == ''):
+        return True
+    if days_between_full < 0:
+        return False
+    try:
+        last_full = datetime.strptime(manifest.full_backup_time, timestamp_format)
+    except ValueError:
+        return True
+    return (now - last_full).days >= days_between_full
+
+
+def hash_file(filepath: str) -> str:
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(MANIFEST_HASH_BLOCKSIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def get_file_state(entry: ScanEntry) -> list:
+    # the stat data of the scan is reused - no additional stat call is needed
+    return [entry.size, entry.mtime_ns, entry.inode, None]
+
+
+def _is_unchanged(state: list, previous: list, filepath: str, use_hash: bool) -> bool:
+    if (state[STATE_SIZE] == previous[STATE_SIZE]) and (state[STATE_MTIME] == previous[STATE_MTIME]) and (state[STATE_INODE] == previous[STATE_INODE]):
+        state[STATE_HASH] = previous[STATE_HASH]
+        return True
+    if use_hash and (state[STATE_SIZE] == previous[STATE_SIZE]) and (previous[STATE_HASH] is not None):
+        # metadata changed (e.g. the file was touched or copied) - the content decides
+        try:
+            state[STATE_HASH] = hash_file(filepath)
+        except OSError:
+            return False
+        return state[STATE_HASH] == previous[STATE_HASH]
+    return False
+
+
+class ChangeDetector:
+    # Compares the current file system with the manifest of the last backup while
+    # the files are streamed into the archive.
+    #
+    # Example usage:
+    #    detector = ChangeDetector(previous_manifest, use_hash=False)
+    #    create_zip(detector.iter_changed(files), ...)
+    #    deleted = detector.get_deleted()      # after all files have been consumed
+    #    manifest.files = detector.states
+
+    def __init__(self, previous: typing.Optional[Manifest], use_hash: bool):
+        self.previous_files: dict[str, list] = previous.files if previous is not None else {}
+        self.use_hash: bool = use_hash
+        # the file states for the new manifest
+        self.states: dict[str, list] = {}
+        self.changed_count: int = 0
+
+    def iter_changed(self, files: typing.Iterable[ScanEntry]) -> typing.Iterator[ScanEntry]:
+        # yields the files that are new or have been modified since the last backup
+        for entry in files:
+            filepath = entry.path
+            # hashes of changed files are calculated lazily below
+            state = get_file_state(entry)
+            previous_state = self.previous_files.get(filepath)
+            if (previous_state is not None) and _is_unchanged(state, previous_state, filepath, self.use_hash):
+                self.states[filepath] = state
+                continue
+            if self.use_hash and (state[STATE_HASH] is None):
+                try:
+                    state[STATE_HASH] = hash_file(filepath)
+                except OSError:
+                    continue
+            self.states[filepath] = state
+            self.changed_count += 1
+            yield entry
+
+    def discard(self, filepath: str, error: OSError = None) -> None:
+        # a changed file that could not be archived (see utils.create_archive): like a
+        # file that can't be hashed, it is left out of the new manifest
+        self.states.pop(filepath, None)
+
+    def get_deleted(self) -> list[str]:
+        # files of the last backup that no longer exist
+        return [filepath for filepath in self.previous_files if filepath not in self.states]
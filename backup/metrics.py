@@ -0,0 +1,245 @@
+import os
+import io
+import json
+import time
+import heapq
+import typing
+import threading
+import contextlib
+from datetime import datetime
+
+from .scanner import ScanEntry
+
+DEFAULT_REPORT_DIRECTORY = '.backup/Reports'
+REPORT_PREFIX = 'report'
+PROFILE_PREFIX = 'profile'
+DEFAULT_SLOWEST_FILES = 10
+PROMETHEUS_PREFIX = 'filesystembackup'
+
+# counters (per backup profile)
+FILES_SCANNED = 'files_scanned'
+BYTES_SCANNED = 'bytes_scanned'
+FILES_BACKED_UP = 'files_backed_up'
+BYTES_READ = 'bytes_read'               # size of the files that were backed up
+BYTES_WRITTEN = 'bytes_written'         # sum over all destinations
+ARCHIVE_INPUT = 'archive_input'         # size of the files that were archived
+ARCHIVE_SIZE = 'archive_size'
+
+RUN_PROFILE = ''                        # stages/counters that do not belong to one profile
+
+
+class RunMetrics:
+    # Timers and counters of one backup run. Stages are timed per profile, the
+    # counters are collected while the files stream through the pipeline (so
+    # there are no extra passes over the files). Thread safe - the scan runs in
+    # a background thread.
+    #
+    # Example usage:
+    #    metrics = RunMetrics('250101120000')
+    #    with metrics.stage('archive', 'filesystem_backup_1'):
+    #        ...
+    #    metrics.write_report('/reports/')
+
+    def __init__(self, backup_time: str, slowest_files: int = DEFAULT_SLOWEST_FILES):
+        self.backup_time: str = backup_time
+        self.started: datetime = datetime.now()
+        self.finished: typing.Optional[datetime] = None
+        self.stages: dict[str, dict[str, float]] = {}          # profile -> stage -> seconds
+        self.counters: dict[str, dict[str, int]] = {}          # profile -> counter -> value
+        self.destinations: list[dict] = []
+        self.slowest_files: int = slowest_files
+        self._slowest: list[tuple[float, str, int]] = []       # min-heap (seconds, path, size)
+        self._lock = threading.Lock()
+
+    def add_time(self, name: str, seconds: float, profile: str = RUN_PROFILE) -> None:
+        with self._lock:
+            stages = self.stages.setdefault(profile, {})
+            stages[name] = stages.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def stage(self, name: str, profile: str = RUN_PROFILE) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, profile)
+
+    def count(self, name: str, value: int = 1, profile: str = RUN_PROFILE) -> None:
+        with self._lock:
+            counters = self.counters.setdefault(profile, {})
+            counters[name] = counters.get(name, 0) + value
+
+    def get_counter(self, name: str, profile: str = RUN_PROFILE) -> int:
+        with self._lock:
+            return self.counters.get(profile, {}).get(name, 0)
+
+    def add_destination(self, profile: str, directory: str, size: int, seconds: float) -> None:
+        with self._lock:
+            self.destinations.append({
+                'profile': profile,
+                'directory': directory,
+                'bytes': size,
+                'seconds': round(seconds, 4),
+                'mb_per_sec': round(size / (1024 * 1024) / seconds, 2) if seconds > 0 else None
+            })
+
+    def time_scan(self, files: typing.Iterable[ScanEntry], profile: str) -> typing.Iterator[ScanEntry]:
+        # Passes the scanned files through; counts them and times the whole scan.
+        start = time.perf_counter()
+        count = 0
+        size = 0
+        try:
+            for entry in files:
+                count += 1
+                size += entry.size
+                yield entry
+        finally:
+            self.add_time('scan', time.perf_counter() - start, profile)
+            self.count(FILES_SCANNED, count, profile)
+            self.count(BYTES_SCANNED, size, profile)
+
+    def time_files(self, files: typing.Iterable[ScanEntry], profile: str) -> typing.Iterator[ScanEntry]:
+        # Passes the files that are backed up through. The time between handing out
+        # a file and the request for the next one is the time the consumer (archive,
+        # chunk store) spent on this file; the slowest files are kept.
+        count = 0
+        size = 0
+        try:
+            for entry in files:
+                start = time.perf_counter()
+                yield entry
+                self._add_file_time(time.perf_counter() - start, entry)
+                count += 1
+                size += entry.size
+        finally:
+            self.count(FILES_BACKED_UP, count, profile)
+            self.count(BYTES_READ, size, profile)
+
+    def _add_file_time(self, seconds: float, entry: ScanEntry) -> None:
+        if self.slowest_files <= 0:
+            return
+        item = (seconds, entry.path, entry.size)
+        with self._lock:
+            if len(self._slowest) < self.slowest_files:
+                heapq.heappush(self._slowest, item)
+            elif seconds > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+
+    def get_slowest_files(self) -> list[dict]:
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+        return [{'path': path, 'bytes': size, 'seconds': round(seconds, 4)} for seconds, path, size in slowest]
+
+    def to_dict(self) -> dict:
+        profiles: dict[str, dict] = {}
+        for profile in sorted(set(self.stages) | set(self.counters)):
+            counters = dict(self.counters.get(profile, {}))
+            if counters.get(ARCHIVE_SIZE):
+                counters['compression_ratio'] = round(counters.get(ARCHIVE_INPUT, 0) / counters[ARCHIVE_SIZE], 3)
+            profiles[profile] = {
+                'stages': {name: round(seconds, 4) for name, seconds in self.stages.get(profile, {}).items()},
+                'counters': counters
+            }
+        finished = self.finished if self.finished is not None else datetime.now()
+        return {
+            'backup_time': self.backup_time,
+            'started': self.started.isoformat(timespec='seconds'),
+            'finished': finished.isoformat(timespec='seconds'),
+            'wall_time': round((finished - self.started).total_seconds(), 3),
+            'run': profiles.pop(RUN_PROFILE, {'stages': {}, 'counters': {}}),
+            'profiles': profiles,
+            'destinations': self.destinations,
+            'slowest_files': self.get_slowest_files()
+        }
+
+    def write_report(self, report_directory: str) -> str:
+        # JSON run report: {report_directory}/report{backup_time}.json
+        if not os.path.isdir(report_directory):
+            os.makedirs(report_directory)
+        report_file = os.path.join(report_directory, REPORT_PREFIX + self.backup_time + '.json')
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return report_file
+
+    def write_prometheus(self, textfile: str) -> None:
+        # Prometheus textfile collector format. The file is replaced atomically, so
+        # the node exporter never reads a half written file.
+        report = self.to_dict()
+        lines: list[str] = []
+
+        def add_metric(name: str, help: str, samples: list[tuple[dict, float]]) -> None:
+            if len(samples) == 0:
+                return
+            lines.append('# HELP {}_{} {}'.format(PROMETHEUS_PREFIX, name, help))
+            lines.append('# TYPE {}_{} gauge'.format(PROMETHEUS_PREFIX, name))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, _escape_label(value)) for key, value in labels.items())
+                lines.append('{}_{}{} {}'.format(PROMETHEUS_PREFIX, name, '{' + label_text + '}' if label_text else '', value))
+
+        add_metric('last_run_timestamp_seconds', 'Start time of the last backup run.', [({}, round(self.started.timestamp()))])
+        add_metric('run_duration_seconds', 'Wall time of the last backup run.', [({}, report['wall_time'])])
+        stages = [({'profile': '', 'stage': name}, seconds) for name, seconds in report['run']['stages'].items()]
+        for profile, data in report['profiles'].items():
+            stages += [({'profile': profile, 'stage': name}, seconds) for name, seconds in data['stages'].items()]
+        add_metric('stage_duration_seconds', 'Time spent in each stage of the last run.', stages)
+        for counter, help in [(FILES_SCANNED, 'Files found by the scan.'),
+                              (BYTES_SCANNED, 'Size of the files found by the scan.'),
+                              (FILES_BACKED_UP, 'Files written to the backup.'),
+                              (BYTES_READ, 'Size of the files written to the backup.'),
+                              (BYTES_WRITTEN, 'Bytes written to all destinations.'),
+                              ('compression_ratio', 'Size of the files divided by the size of the archive.')]:
+            add_metric(counter, help, [({'profile': profile}, data['counters'][counter]) for profile, data in report['profiles'].items() if counter in data['counters']])
+        add_metric('destination_throughput_bytes_per_second', 'Write throughput per destination.',
+                   [({'profile': d['profile'], 'destination': d['directory']}, round(d['bytes'] / d['seconds']) if d['seconds'] > 0 else 0) for d in report['destinations']])
+
+        directory = os.path.dirname(os.path.abspath(textfile))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_file = textfile + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_file, textfile)
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RunProfiler:
+    # --profile-run: cProfile (main thread) and tracemalloc for the whole run.
+    # Writes {report_directory}/profile{backup_time}.pstats (for snakeviz, pstats, ...)
+    # and a text summary with the hottest functions and the largest allocations.
+
+    def __init__(self):
+        import cProfile
+        self._profiler = cProfile.Profile()
+
+    def start(self) -> None:
+        import tracemalloc
+        tracemalloc.start()
+        self._profiler.enable()
+
+    def stop(self, report_directory: str, backup_time: str) -> list[str]:
+        import pstats
+        import tracemalloc
+        self._profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        if not os.path.isdir(report_directory):
+            os.makedirs(report_directory)
+        stats_file = os.path.join(report_directory, PROFILE_PREFIX + backup_time + '.pstats')
+        self._profiler.dump_stats(stats_file)
+
+        text = io.StringIO()
+        text.write('Hot functions (cumulative time, main thread)\n\n')
+        pstats.Stats(self._profiler, stream=text).sort_stats('cumulative').print_stats(40)
+        text.write('\nMemory: peak {:.1f} MB, at the end {:.1f} MB\n\n'.format(peak / (1024 * 1024), current / (1024 * 1024)))
+        text.write('Largest allocations (still allocated at the end of the run)\n\n')
+        for statistic in snapshot.statistics('lineno')[:25]:
+            text.write('{}\n'.format(statistic))
+        text_file = os.path.join(report_directory, PROFILE_PREFIX + backup_time + '.txt')
+        with open(text_file, 'w', encoding='utf-8') as f:
+            f.write(text.getvalue())
+        return [stats_file, text_file]
@@ -0,0 +1,187 @@
+import os
+import time
+import queue
+import typing
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+from .scanner import ScanEntry, IgnoreMatcher, SourceMatcher, get_scan_entry, get_path_key, stat_file, DEFAULT_SCAN_WORKERS, SCAN_ALL
+from .throttle import Throttle, throttle_io
+from .utils import PIPELINE_QUEUE_SIZE
+
+_END_OF_FILES = object()
+
+
+class _PlannedProfile:
+    # the sources of one profile in the scan plan
+
+    def __init__(self, profile_id: str, source: list[str], ignore: list[str], throttle: Throttle = None):
+        self.id: str = profile_id
+        self.matcher = IgnoreMatcher(ignore)
+        self.sources = SourceMatcher(source)
+        self.throttle: typing.Optional[Throttle] = throttle if (throttle is not None) and throttle.is_active() else None
+        # the files of the profile are handed out through this queue (see ScanPlan.take)
+        self.queue: queue.Queue = queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.closed = threading.Event()
+        self.taken: bool = False
+
+
+class ScanPlan:
+    # One scan pass for the sources of several profiles. The source directories of
+    # all profiles are merged: every directory is listed once, even if it belongs to
+    # several profiles (e.g. one profile for "/data/**/*.pas" and one for "/data/").
+    # Glob patterns are matched during the scan (see scanner.SourceMatcher).
+    # Each file is routed to all profiles whose sources contain it and whose ignore
+    # patterns do not match it - the result per profile is the same as iter_files.
+    #
+    # The scan runs in a background thread; the profiles consume their files at the
+    # same time (see take). A profile that does not need its files (e.g. it reads the
+    # change journal) has to release them, otherwise the scan waits for it.
+    #
+    # Example usage:
+    #    plan = ScanPlan()
+    #    plan.add_profile('documents', ['/data/'], ['**/tmp/'])
+    #    plan.add_profile('pascal', ['/data/**/src/'], ['*.o'])
+    #    plan.start()
+    #    files = plan.take('documents')     # on the thread of each profile
+
+    def __init__(self, workers: int = DEFAULT_SCAN_WORKERS):
+        self.workers: int = workers
+        self._profiles: dict[str, _PlannedProfile] = {}
+        self._roots: dict[str, str] = {}        # see get_path_key -> path
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def add_profile(self, profile_id: str, source: list[str], ignore: list[str], throttle: Throttle = None) -> None:
+        # source: absolute paths, as in the configs (see configs.resolve_source)
+        self._profiles[profile_id] = _PlannedProfile(profile_id, source or [], ignore, throttle)
+
+    def start(self) -> None:
+        for profile in self._profiles.values():
+            self._roots.update(profile.sources.roots)
+        self._thread = threading.Thread(target=self._produce, name='scan-plan', daemon=True)
+        self._thread.start()
+
+    def take(self, profile_id: str) -> typing.Optional[typing.Iterator[ScanEntry]]:
+        # The files of the profile - only once; None: the profile is not part of the
+        # plan or its files were taken already (the caller has to scan on its own).
+        profile = self._profiles.get(profile_id)
+        if (profile is None) or profile.taken or profile.closed.is_set():
+            return None
+        profile.taken = True
+        return self._iter_profile(profile)
+
+    def release(self, profile_id: str) -> None:
+        # the profile does not take (any more) files - the scan skips it
+        profile = self._profiles.get(profile_id)
+        if profile is not None:
+            profile.closed.set()
+
+    def close(self) -> None:
+        for profile in self._profiles.values():
+            profile.closed.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _iter_profile(self, profile: _PlannedProfile) -> typing.Iterator[ScanEntry]:
+        try:
+            while True:
+                item = profile.queue.get()
+                if item is _END_OF_FILES:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            profile.closed.set()
+
+    def _put(self, profile: _PlannedProfile, item) -> None:
+        # waits while the profile's queue is full, unless the profile stopped taking files
+        while not profile.closed.is_set():
+            try:
+                profile.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _produce(self) -> None:
+        profiles = list(self._profiles.values())
+        try:
+            for entry, entry_profiles in self._scan():
+                for profile in entry_profiles:
+                    self._put(profile, entry)
+                if all(profile.closed.is_set() for profile in profiles):
+                    return
+            # single files (like iter_files: excluded from the directory scans)
+            for profile in profiles:
+                for file in profile.sources.files.values():
+                    if profile.closed.is_set():
+                        break
+                    if profile.matcher.match_file(file):
+                        continue
+                    entry = stat_file(file)
+                    if entry is not None:
+                        self._put(profile, entry)
+            for profile in profiles:
+                self._put(profile, _END_OF_FILES)
+        except BaseException as e:
+            for profile in profiles:
+                self._put(profile, e)
+
+    def _scan(self) -> typing.Iterator[tuple[ScanEntry, list[_PlannedProfile]]]:
+        # All roots are scanned on one thread pool; a root nested in another root is
+        # scanned on its own (it is skipped by the scan of the outer root), together
+        # with the profiles whose scan of an outer root would have reached it.
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            pending: set[Future] = set()
+            for key, root in self._roots.items():
+                root_profiles = [(profile, profile.sources.get_root_state(key, root, profile.matcher)) for profile in self._profiles.values()]
+                root_profiles = [(profile, state) for profile, state in root_profiles if len(state) > 0]
+                if len(root_profiles) > 0:
+                    pending.add(executor.submit(self._scan_dir, root, root_profiles))
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirs = future.result()
+                    for subdir, subdir_profiles in subdirs:
+                        if all(profile.closed.is_set() for profile, _ in subdir_profiles):
+                            continue
+                        pending.add(executor.submit(self._scan_dir, subdir, subdir_profiles))
+                    yield from files
+
+    def _scan_dir(self, directory: str, profiles: list[tuple[_PlannedProfile, frozenset]]) -> tuple[list[tuple[ScanEntry, list[_PlannedProfile]]], list[tuple[str, list[tuple[_PlannedProfile, frozenset]]]]]:
+        # same as scanner._scan_source_dir, for several profiles (with their scan state):
+        # the files and subdirectories with the profiles they belong to
+        files: list[tuple[ScanEntry, list[_PlannedProfile]]] = []
+        subdirs: list[tuple[str, list[tuple[_PlannedProfile, frozenset]]]] = []
+        start = time.perf_counter()
+        try:
+            with os.scandir(directory or os.curdir) as entries:
+                for entry in entries:
+                    try:
+                        path = entry.path if directory else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            if get_path_key(path) in self._roots:
+                                continue
+                            subdir_profiles = [(profile, profile.sources.descend(state, entry.name)) for profile, state in profiles if not profile.matcher.match_dir(path)]
+                            subdir_profiles = [(profile, state) for profile, state in subdir_profiles if len(state) > 0]
+                            if len(subdir_profiles) > 0:
+                                subdirs.append((path, subdir_profiles))
+                        elif entry.is_file():
+                            file_profiles = [profile for profile, state in profiles if profile.sources.match_file(state, entry.name)
+                                             and not (profile.matcher.match_file(path) or (profile.sources.files and (get_path_key(path) in profile.sources.files)))]
+                            if len(file_profiles) > 0:
+                                files.append((get_scan_entry(path, entry.stat()), file_profiles))
+                        elif entry.is_symlink() and entry.is_dir():
+                            # see scanner._scan_source_dir: symbolic links matching a glob pattern
+                            subdir_profiles = [(profile, SCAN_ALL) for profile, state in profiles if (state is not SCAN_ALL) and (not profile.matcher.match_dir(path))
+                                               and (profile.sources.descend(state, entry.name) is SCAN_ALL)]
+                            if len(subdir_profiles) > 0:
+                                subdirs.append((path, subdir_profiles))
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        throttles = [profile.throttle for profile, _ in profiles if profile.throttle is not None]
+        if len(throttles) > 0:
+            throttle_io(throttles, 0, 0, time.perf_counter() - start)
+        return files, subdirs
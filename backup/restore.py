@@ -0,0 +1,428 @@
+import os
+import json
+import shutil
+import typing
+import zipfile
+import tarfile
+import datetime
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .configs import ConfigObject, Destination, get_config_filepath
+from .logmgr import LogManager
+from .catalog import Catalog, BackupRecord, FileRecord, BACKUP_KIND_SNAPSHOT
+from .manifest import BACKUP_MODE_FULL, BACKUP_MODE_INCREMENTAL
+from .chunkstore import load_snapshot, read_chunk
+from .compression import FORMAT_ZIP, get_archive_format, open_decompressed_stream
+from .archive import get_default_workers
+from .backends import DestinationBackend
+from .delta import DELTA_ARCNAME_PREFIX, get_delta_arcname, read_delta_header, apply_delta
+from .utils import get_arcname, get_temp_filepath, DELETED_FILES_ARCNAME, BACKUP_INFO_ARCNAME, BACKUP_FILENAME_TIMESTAMP_LENGTH
+
+COPY_BUFFER_SIZE = 1024 * 1024
+LATEST = '9' * BACKUP_FILENAME_TIMESTAMP_LENGTH
+
+
+class RestoreItem(typing.NamedTuple):
+    file: FileRecord
+    backup: BackupRecord
+    # delta mode: the version of the file the delta applies to
+    base: typing.Optional['RestoreItem'] = None
+
+
+def parse_point_in_time(text: str) -> str:
+    # "20250131", "2025-01-31 12:00", "20250131120000" -> backup time (14 digits);
+    # a date without time means the end of that day
+    digits = ''.join(c for c in text if c.isdigit())
+    if (len(digits) < 8) or (len(digits) > BACKUP_FILENAME_TIMESTAMP_LENGTH):
+        raise ValueError('Invalid point in time: {}'.format(text))
+    return digits + '235959'[len(digits) - 8:]
+
+
+def get_backup_chain(backups: list[BackupRecord]) -> list[BackupRecord]:
+    # the latest full backup and all incremental backups after it (oldest first);
+    # the volumes of a set (see volumes) are records with the same backup time
+    for i in range(len(backups) - 1, -1, -1):
+        if backups[i].mode != BACKUP_MODE_INCREMENTAL:
+            while (i > 0) and (backups[i - 1].backup_time == backups[i].backup_time):
+                i -= 1
+            return backups[i:]
+    if len(backups) > 0:
+        # the files of the missing full backup would silently be left out
+        raise ValueError('The full backup of the incremental backups since {} is missing'.format(backups[0].backup_time))
+    return backups
+
+
+def _is_glob(pattern: str) -> bool:
+    return any(c in pattern for c in '*?[')
+
+
+def get_arcname_pattern(path: str) -> str:
+    # Glob patterns are matched against the member names as stored (without leading
+    # separator, e.g. "*/projects/*.py"); paths are resolved like the sources of the
+    # backup (see configs.resolve_source).
+    if _is_glob(path):
+        return path.replace(os.sep, '/').lstrip('/')
+    return get_arcname(os.path.abspath(path))
+
+
+def get_relative_arcname_pattern(path: str) -> typing.Optional[str]:
+    # Backups of relative sources made before they were resolved (see
+    # configs.resolve_source) have relative member names: a relative path selects
+    # these as well.
+    if _is_glob(path) or os.path.isabs(path):
+        return None
+    return get_arcname(path)
+
+
+class RestoreManager():
+    # Restores files of a profile as they were at a point in time.
+    #
+    # The backups are looked up in the catalog of a destination: the latest full
+    # backup up to the point in time plus the incremental backups after it. The
+    # files are found in the file index of the catalog, so only the members that
+    # are actually restored are read. Zip archives and chunk store snapshots are
+    # read with random access on several workers; tar archives have to be read
+    # as a stream (one worker per archive). Destinations with a backend (see
+    # backends) are read with ranged requests; their catalog is rebuilt from the
+    # storage if the local directory is lost.
+
+    def __init__(self, args: typing.Union[argparse.Namespace, dict]):
+        self.args = args
+        self.backup_time: str = datetime.datetime.now().strftime("%y%m%d%H%M%S")
+        self.log = LogManager(self.backup_time)
+
+        self.config_filepath: str = get_config_filepath(self.args.config)
+        if not os.path.isfile(self.config_filepath):
+            raise Exception('Config file not found. Please ensure that the file is present:\n{}'.format(self.config_filepath))
+        self.configs = ConfigObject(self.config_filepath, self.log)
+        self.log.configure(self.configs.settings.log_directory, self.configs.settings.log_level)
+
+        self._local = threading.local()
+        self._open_archives: list[tuple[zipfile.ZipFile, typing.BinaryIO]] = []
+        self._lock = threading.Lock()
+        self._backend: typing.Optional[DestinationBackend] = None
+        # destinations whose backups of the profile are incomplete (see get_backup_chain)
+        self._broken_destinations: list[str] = []
+        # members with relative names (see get_relative_arcname_pattern): restored
+        # relative to the current directory
+        self._relative_arcnames: set[str] = set()
+
+
+    def _get_destinations(self) -> list[Destination]:
+        if (self.args.destinations is not None) and (len(self.args.destinations) > 0):
+            destinations = []
+            for destination_id in self.args.destinations:
+                destination = self.configs.destinations.get(destination_id.strip())
+                if destination is None:
+                    self.log.log_error('Destination "{}" does not exist in config file {}'.format(destination_id, self.config_filepath))
+                else:
+                    destinations.append(destination)
+            return destinations
+        return [destination for destination in self.configs.destinations.values() if destination.active == True]
+
+
+    def _index_backup(self, catalog: Catalog, record: BackupRecord) -> BackupRecord:
+        # Backups of a rebuilt catalog have no file index: it is read from the
+        # backup (zip: central directory only; tar: the whole stream). Returns the
+        # record including the mode of the backup.
+        backup_file = catalog.get_file(record)
+        self.log.log_hint('Indexing backup {}...'.format(backup_file))
+        files: list[FileRecord] = []
+        mode = record.mode
+        if record.kind == BACKUP_KIND_SNAPSHOT:
+            for filepath, file_info in load_snapshot(backup_file).get('files', {}).items():
+                files.append(FileRecord(get_arcname(filepath), file_info['size'], file_info['mtime_ns']))
+            mode = BACKUP_MODE_FULL
+        else:
+            deleted: list[str] = []
+            info: dict = {}
+            format = get_archive_format(backup_file)
+            if format == FORMAT_ZIP:
+                with self._open_backup(backup_file) as f, zipfile.ZipFile(f) as zip:
+                    for zinfo in zip.infolist():
+                        if zinfo.filename == DELETED_FILES_ARCNAME:
+                            deleted = json.loads(zip.read(zinfo))
+                        elif zinfo.filename == BACKUP_INFO_ARCNAME:
+                            info = json.loads(zip.read(zinfo))
+                        elif zinfo.filename.startswith(DELTA_ARCNAME_PREFIX):
+                            # delta mode: the size of the file is part of the delta
+                            mtime_ns = int(datetime.datetime(*zinfo.date_time).timestamp() * 1e9)
+                            with zip.open(zinfo) as delta:
+                                size = read_delta_header(delta).size
+                            files.append(FileRecord(zinfo.filename[len(DELTA_ARCNAME_PREFIX):], size, mtime_ns, delta=True))
+                        elif not zinfo.is_dir():
+                            mtime_ns = int(datetime.datetime(*zinfo.date_time).timestamp() * 1e9)
+                            files.append(FileRecord(zinfo.filename, zinfo.file_size, mtime_ns))
+            else:
+                with self._open_backup(backup_file) as f, open_decompressed_stream(f, format) as stream, tarfile.open(fileobj=stream, mode='r|') as tar:
+                    for tarinfo in tar:
+                        if tarinfo.name == DELETED_FILES_ARCNAME:
+                            deleted = json.loads(tar.extractfile(tarinfo).read())
+                        elif tarinfo.name == BACKUP_INFO_ARCNAME:
+                            info = json.loads(tar.extractfile(tarinfo).read())
+                        elif tarinfo.isfile():
+                            files.append(FileRecord(tarinfo.name, tarinfo.size, int(tarinfo.mtime * 1e9)))
+            files += [FileRecord(get_arcname(filepath), None, None, True) for filepath in deleted]
+            mode = info.get('mode', mode)
+
+        catalog.add_files(record.filename, files)
+        if mode != record.mode:
+            catalog.set_mode(record.filename, mode)
+        return record._replace(mode=mode)
+
+
+    def _find_backups(self, catalog: Catalog, profile_id: str, point_in_time: str) -> list[BackupRecord]:
+        # the backups needed for the point in time; backups without file index are indexed
+        backups = catalog.get_backups_until(profile_id, point_in_time)
+        full_backup_time = None
+        for i in range(len(backups) - 1, -1, -1):
+            # all volumes of the full backup are needed
+            if (full_backup_time is not None) and (backups[i].backup_time != full_backup_time):
+                break
+            if not catalog.is_indexed(backups[i].filename):
+                backups[i] = self._index_backup(catalog, backups[i])
+            if backups[i].mode != BACKUP_MODE_INCREMENTAL:
+                full_backup_time = backups[i].backup_time
+        return get_backup_chain(backups)
+
+
+    def _find_files(self, catalog: Catalog, backups: list[BackupRecord], patterns: list[str]) -> list[RestoreItem]:
+        # newer backups overrule older ones; deleted files are removed again
+        items: dict[str, RestoreItem] = {}
+        for backup in backups:
+            for file in catalog.find_files(backup.filename, patterns):
+                if file.deleted:
+                    items.pop(file.arcname, None)
+                elif file.delta:
+                    items[file.arcname] = RestoreItem(file, backup, items.get(file.arcname))
+                else:
+                    items[file.arcname] = RestoreItem(file, backup)
+        return [items[arcname] for arcname in sorted(items)]
+
+
+    def _get_target(self, arcname: str) -> str:
+        parts = arcname.split('/')
+        if '..' in parts:
+            raise ValueError('Invalid file name in backup: {}'.format(arcname))
+        if self.args.target:
+            return os.path.join(os.path.abspath(self.args.target), *parts)
+        if arcname in self._relative_arcnames:
+            return os.path.abspath(os.path.join(*parts))
+        return os.path.join(os.sep, *parts)
+
+
+    def _open_backup(self, backup_file: str) -> typing.BinaryIO:
+        if self._backend is not None:
+            return self._backend.open_file(backup_file)
+        return open(backup_file, 'rb')
+
+
+    def _get_zip(self, backup_file: str) -> zipfile.ZipFile:
+        # one ZipFile per worker thread and archive
+        archives = getattr(self._local, 'archives', None)
+        if archives is None:
+            archives = self._local.archives = {}
+        zip = archives.get(backup_file)
+        if zip is None:
+            f = self._open_backup(backup_file)
+            zip = archives[backup_file] = zipfile.ZipFile(f)
+            with self._lock:
+                self._open_archives.append((zip, f))
+        return zip
+
+
+    def _write_file(self, target: str, source: typing.Union[typing.BinaryIO, typing.Iterable[bytes]], mtime_ns: typing.Optional[int]) -> None:
+        # the file gets its final name only when it is complete
+        directory = os.path.dirname(target)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        temp_file = get_temp_filepath(target)
+        try:
+            with open(temp_file, 'wb') as f:
+                if hasattr(source, 'read'):
+                    shutil.copyfileobj(source, f, COPY_BUFFER_SIZE)
+                else:
+                    for data in source:
+                        f.write(data)
+            if mtime_ns is not None:
+                os.utime(temp_file, ns=(mtime_ns, mtime_ns))
+            os.replace(temp_file, target)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+
+    def _restore_member(self, backup_file: str, item: RestoreItem, target: str) -> None:
+        with self._get_zip(backup_file).open(item.file.arcname) as source:
+            self._write_file(target, source, item.file.mtime_ns)
+
+
+    def _restore_delta(self, catalog: Catalog, item: RestoreItem, target: str) -> None:
+        # Delta mode: the file is rebuilt from the last version stored as a whole and
+        # the deltas of the following backups, in temporary files next to the target.
+        chain: list[RestoreItem] = []
+        while item.file.delta:
+            if item.base is None:
+                raise ValueError('The base version of the delta is not part of the backups')
+            chain.append(item)
+            item = item.base
+        directory = os.path.dirname(target)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        base_file = get_temp_filepath(target + '.base')
+        next_file = get_temp_filepath(target + '.next')
+        try:
+            backup_file = catalog.get_file(item.backup)
+            if get_archive_format(backup_file) != FORMAT_ZIP:
+                raise ValueError('The base version of the delta is not part of a zip archive')
+            with self._get_zip(backup_file).open(item.file.arcname) as source, open(base_file, 'wb') as f:
+                shutil.copyfileobj(source, f, COPY_BUFFER_SIZE)
+            for delta_item in reversed(chain):
+                delta_backup_file = catalog.get_file(delta_item.backup)
+                with self._get_zip(delta_backup_file).open(get_delta_arcname(delta_item.file.arcname)) as delta, open(base_file, 'rb') as base, open(next_file, 'wb') as out:
+                    apply_delta(base, delta, out, delta_item.base.backup.backup_time)
+                os.replace(next_file, base_file)
+            # the rebuilt file gets its final name only when it is complete
+            if chain[0].file.mtime_ns is not None:
+                os.utime(base_file, ns=(chain[0].file.mtime_ns, chain[0].file.mtime_ns))
+            os.replace(base_file, target)
+        finally:
+            for temp_file in (base_file, next_file):
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+
+    def _restore_from_snapshot(self, destination_directory: str, chunks: list[str], item: RestoreItem, target: str) -> None:
+        self._write_file(target, (read_chunk(destination_directory, chunk_hash) for chunk_hash in chunks), item.file.mtime_ns)
+
+
+    def _restore_from_tar(self, backup_file: str, items: dict[str, tuple[RestoreItem, str]]) -> list[tuple[str, Exception]]:
+        # tar archives can only be read as a stream - all files of one archive in one pass
+        errors: list[tuple[str, Exception]] = []
+        with self._open_backup(backup_file) as f, open_decompressed_stream(f, get_archive_format(backup_file)) as stream, tarfile.open(fileobj=stream, mode='r|') as tar:
+            for tarinfo in tar:
+                if tarinfo.name not in items:
+                    continue
+                item, target = items.pop(tarinfo.name)
+                try:
+                    self._write_file(target, tar.extractfile(tarinfo), item.file.mtime_ns)
+                except Exception as e:
+                    errors.append((target, e))
+        for item, target in items.values():
+            errors.append((target, Exception('File not found in {}'.format(backup_file))))
+        return errors
+
+
+    def _restore(self, catalog: Catalog, items: list[RestoreItem], workers: int) -> tuple[int, int]:
+        # Returns the number of restored files and of files that could not be restored.
+        errors: list[tuple[str, Exception]] = []
+        skipped = 0
+        snapshots: dict[str, dict] = {}
+        tar_items: dict[str, dict[str, tuple[RestoreItem, str]]] = {}
+        futures = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for item in items:
+                target = self._get_target(item.file.arcname)
+                if os.path.exists(target) and not self.args.overwrite:
+                    skipped += 1
+                    continue
+                backup_file = catalog.get_file(item.backup)
+                if item.file.delta:
+                    futures.append((target, executor.submit(self._restore_delta, catalog, item, target)))
+                elif item.backup.kind == BACKUP_KIND_SNAPSHOT:
+                    if backup_file not in snapshots:
+                        snapshots[backup_file] = {get_arcname(filepath): file_info for filepath, file_info in load_snapshot(backup_file).get('files', {}).items()}
+                    chunks = snapshots[backup_file][item.file.arcname]['chunks']
+                    futures.append((target, executor.submit(self._restore_from_snapshot, catalog.destination_directory, chunks, item, target)))
+                elif get_archive_format(backup_file) == FORMAT_ZIP:
+                    futures.append((target, executor.submit(self._restore_member, backup_file, item, target)))
+                else:
+                    tar_items.setdefault(backup_file, {})[item.file.arcname] = (item, target)
+            tar_futures = [executor.submit(self._restore_from_tar, backup_file, members) for backup_file, members in tar_items.items()]
+
+            for target, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append((target, e))
+            for future in tar_futures:
+                try:
+                    errors += future.result()
+                except Exception as e:
+                    errors.append((self.args.target or os.sep, e))
+
+        for zip, f in self._open_archives:
+            zip.close()
+            f.close()
+        self._open_archives.clear()
+
+        for target, error in errors:
+            self.log.log_error('Cannot restore {}: {}'.format(target, error), path=target)
+        if skipped > 0:
+            self.log.log_hint('{} files already exist and were skipped (use --overwrite to replace them).'.format(skipped))
+        return len(items) - skipped - len(errors), len(errors)
+
+
+    def run(self) -> int:
+        profile_id = self.args.profile.strip()
+        try:
+            point_in_time = parse_point_in_time(self.args.time) if self.args.time else LATEST
+        except ValueError as e:
+            self.log.log_error(str(e))
+            return 1
+        patterns = [get_arcname_pattern(path) for path in self.args.paths]
+        relative_patterns = [pattern for pattern in (get_relative_arcname_pattern(path) for path in self.args.paths) if pattern is not None]
+
+        # the first destination that has backups of the profile is used
+        for destination in self._get_destinations():
+            backend = destination.backend.get_backend(destination.directory)
+            if (backend is None) and (not os.path.isdir(destination.directory)):
+                continue
+            try:
+                result = self._restore_destination(destination, backend, profile_id, point_in_time, patterns, relative_patterns)
+            finally:
+                if backend is not None:
+                    backend.close()
+            if result is not None:
+                return result
+
+        if len(self._broken_destinations) > 0:
+            self.log.log_error('No complete backups of profile "{}" found up to {} - nothing was restored.'.format(profile_id, point_in_time if point_in_time != LATEST else 'now'))
+            return 1
+        self.log.log_error('No backups of profile "{}" found up to {}'.format(profile_id, point_in_time if point_in_time != LATEST else 'now'))
+        return 1
+
+
+    def _restore_destination(self, destination: Destination, backend: typing.Optional[DestinationBackend], profile_id: str, point_in_time: str, patterns: list[str], relative_patterns: list[str] = []) -> typing.Optional[int]:
+        # None: the destination has no backups of the profile
+        self._backend = backend
+        with Catalog(destination.directory, backend) as catalog:
+            try:
+                backups = self._find_backups(catalog, profile_id, point_in_time)
+            except ValueError as e:
+                self.log.log_error('[{}]:: Cannot restore from destination "{}": {}'.format(profile_id, destination.id, e), profile=profile_id, destination=destination.id)
+                self._broken_destinations.append(destination.id)
+                return None
+            if len(backups) == 0:
+                return None
+            self.log.log_hint('[{}]:: Restoring from destination "{}" (backup {}, {} incremental backups)'.format(
+                profile_id, destination.id, backups[0].backup_time, len(backups) - 1))
+            items = self._find_files(catalog, backups, patterns)
+            if len(relative_patterns) > 0:
+                relative_items = self._find_files(catalog, backups, relative_patterns)
+                self._relative_arcnames = {item.file.arcname for item in relative_items}
+                items = sorted(set(items) | set(relative_items), key=lambda item: item.file.arcname)
+            if self.args.list:
+                for item in items:
+                    self.log.log_hint('{}  {:>12}  {}'.format(item.backup.backup_time, item.file.size, item.file.arcname))
+                self.log.log_hint('[{}]:: {} files'.format(profile_id, len(items)))
+                return 0
+
+            workers = self.args.workers if (self.args.workers is not None) and (self.args.workers > 0) else get_default_workers()
+            self.log.log_hint('[{}]:: Restoring {} files...'.format(profile_id, len(items)))
+            restored, failed = self._restore(catalog, items, workers)
+            self.log.log_hint('[{}]:: Restore completed: {} files restored, {} failed.'.format(profile_id, restored, failed))
+            self.log.flush()
+            return 0 if failed == 0 else 1
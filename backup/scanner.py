@@ -0,0 +1,327 @@
+import os
+import re
+import stat
+import time
+import fnmatch
+import typing
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+from .throttle import Throttle, throttle_io
+
+DEFAULT_SCAN_WORKERS = 8
+
+_GLOB_MAGIC = re.compile('[*?[]')
+
+
+class ScanEntry(typing.NamedTuple):
+    # a file found by the scanner, including the stat data of the directory scan
+    path: str
+    size: int
+    mtime_ns: int
+    inode: int
+    device: int
+    mode: int
+
+
+# a file to archive: its path or its ScanEntry (the stat data of the scan is reused)
+SourceFile = typing.Union[str, ScanEntry]
+
+
+def get_source_path(file: SourceFile) -> str:
+    return file.path if isinstance(file, ScanEntry) else file
+
+
+class IgnoreMatcher:
+    # All ignore patterns compiled into one regular expression (same semantics as
+    # fnmatch.fnmatch on the full path).
+    #
+    # Directories are matched with a trailing separator, so a pattern like
+    # "**/not-this-dir/" prunes the whole directory before it is walked.
+
+    def __init__(self, ignore_patterns: list[str]):
+        patterns = [fnmatch.translate(os.path.normcase(pattern)) for pattern in (ignore_patterns or [])]
+        self._regex: typing.Optional[re.Pattern] = re.compile('|'.join(patterns)) if len(patterns) > 0 else None
+
+    def match_file(self, path: str) -> bool:
+        if self._regex is None:
+            return False
+        return self._regex.match(os.path.normcase(path)) is not None
+
+    def match_dir(self, path: str) -> bool:
+        if self._regex is None:
+            return False
+        return self._regex.match(os.path.normcase(os.path.join(path, ''))) is not None
+
+
+def get_path_key(path: str) -> str:
+    # normalized absolute path, used to compare paths of different source patterns
+    return os.path.normcase(os.path.abspath(path))
+
+
+def get_scan_entry(path: str, st: os.stat_result) -> ScanEntry:
+    return ScanEntry(path, st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev, st.st_mode)
+
+
+class _GlobPattern(typing.NamedTuple):
+    key: str                                    # see get_path_key
+    parts: list[typing.Optional[re.Pattern]]    # the parts below the root, None: "**"
+    hidden: list[bool]                          # whether the part matches names starting with "."
+    dir_only: bool                              # the pattern ends with a separator
+
+
+# scan state: everything below the directory belongs to the sources
+SCAN_ALL: frozenset = frozenset({(-1, -1)})
+
+
+class SourceMatcher:
+    # The source patterns of a profile, prepared for one walk of the file system
+    # (instead of expanding every pattern with glob.glob on its own):
+    #  - directories ("/data/") are scanned completely,
+    #  - files ("/data/file.txt") are read with stat and excluded from the scans,
+    #  - glob patterns ("/data/**/src/*.pas"): the leading part without wildcards is
+    #    the root of the scan ("/data"), the rest is matched against the paths below.
+    # Glob patterns match like glob.glob(recursive=True): "**" matches any number of
+    # directories, wildcards do not match names starting with "." and a trailing
+    # separator only matches directories. Everything below a matching directory
+    # belongs to the source.
+    #
+    # The scan keeps a state per directory: the parts of the glob patterns that the
+    # names below it are matched against (see get_root_state, descend, match_file).
+    # Directories with an empty state are not walked.
+
+    def __init__(self, file_patterns: list[str]):
+        self.directories: dict[str, str] = {}   # see get_path_key -> path
+        self.files: dict[str, str] = {}
+        self.roots: dict[str, str] = {}         # directories and roots of the glob patterns
+        self._globs: list[_GlobPattern] = []
+        self._root_states: dict[str, frozenset] = {}
+        for file_pattern in file_patterns or []:
+            self._add(file_pattern)
+
+    def _add(self, file_pattern: str) -> None:
+        drive, path = os.path.splitdrive(file_pattern)
+        if os.altsep:
+            path = path.replace(os.altsep, os.sep)
+        names = path.split(os.sep)
+        first = next((i for i, name in enumerate(names) if _GLOB_MAGIC.search(name)), None)
+        if first is None:
+            key = get_path_key(file_pattern)
+            if os.path.isdir(file_pattern):
+                self.directories.setdefault(key, file_pattern)
+                self.roots.setdefault(key, file_pattern)
+            else:
+                self.files.setdefault(key, file_pattern)
+            return
+
+        root = drive + (os.sep.join(names[:first]) or (os.sep if first > 0 else ''))
+        parts = [name for name in names[first:] if name != '']
+        key = get_path_key(root)
+        self.roots.setdefault(key, root)
+        self._globs.append(_GlobPattern(key, [None if part == '**' else re.compile(fnmatch.translate(os.path.normcase(part))) for part in parts],
+                                        [part.startswith('.') for part in parts], names[-1] == ''))
+
+    def _closure(self, glob: _GlobPattern, index: int) -> typing.Iterator[int]:
+        # "**" matches zero directories as well
+        yield index
+        while (index < len(glob.parts)) and (glob.parts[index] is None):
+            index += 1
+            yield index
+
+    def _match_part(self, glob: _GlobPattern, index: int, name: str) -> bool:
+        if name.startswith('.') and not glob.hidden[index]:
+            return False
+        part = glob.parts[index]
+        return (part is None) or (part.match(name) is not None)
+
+    def _get_dir_state(self, state: set) -> frozenset:
+        # a directory matching a glob pattern: everything below belongs to the source
+        if any(index == len(self._globs[i].parts) for i, index in state):
+            return SCAN_ALL
+        return frozenset(state)
+
+    def descend(self, state: frozenset, name: str) -> frozenset:
+        # the state of the subdirectory name of a directory with the given state
+        if state is SCAN_ALL:
+            return state
+        name = os.path.normcase(name)
+        next_state: set[tuple[int, int]] = set()
+        for i, index in state:
+            glob = self._globs[i]
+            if (index < len(glob.parts)) and self._match_part(glob, index, name):
+                next_state.update((i, next_index) for next_index in self._closure(glob, index if glob.parts[index] is None else index + 1))
+        return self._get_dir_state(next_state)
+
+    def match_file(self, state: frozenset, name: str) -> bool:
+        # whether the file name in a directory with the given state belongs to the sources
+        if state is SCAN_ALL:
+            return True
+        name = os.path.normcase(name)
+        for i, index in state:
+            glob = self._globs[i]
+            if (not glob.dir_only) and (index == len(glob.parts) - 1) and self._match_part(glob, index, name):
+                return True
+        return False
+
+    def get_root_state(self, key: str, root: str, matcher: IgnoreMatcher) -> frozenset:
+        # The state of a scan root (see get_path_key): the sources starting at the root
+        # and those of the nearest root above it, whose scan would have walked into it
+        # (the scan does not follow symbolic links and prunes ignored directories).
+        # The root does not have to be one of the roots of these sources (see planner.ScanPlan).
+        state = self._root_states.get(key)
+        if state is not None:
+            return state
+        if key in self.directories:
+            state = SCAN_ALL
+        else:
+            start: set[tuple[int, int]] = set()
+            for i, glob in enumerate(self._globs):
+                if glob.key == key:
+                    start.update((i, index) for index in self._closure(glob, 0))
+            state = self._get_dir_state(start)
+            outer = max((other for other in self.roots if key.startswith(os.path.join(other, ''))), key=len, default=None)
+            if (outer is not None) and (state is not SCAN_ALL):
+                outer_state = self.get_root_state(outer, self.roots[outer], matcher)
+                path = self.roots[outer]
+                for name in os.path.relpath(key, outer).split(os.sep):
+                    path = os.path.join(path, name)
+                    if os.path.islink(path) or matcher.match_dir(path):
+                        outer_state = frozenset()
+                    if len(outer_state) == 0:
+                        break
+                    outer_state = self.descend(outer_state, name)
+                state = SCAN_ALL if outer_state is SCAN_ALL else state | outer_state
+        self._root_states[key] = state
+        return state
+
+
+def _scan_dir(directory: str, matcher: IgnoreMatcher, exclude_dirs: set[str], exclude_files: set[str], throttle: Throttle = None) -> tuple[list[ScanEntry], list[str]]:
+    # Scans one directory. Returns its files and the subdirectories that have to be
+    # scanned as well. Like os.walk, unreadable directories are skipped silently
+    # and symbolic links to directories are not followed.
+    # throttle: the directory listing counts as one I/O operation
+    files: list[ScanEntry] = []
+    subdirs: list[str] = []
+    start = time.perf_counter()
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if matcher.match_dir(entry.path):
+                            continue
+                        if exclude_dirs and (get_path_key(entry.path) in exclude_dirs):
+                            continue
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        if matcher.match_file(entry.path):
+                            continue
+                        if exclude_files and (get_path_key(entry.path) in exclude_files):
+                            continue
+                        files.append(get_scan_entry(entry.path, entry.stat()))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    if throttle is not None:
+        throttle_io([throttle], 0, 0, time.perf_counter() - start)
+    return files, subdirs
+
+
+def scan_tree(root: str, matcher: IgnoreMatcher, workers: int = DEFAULT_SCAN_WORKERS, exclude_dirs: set[str] = None, exclude_files: set[str] = None, throttle: Throttle = None) -> typing.Iterator[ScanEntry]:
+    # Yields all files below root that are not ignored. Directories are scanned
+    # concurrently on a thread pool; the order of the files is not defined.
+    # Subdirectories are only submitted while the consumer takes files, so a slow
+    # consumer keeps the number of buffered directory listings small.
+    #
+    # exclude_dirs / exclude_files (see get_path_key) are skipped, because they
+    # are handled by another scan. throttle: limits the directory listings (see throttle.Throttle).
+    if (throttle is not None) and (not throttle.is_active()):
+        throttle = None
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending: set[Future] = {executor.submit(_scan_dir, root, matcher, exclude_dirs, exclude_files, throttle)}
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                for subdir in subdirs:
+                    pending.add(executor.submit(_scan_dir, subdir, matcher, exclude_dirs, exclude_files, throttle))
+                yield from files
+
+
+def _scan_source_dir(directory: str, state: frozenset, sources: SourceMatcher, matcher: IgnoreMatcher, throttle: Throttle = None) -> tuple[list[ScanEntry], list[tuple[str, frozenset]]]:
+    # same as _scan_dir, for the sources of a profile: the files and the subdirectories
+    # (with their state) that belong to the sources. Other scan roots are skipped.
+    files: list[ScanEntry] = []
+    subdirs: list[tuple[str, frozenset]] = []
+    start = time.perf_counter()
+    try:
+        # the root of a relative glob pattern (e.g. "**/src/") is the current directory
+        with os.scandir(directory or os.curdir) as entries:
+            for entry in entries:
+                try:
+                    path = entry.path if directory else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if matcher.match_dir(path):
+                            continue
+                        if (len(sources.roots) > 1) and (get_path_key(path) in sources.roots):
+                            continue
+                        subdir_state = sources.descend(state, entry.name)
+                        if len(subdir_state) > 0:
+                            subdirs.append((path, subdir_state))
+                    elif entry.is_file():
+                        if matcher.match_file(path) or (not sources.match_file(state, entry.name)):
+                            continue
+                        if sources.files and (get_path_key(path) in sources.files):
+                            continue
+                        files.append(get_scan_entry(path, entry.stat()))
+                    elif (state is not SCAN_ALL) and entry.is_symlink() and entry.is_dir():
+                        # like a source directory, a symbolic link matching a glob pattern is scanned
+                        # (but links are not followed to match the patterns below them)
+                        if (not matcher.match_dir(path)) and (sources.descend(state, entry.name) is SCAN_ALL):
+                            subdirs.append((path, SCAN_ALL))
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    if throttle is not None:
+        throttle_io([throttle], 0, 0, time.perf_counter() - start)
+    return files, subdirs
+
+
+def scan_sources(sources: SourceMatcher, matcher: IgnoreMatcher, workers: int = DEFAULT_SCAN_WORKERS, throttle: Throttle = None) -> typing.Iterator[ScanEntry]:
+    # Yields all files of the sources that are not ignored (see SourceMatcher), every
+    # file once: all roots are scanned on one thread pool, each directory is listed
+    # once - a root below another root is skipped by the scan of the outer root and
+    # scanned with the state of both. The single files of the sources come last.
+    if (throttle is not None) and (not throttle.is_active()):
+        throttle = None
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending: set[Future] = set()
+        for key, root in sources.roots.items():
+            state = sources.get_root_state(key, root, matcher)
+            if len(state) > 0:
+                pending.add(executor.submit(_scan_source_dir, root, state, sources, matcher, throttle))
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                for subdir, subdir_state in subdirs:
+                    pending.add(executor.submit(_scan_source_dir, subdir, subdir_state, sources, matcher, throttle))
+                yield from files
+
+    for file in sources.files.values():
+        if matcher.match_file(file):
+            continue
+        entry = stat_file(file)
+        if entry is not None:
+            yield entry
+
+
+def stat_file(path: str) -> typing.Optional[ScanEntry]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return get_scan_entry(path, st)
@@ -0,0 +1,241 @@
+import os
+import sys
+import time
+import typing
+import platform
+import threading
+from errno import ESRCH
+from collections import deque
+
+MIB = 1024 * 1024
+# a bucket holds the tokens of BURST_SECONDS - short bursts are not delayed
+BURST_SECONDS = 0.5
+# chunk size of throttled copies (copy_file_range copies a whole file at once otherwise)
+THROTTLED_COPY_CHUNK_SIZE = 8 * MIB
+
+# adaptive mode: the mean latency of the I/O operations is evaluated every
+# ADAPTIVE_WINDOW seconds and compared with the lowest latency of the last
+# ADAPTIVE_HISTORY windows (the baseline). The latency of an operation is
+# normalized to the time of one MiB-equivalent (a seek plus MiB of transfer).
+ADAPTIVE_WINDOW = 1.0
+ADAPTIVE_MIN_SAMPLES = 4
+ADAPTIVE_HISTORY = 60
+ADAPTIVE_LATENCY_FACTOR = 2.0       # congested: latency above factor * baseline ...
+ADAPTIVE_MIN_LATENCY = 0.005        # ... and above 5 ms (page cache hits never are)
+ADAPTIVE_DECREASE = 0.5             # the share of time spent on I/O is halved when congested ...
+ADAPTIVE_INCREASE = 0.1             # ... and raised again step by step
+ADAPTIVE_MIN_DUTY = 0.1
+
+# ioprio_set (Linux): syscall numbers per architecture
+IO_PRIORITY_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+_IOPRIO_SYSCALLS = {'x86_64': 251, 'amd64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'arm64': 30, 'riscv64': 30,
+                    'armv7l': 314, 'ppc64le': 273, 'ppc64': 273, 's390x': 282}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+
+class TokenBucket:
+    # Thread safe token bucket. Tokens are taken before they are available; the
+    # caller waits for the debt (see consume), so large requests are not starved.
+
+    def __init__(self, rate: float):
+        self.rate: float = rate
+        self.capacity: float = rate * BURST_SECONDS
+        self._tokens: float = self.capacity
+        self._time: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: float) -> float:
+        # returns the seconds to wait until the tokens are paid
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class LatencyMonitor:
+    # Adaptive mode: backs off when the I/O latency rises (AIMD on the share of
+    # time spent on I/O - after an operation of t seconds, t * (1 / duty - 1)
+    # seconds are waited).
+
+    def __init__(self):
+        self.duty: float = 1.0
+        self._history: deque[float] = deque(maxlen=ADAPTIVE_HISTORY)
+        self._window_start: float = time.monotonic()
+        self._sum: float = 0
+        self._count: int = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float, nbytes: int) -> float:
+        # returns the seconds to wait after the operation
+        with self._lock:
+            self._sum += seconds / (1 + nbytes / MIB)
+            self._count += 1
+            now = time.monotonic()
+            if (now - self._window_start >= ADAPTIVE_WINDOW) and (self._count >= ADAPTIVE_MIN_SAMPLES):
+                latency = self._sum / self._count
+                self._history.append(latency)
+                if latency > max(ADAPTIVE_LATENCY_FACTOR * min(self._history), ADAPTIVE_MIN_LATENCY):
+                    self.duty = max(ADAPTIVE_MIN_DUTY, self.duty * ADAPTIVE_DECREASE)
+                else:
+                    self.duty = min(1.0, self.duty + ADAPTIVE_INCREASE)
+                self._window_start, self._sum, self._count = now, 0, 0
+            return seconds * (1 / self.duty - 1)
+
+
+class Throttle:
+    # Limits of a profile or a destination: read and write bandwidth (bytes per
+    # second), I/O operations per second and the adaptive mode. A rate of 0 is
+    # not limited. Shared by all threads that do I/O for the profile/destination.
+
+    def __init__(self, read_rate: float = 0, write_rate: float = 0, iops: float = 0, adaptive: bool = False):
+        self._read: typing.Optional[TokenBucket] = TokenBucket(read_rate) if read_rate > 0 else None
+        self._write: typing.Optional[TokenBucket] = TokenBucket(write_rate) if write_rate > 0 else None
+        self._iops: typing.Optional[TokenBucket] = TokenBucket(iops) if iops > 0 else None
+        self._latency: typing.Optional[LatencyMonitor] = LatencyMonitor() if adaptive else None
+        # seconds the I/O was delayed by this throttle (see throttle_io)
+        self.delay: float = 0
+
+    def is_active(self) -> bool:
+        return (self._read is not None) or (self._write is not None) or (self._iops is not None) or (self._latency is not None)
+
+    def account(self, read: int, written: int, seconds: float) -> float:
+        # Accounts an I/O operation that took seconds. Returns the seconds the
+        # caller has to wait before its next operation.
+        wait = 0
+        if (self._read is not None) and (read > 0):
+            wait = max(wait, self._read.consume(read))
+        if (self._write is not None) and (written > 0):
+            wait = max(wait, self._write.consume(written))
+        if self._iops is not None:
+            wait = max(wait, self._iops.consume(1))
+        if self._latency is not None:
+            wait = max(wait, self._latency.add(seconds, read + written))
+        return wait
+
+
+def throttle_io(throttles: list[Throttle], read: int, written: int, seconds: float) -> None:
+    # the limits of all throttles apply at the same time; the delay is counted
+    # for the throttle that caused it
+    wait, cause = 0, None
+    for throttle in throttles:
+        throttle_wait = throttle.account(read, written, seconds)
+        if throttle_wait > wait:
+            wait, cause = throttle_wait, throttle
+    if cause is not None:
+        cause.delay += wait
+        time.sleep(wait)
+
+
+class ThrottledFile:
+    # File object wrapper: every read and write is accounted to the throttles.
+
+    def __init__(self, file: typing.BinaryIO, throttles: list[Throttle]):
+        self._file: typing.BinaryIO = file
+        self._throttles: list[Throttle] = throttles
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.perf_counter()
+        data = self._file.read(size)
+        throttle_io(self._throttles, len(data), 0, time.perf_counter() - start)
+        return data
+
+    def write(self, data: bytes) -> int:
+        start = time.perf_counter()
+        written = self._file.write(data)
+        throttle_io(self._throttles, 0, len(data), time.perf_counter() - start)
+        return written
+
+    def __getattr__(self, name: str):
+        return getattr(self._file, name)
+
+    def __enter__(self) -> 'ThrottledFile':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._file.close()
+
+
+def throttle_file(file: typing.BinaryIO, throttles: list[typing.Optional[Throttle]]) -> typing.BinaryIO:
+    # the file itself, if none of the throttles limits anything
+    throttles = [throttle for throttle in throttles if (throttle is not None) and throttle.is_active()]
+    return ThrottledFile(file, throttles) if len(throttles) > 0 else file
+
+
+class ThrottleGroup:
+    # The throttles of one profile run: the profile's throttle applies to the scan,
+    # the reads of the source files and all writes; the throttle of a destination
+    # (by destination directory) to the writes into that destination.
+
+    def __init__(self, profile: Throttle = None, destinations: dict[str, Throttle] = None):
+        self.profile: typing.Optional[Throttle] = profile
+        self.destinations: dict[str, Throttle] = destinations if destinations is not None else {}
+
+    def get_write_throttles(self, destination_directory: str) -> list[Throttle]:
+        return [throttle for throttle in (self.profile, self.destinations.get(destination_directory)) if (throttle is not None) and throttle.is_active()]
+
+    def open_source(self, filepath: str) -> typing.BinaryIO:
+        return throttle_file(open(filepath, 'rb'), [self.profile])
+
+    def wrap_destination(self, destination_directory: str, file: typing.BinaryIO) -> typing.BinaryIO:
+        return throttle_file(file, self.get_write_throttles(destination_directory))
+
+    def get_source_opener(self) -> typing.Optional[typing.Callable[[str], typing.BinaryIO]]:
+        # None: the source files are read without throttling
+        return self.open_source if (self.profile is not None) and self.profile.is_active() else None
+
+
+def parse_io_priority(value: str) -> typing.Optional[tuple[int, int]]:
+    # "idle", "best-effort", "best-effort:7", "realtime:0" -> (class, level); None: invalid
+    name, _, level = value.partition(':')
+    if name not in IO_PRIORITY_CLASSES:
+        return None
+    if level == '':
+        return IO_PRIORITY_CLASSES[name], 4 if name != 'idle' else 0
+    if (not level.isdigit()) or (int(level) > 7):
+        return None
+    return IO_PRIORITY_CLASSES[name], int(level)
+
+
+def _get_thread_ids() -> list[int]:
+    # Linux: nice and ioprio are attributes of the single threads - the ids of all
+    # threads of the process; elsewhere: 0 (the process)
+    try:
+        return [int(thread_id) for thread_id in os.listdir('/proc/self/task')]
+    except (OSError, ValueError):
+        return [0]
+
+
+def set_process_priority(nice: int = None, io_priority: str = None) -> None:
+    # Sets the CPU (nice) and I/O priority (ioprio, Linux only) of the process: of all
+    # its threads that are running already (e.g. the log writer); threads started
+    # afterwards inherit the priorities.
+    # Raises OSError if a priority cannot be set.
+    thread_ids = _get_thread_ids()
+    if nice is not None:
+        if not hasattr(os, 'setpriority'):
+            raise OSError('Setting the nice value is not supported on this platform')
+        for thread_id in thread_ids:
+            try:
+                os.setpriority(os.PRIO_PROCESS, thread_id, nice)
+            except ProcessLookupError:
+                # the thread ended in the meantime
+                continue
+    if io_priority is not None:
+        number = _IOPRIO_SYSCALLS.get(platform.machine().lower())
+        if (not sys.platform.startswith('linux')) or (number is None):
+            raise OSError('I/O priorities are not supported on this platform')
+        priority = parse_io_priority(io_priority)
+        if priority is None:
+            raise OSError('Invalid I/O priority: {}'.format(io_priority))
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        for thread_id in thread_ids:
+            if libc.syscall(number, _IOPRIO_WHO_PROCESS, thread_id, (priority[0] << _IOPRIO_CLASS_SHIFT) | priority[1]) != 0:
+                errno = ctypes.get_errno()
+                if errno == ESRCH:
+                    continue
+                raise OSError(errno, 'Cannot set the I/O priority {}: {}'.format(io_priority, os.strerror(errno)))
@@ -1,16 +1,28 @@
 import os
 import shutil
 import glob
-import fnmatch
-from datetime import datetime
-import tarfile
-import zipfile
+from datetime import datetime, timedelta
 import csv
 import json
+import time
+import queue
+import typing
+import threading
+
+from .compression import CompressionPolicy, FORMAT_ZIP, FORMAT_TAR_GZ, get_archive_extension, write_tar
+from .checkpoint import Checkpoint
+from .scanner import ScanEntry, SourceFile, IgnoreMatcher, SourceMatcher, scan_sources, get_path_key, get_source_path, DEFAULT_SCAN_WORKERS
+from .throttle import Throttle, ThrottleGroup, ThrottledFile, throttle_io, THROTTLED_COPY_CHUNK_SIZE
+from .backends import DestinationBackend
+from .delta import DeltaEncoder
 
 BACKUP_DIR_PREFIX = 'BACKUP_'
 BACKUP_FILENAME_PREFIX = 'archive'
 BACKUP_FILENAME_FORMAT_DATETIMESTAMP = '%Y%m%d%H%M%S'
+BACKUP_FILENAME_TIMESTAMP_LENGTH = 14
+DELETED_FILES_ARCNAME = '.backup_deleted_files.json'
+BACKUP_INFO_ARCNAME = '.backup_info.json'
+PIPELINE_QUEUE_SIZE = 10000
 
 
 def readJson(filepath: str) -> dict:
@@ -29,13 +41,16 @@ def readJson(filepath: str) -> dict:
         raise Exception('Invalid JSON format: {}'.format(filepath))
 
 
-def filter_files(file_patterns: list[str], ignore_patterns: list[str] = []) -> list[str]:
-    # This method returns a list of all files matchting any of the file_patterns,
-    # excluding those matching any of the ignore patterns.
+def iter_files(file_patterns: list[str], ignore_patterns: list[str] = [], workers: int = DEFAULT_SCAN_WORKERS, throttle: Throttle = None) -> typing.Iterator[ScanEntry]:
+    # This generator yields all files matchting any of the file_patterns,
+    # excluding those matching any of the ignore patterns (as ScanEntry incl. the stat data).
+    # Files are yielded while the scan is still running and every file is yielded once - 
+    # without keeping a list of all files in memory.
     # 
     # Args:
     #     file_patterns (list): A list of directory paths and/or files to search. 
     #     ignore_patterns (list): A list of glob patterns to ignore. 
+    #     throttle (Throttle): limits the directory listings of the scan (optional).
     #
     #     where both args support wildcards:
     #     ⁠"*"  : matches any characters, 
@@ -43,12 +58,13 @@ def filter_files(file_patterns: list[str], ignore_patterns: list[str] = []) -> l
     #     "[]" : matches any character within the specified range (e.g., ⁠[a-z], ⁠[0-9], ⁠[A-Za-z]).
     #
     # Returns:
-    #    A list of file paths matching any of the file_patterns, but none of the ignore_patterns.
+    #    ScanEntry objects matching any of the file_patterns, but none of the ignore_patterns.
+    #    Directories matching an ignore pattern (with trailing "/", e.g. "**/logs/") are not walked at all.
     #
     # Example usage:
     #    file_patterns = ["/path/to/directory1", "/path/to/directory2",‚ "/path/to/**/subdir/"]
     #    ignore_patterns = ["*.txt", "temp*", "**/logs/*"]  
-    #    filtered_files = filter_files(file_patterns, ignore_patterns) 
+    #    filtered_files = iter_files(file_patterns, ignore_patterns) 
     #
     # where
     #    "*.txt": Matches any file ending with “.txt”.
@@ -56,104 +72,486 @@ def filter_files(file_patterns: list[str], ignore_patterns: list[str] = []) -> l
     #    ""⁠**/logs/*": Matches any file within a directory named “logs” at any level of the directory tree.  
      
     if file_patterns == None:
-        return []
+        return
     
-    filtered_files: list[str] = [] 
+    # all ignore patterns are compiled into one regular expression
+    matcher = IgnoreMatcher(ignore_patterns)
+
+    # glob patterns are matched during the scan (one walk of their roots, see
+    # SourceMatcher) instead of being expanded with glob.glob first
+    yield from scan_sources(SourceMatcher(file_patterns), matcher, workers, throttle)
+
+
+def expand_sources(file_patterns: list[str]) -> tuple[dict[str, str], dict[str, str]]:
+    # Returns the directories and the files matching the source patterns (see get_path_key -> path).
+    # Only used to watch the sources (see watch.py) - the scans match glob patterns while
+    # they walk the file system (see iter_files).
+    # using glob.glob(): glob.glob() can be used as a wildcard search (search w/ *, ? or []) for files. 
+    # within the file system. It returns a list of all file paths that match the provided directory file pattern
+    directories: dict[str, str] = {}
+    files: dict[str, str] = {}
     for file_pattern in file_patterns:
-        # using glob.glob(): glob.glob() can be used as a wildcard search (search w/ *, ? or []) for files. 
-        # within the file system. It returns a list of all file paths that match the provided directory file pattern
         for file in glob.glob(file_pattern, recursive=True):
             if os.path.isdir(file):
-                # handling directores
-                for root, _, files in os.walk(file):
-                    for file in files:
-                        full_path = os.path.join(root, file)
-                        # using ⁠fnmatch.fnmatch to check if the current ⁠file matches any of the ⁠ignore_patterns.
-                        # ⁠fnmatch.fnmatch supports wildcards like ⁠* (match any characters) and ⁠? (match any single character).
-                        if any(fnmatch.fnmatch(full_path, pattern) for pattern in ignore_patterns):
-                            continue  # skip this file if it matches an ignore pattern
-                        filtered_files.append(full_path)
+                directories.setdefault(get_path_key(file), file)
             else:
-                # handling files 
-                files = glob.glob(file)
-                for file in files:
-                    if any(fnmatch.fnmatch(file, pattern) for pattern in ignore_patterns):
-                        continue
-                    filtered_files.append(file) 
-
-    # remove duplicates from list
-    unique_result = set()
-    for file in filtered_files:
-        unique_result.add(file)
-    filtered_files = list(unique_result)  
-
-    return filtered_files
-
-
-def create_tar_gz(filepaths: list[str], destination_directory: str) -> str:
-    # cd to destination dir; save orig.
-    saved_path: str = os.getcwd()
-    os.chdir(destination_directory)
-    try:
-        timestamp = datetime.now().strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
-        backup_file = "archive{}.tar.gz".format(timestamp)
+                files.setdefault(get_path_key(file), file)
+    return directories, files
+
+
+def scan_files(file_patterns: list[str], ignore_patterns: list[str] = [], workers: int = DEFAULT_SCAN_WORKERS) -> list[ScanEntry]:
+    # Same as iter_files, but returns a list.
+    return list(iter_files(file_patterns, ignore_patterns, workers))
+
+
+def filter_files(file_patterns: list[str], ignore_patterns: list[str] = []) -> list[str]:
+    # Same as iter_files, but returns a list of the file paths only.
+    return [entry.path for entry in iter_files(file_patterns, ignore_patterns)]
+
+
+class CountingIterator:
+    # Passes the items of an iterable through and counts them.
+
+    def __init__(self, iterable: typing.Iterable):
+        self._iterator = iter(iterable)
+        self.count: int = 0
+
+    def __iter__(self) -> 'CountingIterator':
+        return self
+
+    def __next__(self):
+        item = next(self._iterator)
+        self.count += 1
+        return item
+
+
+def prefetch(iterable: typing.Iterable, maxsize: int = PIPELINE_QUEUE_SIZE) -> typing.Iterator:
+    # Runs the iterable in a background thread and yields its items. At most
+    # maxsize items are buffered, so producer (e.g. the file scan) and consumer
+    # (e.g. the compression) overlap while the memory stays bounded.
+    items: queue.Queue = queue.Queue(maxsize)
+    stop = threading.Event()
+    end_of_items = object()
 
-        with tarfile.open(backup_file, "w:gz") as tar:
-            for filepath in filepaths:
-                tar.add(filepath, arcname=filepath)
-        tar.close()
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(end_of_items)
+        except BaseException as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is end_of_items:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
     finally:
-        os.chdir(saved_path)
-   
-    return os.path.join(destination_directory, backup_file)
+        stop.set()
+
+
+def get_arcname(filepath: str) -> str:
+    # name of a file in the archives (same as zipfile/tarfile: without drive and
+    # leading separator, always with "/")
+    arcname = os.path.normpath(os.path.splitdrive(filepath)[1])
+    while arcname[0:1] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    if os.sep != '/':
+        arcname = arcname.replace(os.sep, '/')
+    return arcname
+
+
+class WriteResult:
+    # result of write_to_destinations
+
+    def __init__(self):
+        # destination directory -> backup file
+        self.backup_files: dict[str, str] = {}
+        # destination directory -> exception, for destinations that failed
+        self.errors: dict[str, Exception] = {}
+        self.size: int = 0
+        self.checksum: str = ''      # sha256 of the backup file
+        self.block_checksums: list[str] = []     # see archive.CHECKSUM_BLOCK_SIZE
+        # destination directory -> seconds spent writing the file (streamed or copied)
+        self.durations: dict[str, float] = {}
+        # multi-volume archives (see volumes.create_volumes): the results of the single
+        # volumes; for a volume: the number of files archived in it
+        self.volumes: list['WriteResult'] = []
+        self.file_count: int = 0
+        # files that vanished or became unreadable since the scan -> error (not archived)
+        self.skipped: dict[str, OSError] = {}
+
+
+def create_archive(filepaths: typing.Iterable[SourceFile], destination_directories: list[str], format: str = FORMAT_ZIP, policy: CompressionPolicy = None, get_deleted_files: typing.Callable[[], list[str]] = None, workers: int = None, backup_info: dict = None, checkpoint_interval: float = 0, resume: Checkpoint = None, volume_size: int = 0, throttle: ThrottleGroup = None, backends: dict[str, DestinationBackend] = None, delta: DeltaEncoder = None, on_skipped: typing.Callable[[str, OSError], None] = None) -> WriteResult:
+    # Creates a zip or a compressed tar archive (see compression.FORMATS).
+    # backup_info (profile, backup_time, mode, ...) is stored in the archive member BACKUP_INFO_ARCNAME;
+    # its backup_time names the archive (see get_backup_timestamp).
+    # Checkpoints (and resuming from them) are only supported for single zip archives.
+    # volume_size > 0: the archive is split into volumes of about volume_size bytes (see volumes).
+    # filepaths: paths or the ScanEntry of the scan (its stat data is reused, see scanner.SourceFile).
+    # throttle: limits the reads of the files and the writes into the destinations (see throttle).
+    # backends: destination directory -> backend of destinations that are not local (see backends).
+    # delta: large files are stored as deltas (zip archives only, see delta.DeltaEncoder).
+    # Files that vanished or became unreadable since the scan are not archived: they are
+    # returned in WriteResult.skipped and passed to on_skipped at once (before the
+    # deleted files are recorded).
+    if volume_size > 0:
+        from .volumes import create_volumes
+        return create_volumes(filepaths, destination_directories, volume_size, format, policy, get_deleted_files, workers, backup_info, throttle, backends, delta, on_skipped)
+    if format == FORMAT_ZIP:
+        return create_zip(filepaths, destination_directories, get_deleted_files, workers, policy, backup_info, checkpoint_interval, resume, throttle=throttle, backends=backends, delta=delta, on_skipped=on_skipped)
+    level = policy.level if policy is not None else None
+    return create_tar(filepaths, destination_directories, format, level, get_deleted_files, workers, backup_info, throttle=throttle, backends=backends, on_skipped=on_skipped)
+
+
+def get_backup_timestamp(backup_info: dict = None) -> str:
+    # the backup files are named after the start of the backup (backup_info, the same
+    # time as in the manifest, catalog and checkpoint); default: now
+    if (backup_info is not None) and backup_info.get('backup_time'):
+        return backup_info['backup_time']
+    return datetime.now().strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+
+
+def _get_extra_members(get_deleted_files: typing.Callable[[], list[str]], backup_info: dict) -> dict[str, bytes]:
+    # incremental backups: record the files deleted since the last backup
+    # (only known after all files have been processed)
+    members: dict[str, bytes] = {}
+    deleted_files = get_deleted_files() if get_deleted_files is not None else []
+    if deleted_files:
+        members[DELETED_FILES_ARCNAME] = json.dumps(deleted_files).encode('utf-8')
+    if backup_info is not None:
+        members[BACKUP_INFO_ARCNAME] = json.dumps(backup_info).encode('utf-8')
+    return members
+
+
+def _get_skipped_handler(on_skipped: typing.Callable[[str, OSError], None] = None) -> tuple[dict[str, OSError], typing.Callable[[str, OSError], None]]:
+    # collects the skipped files for WriteResult.skipped
+    skipped: dict[str, OSError] = {}
+
+    def skip(filepath: str, error: OSError) -> None:
+        skipped[filepath] = error
+        if on_skipped is not None:
+            on_skipped(filepath, error)
+
+    return skipped, skip
 
 
-def create_zip(filepaths: list[str], destination_directory: str) -> str:
-    # cd to destination dir; save orig.
-    saved_path: str = os.getcwd()
-    os.chdir(destination_directory)
+def create_tar(filepaths: typing.Iterable[SourceFile], destination_directories: list[str], format: str = FORMAT_TAR_GZ, level: int = None, get_deleted_files: typing.Callable[[], list[str]] = None, workers: int = None, backup_info: dict = None, filename: str = None, throttle: ThrottleGroup = None, backends: dict[str, DestinationBackend] = None, on_skipped: typing.Callable[[str, OSError], None] = None) -> WriteResult:
+    # The tar stream is compressed as a whole (gz, xz or zst) and streamed into all
+    # destinations at once (see write_to_destinations).
+    # filename: name of the backup file (default: archive{backup_datetime}.{format}, see get_backup_timestamp)
+    # on_skipped: see create_archive
+    skipped, skip = _get_skipped_handler(on_skipped)
+
+    def get_extra_members() -> dict[str, bytes]:
+        return _get_extra_members(get_deleted_files, backup_info)
+
+    def write_archive(fileobj):
+        write_tar(fileobj, (get_source_path(file) for file in filepaths), format, level, workers, get_extra_members, throttle.get_source_opener() if throttle is not None else None, skip)
+
+    if filename is None:
+        filename = BACKUP_FILENAME_PREFIX + get_backup_timestamp(backup_info) + get_archive_extension(format)
+    result = write_to_destinations(filename, destination_directories, write_archive, throttle=throttle, backends=backends)
+    result.skipped = skipped
+    return result
+
+
+def create_zip(filepaths: typing.Iterable[SourceFile], destination_directories: list[str], get_deleted_files: typing.Callable[[], list[str]] = None, workers: int = None, policy: CompressionPolicy = None, backup_info: dict = None, checkpoint_interval: float = 0, resume: Checkpoint = None, filename: str = None, throttle: ThrottleGroup = None, backends: dict[str, DestinationBackend] = None, delta: DeltaEncoder = None, on_skipped: typing.Callable[[str, OSError], None] = None) -> WriteResult:
+    # The archive is streamed into all destinations at once (see write_to_destinations);
+    # its members are compressed in parallel (see archive.ParallelZipWriter).
+    # filepaths may be a generator - the files are archived while they are produced.
+    # Small files given as ScanEntry are read ahead and written in batches (see
+    # archive.ParallelZipWriter.write_files).
+    #
+    # checkpoint_interval > 0: a checkpoint is written every checkpoint_interval seconds
+    # and the temporary files are kept if the backup is interrupted. resume continues
+    # the archive of such a checkpoint (files that are already in it are not read again).
+    # filename: name of the backup file (default: archive{backup_datetime}.zip, see get_backup_timestamp)
+    # on_skipped: see create_archive
+    from .archive import ParallelZipWriter
+    from .checkpoint import CheckpointWriter, get_checkpoint_filepath
+    checkpoint: typing.Optional[CheckpointWriter] = None
+    skipped, skip = _get_skipped_handler(on_skipped)
+
+    def write_zip(fileobj):
+        nonlocal checkpoint
+        if (checkpoint_interval > 0) or (resume is not None):
+            checkpoint_files = [get_checkpoint_filepath(os.path.join(directory, filename)) for directory in destination_directories]
+            header = resume.header if resume is not None else dict(backup_info or {}, filename=filename, format=FORMAT_ZIP)
+            interval = checkpoint_interval if checkpoint_interval > 0 else float('inf')
+            checkpoint = CheckpointWriter(checkpoint_files, header, interval, fileobj.sync, resume)
+        opener = throttle.get_source_opener() if throttle is not None else None
+        with ParallelZipWriter(fileobj, workers, policy, checkpoint, resume.members if resume is not None else None, opener, delta, skip) as zip:
+            zip.write_files(filepaths)
+            for arcname, data in _get_extra_members(get_deleted_files, backup_info).items():
+                zip.writestr(arcname, data)
+
+    if resume is not None:
+        filename = resume.filename
+    elif filename is None:
+        filename = BACKUP_FILENAME_PREFIX + get_backup_timestamp(backup_info) + get_archive_extension(FORMAT_ZIP)
+    result = write_to_destinations(filename, destination_directories, write_zip, resume.offset if resume is not None else 0, checkpoint_interval > 0, throttle, backends)
+    if checkpoint is not None:
+        checkpoint.remove()
+    result.skipped = skipped
+    return result
+
+
+def parse_backup_time(filename: str) -> typing.Optional[datetime]:
+    # archive{backup_datetime}.{zip|tar.gz|...} -> backup_datetime
+    if not filename.startswith(BACKUP_FILENAME_PREFIX):
+        return None
+    timestamp = filename[len(BACKUP_FILENAME_PREFIX):len(BACKUP_FILENAME_PREFIX) + BACKUP_FILENAME_TIMESTAMP_LENGTH]
     try:
-        timestamp = datetime.now().strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
-        backup_file = "archive{}.zip".format(timestamp)
+        return datetime.strptime(timestamp, BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+    except ValueError:
+        return None
 
-        with zipfile.ZipFile(backup_file , "w") as zip:
-            for filepath in filepaths:
-               zip.write(filepath, filepath)
-    finally:
-        os.chdir(saved_path)
 
-    return os.path.join(destination_directory, backup_file)    
+def get_temp_filepath(filepath: str) -> str:
+    # hidden temporary file: not picked up by the clean-up mechanism
+    return os.path.join(os.path.dirname(filepath), '.' + os.path.basename(filepath) + '.part')
+
+
+def _open_resumed(temp_file: str, offset: int, prefix_file: str) -> typing.BinaryIO:
+    # the temporary file of an interrupted backup, truncated to the checkpoint;
+    # a destination whose file is lost gets a copy of the first offset bytes
+    if (not os.path.isfile(temp_file)) or (os.path.getsize(temp_file) < offset):
+        with open(prefix_file, 'rb') as fsrc, open(temp_file, 'wb') as fdst:
+            remaining = offset
+            while remaining > 0:
+                data = fsrc.read(min(remaining, 1024 * 1024))
+                fdst.write(data)
+                remaining -= len(data)
+    f = open(temp_file, 'r+b')
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def write_to_destinations(filename: str, destination_directories: list[str], write_function, resume_offset: int = 0, keep_partial: bool = False, throttle: ThrottleGroup = None, backends: dict[str, DestinationBackend] = None) -> WriteResult:
+    # Writes a backup file in one pass into several destination directories.
+    # 
+    # write_function(fileobj) produces the content; the stream is teed into one
+    # temporary file per file system. Destinations that share a file system with
+    # another destination get a (zero-copy) copy of the finished file afterwards.
+    # All files are renamed to their final name only when they are complete.
+    # Destinations with a backend (by destination directory, see backends) get the
+    # stream directly as an upload, which is completed at the end.
+    #
+    # resume_offset > 0: the temporary files of an interrupted run are continued from
+    # this offset (see checkpoint). keep_partial: the temporary files are not deleted
+    # if write_function fails, so the backup can be resumed. throttle: limits the
+    # writes per destination (the stream is as fast as the slowest destination).
+    #
+    # Returns a WriteResult with the backup files, the failed destinations and
+    # the checksum of the backup file (calculated while writing).
+    from .archive import TeeWriter
+
+    result = WriteResult()
+    backup_files = result.backup_files
+    errors = result.errors
+    backends = backends or {}
 
+    # one stream per file system (and per backend)
+    primary_directories: dict[int, str] = {}
+    secondary_directories: list[tuple[str, str]] = []
+    remote_directories: list[str] = []
+    for destination_directory in destination_directories:
+        try:
+            # volumes are written concurrently (see volumes)
+            os.makedirs(destination_directory, exist_ok=True)
+            device = os.stat(destination_directory).st_dev
+        except OSError as e:
+            errors[destination_directory] = e
+            continue
+        if destination_directory in backends:
+            remote_directories.append(destination_directory)
+        elif device in primary_directories:
+            secondary_directories.append((destination_directory, primary_directories[device]))
+        else:
+            primary_directories[device] = destination_directory
+    if len(primary_directories) + len(remote_directories) == 0:
+        return result
 
-def cleanup_destination(destination_directory: str, days_to_keep: int) -> None:
+    prefix_file = None
+    if resume_offset > 0:
+        temp_files = [get_temp_filepath(os.path.join(directory, filename)) for directory in destination_directories]
+        prefix_file = next((temp_file for temp_file in temp_files if os.path.isfile(temp_file) and os.path.getsize(temp_file) >= resume_offset), None)
+        if prefix_file is None:
+            raise OSError('Cannot resume {}: the temporary files are missing'.format(filename))
+
+    directories: list[str] = []
+    files = []
+    for destination_directory in list(primary_directories.values()) + remote_directories:
+        backup_file = os.path.join(destination_directory, filename)
+        temp_file = get_temp_filepath(backup_file)
+        try:
+            if destination_directory in backends:
+                files.append(backends[destination_directory].open_upload(backup_file, resume_offset, prefix_file))
+            elif prefix_file is not None:
+                files.append(_open_resumed(temp_file, resume_offset, prefix_file))
+            else:
+                files.append(open(temp_file, 'wb'))
+            directories.append(destination_directory)
+        except OSError as e:
+            errors[destination_directory] = e
+        else:
+            if throttle is not None:
+                files[-1] = throttle.wrap_destination(destination_directory, files[-1])
+
+    def discard(i: int) -> None:
+        # the temporary file or the unfinished upload of a destination
+        if directories[i] in backends:
+            try:
+                files[i].abort()
+            except OSError:
+                pass
+        else:
+            try:
+                os.remove(get_temp_filepath(os.path.join(directories[i], filename)))
+            except OSError:
+                # already gone, or the file system of the destination failed
+                pass
+
+    tee = TeeWriter(files)
+    start = time.perf_counter()
+    try:
+        if len(files) > 0:
+            if prefix_file is not None:
+                tee.resume(prefix_file, resume_offset)
+            write_function(tee)
+            tee.flush()
+    except BaseException:
+        for f in files:
+            f.close()
+        if not keep_partial:
+            for i in range(len(directories)):
+                discard(i)
+        raise
+    for i, f in enumerate(files):
+        try:
+            if (directories[i] in backends) and (i not in tee.errors):
+                f.complete()
+            f.close()
+        except OSError as e:
+            tee.errors[i] = e
+    result.size = tee.tell()
+    result.checksum = tee.sha256.hexdigest()
+    result.block_checksums = tee.get_block_checksums()
+    stream_time = time.perf_counter() - start
+
+    for i, destination_directory in enumerate(directories):
+        backup_file = os.path.join(destination_directory, filename)
+        if i in tee.errors:
+            errors[destination_directory] = tee.errors[i]
+            discard(i)
+            continue
+        if destination_directory not in backends:
+            try:
+                os.replace(get_temp_filepath(backup_file), backup_file)
+            except OSError as e:
+                errors[destination_directory] = e
+                discard(i)
+                continue
+        backup_files[destination_directory] = backup_file
+        result.durations[destination_directory] = stream_time
+
+    for destination_directory, primary_directory in secondary_directories:
+        if primary_directory not in backup_files:
+            errors[destination_directory] = errors[primary_directory]
+            continue
+        try:
+            start = time.perf_counter()
+            copy_file(backup_files[primary_directory], destination_directory, throttle.get_write_throttles(destination_directory) if throttle is not None else None)
+            backup_files[destination_directory] = os.path.join(destination_directory, filename)
+            result.durations[destination_directory] = time.perf_counter() - start
+        except OSError as e:
+            errors[destination_directory] = e
+
+    return result
+
+
+def remove_backup_file(backup_file: str, backend: DestinationBackend = None) -> None:
+    if backend is not None:
+        backend.delete_files([backup_file])
+    elif os.path.exists(backup_file):
+        os.remove(backup_file)
+
+
+def cleanup_destination(destination_directory: str, days_to_keep: int, backend: DestinationBackend = None) -> None:
+    # Deletes all archives older than days_to_keep. The expired archives are looked
+    # up in the catalog of the destination - only the backup folders are listed:
+    # backup files missing in the catalog are registered first (the catalog of a
+    # run may have failed, or the catalog of a backend is older than the storage).
+    # With a backend, the expired files are deleted in batches.
+    from .catalog import Catalog, BACKUP_KIND_ARCHIVE
+    from .volumes import get_volume_index_filepath
     if days_to_keep < 1:
         return
 
-    saved_path: str = os.getcwd()
-    os.chdir(destination_directory)
-    try:
-        now = datetime.now()
-        for root, dirs, files in os.walk(destination_directory):
-            for dir in dirs:
-                if not dir.startswith(BACKUP_DIR_PREFIX):
-                    dirs.remove(dir)
-            for file in files:
-                if file.startswith(BACKUP_FILENAME_PREFIX):
-                    file_datetime = datetime.strptime(file[len(BACKUP_FILENAME_PREFIX):-4], BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
-                    difference = now - file_datetime
-                    if difference.days > days_to_keep:
-                        full_path = os.path.join(root, file)
-                        os.remove(full_path)
-            #if not glob.glob(os.path.join(root, '*')): #os.listdir(root):
-             #   os.remove(root)
+    cutoff = datetime.now() - timedelta(days=days_to_keep + 1)
+    if (backend is None) and (not os.path.isdir(destination_directory)):
+        return
+    with Catalog(destination_directory, backend) as catalog:
+        catalog.add_untracked()
+        expired = catalog.get_expired_backups(cutoff, BACKUP_KIND_ARCHIVE)
+        if backend is not None:
+            # the volume indexes are stored in the backend as well
+            index_files = {get_volume_index_filepath(catalog.get_file(record)) for record in expired}
+            backend.delete_files([catalog.get_file(record) for record in expired] + sorted(index_file for index_file in index_files if index_file is not None))
+        for record in expired:
+            full_path = catalog.get_file(record)
+            if (backend is None) and os.path.exists(full_path):
+                os.remove(full_path)
+            # the volumes of a set have the same backup time - they expire together with their index
+            index_file = get_volume_index_filepath(full_path)
+            if (index_file is not None) and os.path.exists(index_file):
+                os.remove(index_file)
+            catalog.remove_backup(record.filename)
+    if backend is not None:
+        # uploads of backups that were interrupted and never resumed
+        backend.abort_uploads(cutoff, BACKUP_DIR_PREFIX)
 
 
-    finally:
-        os.chdir(saved_path)
+def _copy_file_range(source_file: str, target_file: str, throttles: list[Throttle] = None) -> bool:
+    # zero-copy copy within the kernel; on file systems like btrfs or xfs this
+    # creates a reflink (no data is duplicated at all)
+    # throttles: the file is copied in chunks, each chunk is accounted as written
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    with open(source_file, 'rb') as fsrc, open(target_file, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                start = time.perf_counter()
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(remaining, THROTTLED_COPY_CHUNK_SIZE) if throttles else remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+                if throttles:
+                    throttle_io(throttles, 0, copied, time.perf_counter() - start)
+        except OSError:
+            return False
+    return remaining == 0
 
-   
 
-def copy_file(file: str, destination_dir: str):
+def copy_file(file: str, destination_dir: str, throttles: list[Throttle] = None):
     if not os.path.exists(file):
         return False
     
@@ -161,13 +559,25 @@ def copy_file(file: str, destination_dir: str):
         os.makedirs(destination_dir)
 
     target_file = os.path.join(destination_dir, os.path.basename(file))
+    temp_file = get_temp_filepath(target_file)
     try:
-        shutil.copy(file, target_file)
+        # shutil.copyfile falls back to sendfile (Linux) / fcopyfile (macOS)
+        if not _copy_file_range(file, temp_file, throttles):
+            if throttles:
+                with open(file, 'rb') as fsrc, ThrottledFile(open(temp_file, 'wb'), throttles) as fdst:
+                    shutil.copyfileobj(fsrc, fdst, THROTTLED_COPY_CHUNK_SIZE)
+            else:
+                shutil.copyfile(file, temp_file)
+        shutil.copymode(file, temp_file)
+        os.replace(temp_file, target_file)
         return True
     except PermissionError as e:
         raise PermissionError(f"Permission error during copy: {e}")
     except OSError as e:
         raise OSError(f"Error during file copy: {e}")
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
     
 
 def writeCsv(filepath: str, data: list) -> None:
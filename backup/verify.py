@@ -0,0 +1,288 @@
+import os
+import zlib
+import random
+import typing
+import hashlib
+import zipfile
+import datetime
+import argparse
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from .configs import ConfigObject, Destination, get_config_filepath
+from .logmgr import LogManager
+from .catalog import Catalog, BackupRecord, BACKUP_KIND_SNAPSHOT
+from .chunkstore import load_snapshot, get_chunk_file
+from .compression import FORMAT_ZIP, get_archive_format
+from .archive import new_block_hash, get_default_workers
+from .backends import DestinationBackend
+
+# blocks that are read and checked by one task (sequential reads of 64 MiB)
+BLOCKS_PER_TASK = 8
+READ_SIZE = 8 * 1024 * 1024
+
+RESULT_OK = 'ok'
+RESULT_CORRUPTED = 'corrupted'
+RESULT_MISSING = 'missing'
+RESULT_UNVERIFIED = 'unverified'      # no checksums in the catalog (e.g. rebuilt catalog)
+
+
+class VerifyResult:
+    # result of the verification of one backup file
+
+    def __init__(self, destination: Destination, record: BackupRecord, backup_file: str):
+        self.destination: Destination = destination
+        self.record: BackupRecord = record
+        self.backup_file: str = backup_file
+        self.status: str = RESULT_OK
+        self.errors: list[str] = []
+        self.bytes_checked: int = 0
+        self.futures: list[Future] = []
+
+    def add_error(self, status: str, error: str) -> None:
+        if self.status != RESULT_MISSING:
+            self.status = status
+        self.errors.append(error)
+
+
+def _drop_cache(fd: typing.Optional[int], offset: int, length: int) -> None:
+    # the data should come from the disk, not from the page cache (e.g. a backup
+    # that was just written); afterwards the cache is not filled with backup data
+    if (fd is not None) and hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def _open(filepath: str, backend: DestinationBackend = None) -> tuple[typing.BinaryIO, typing.Optional[int]]:
+    # the file and its descriptor (None: the file is read from a backend, there is no page cache to bypass)
+    if backend is not None:
+        return backend.open_file(filepath), None
+    f = open(filepath, 'rb', buffering=0)
+    return f, f.fileno()
+
+
+def check_blocks(filepath: str, block_size: int, checksums: dict[int, str], backend: DestinationBackend = None) -> tuple[list[str], int]:
+    # Hashes the given blocks of the file. Returns the errors (one per corrupted
+    # block) and the number of bytes read.
+    errors: list[str] = []
+    bytes_read = 0
+    buffer = bytearray(min(block_size, READ_SIZE))
+    f, fd = _open(filepath, backend)
+    with f:
+        for index in sorted(checksums):
+            _drop_cache(fd, index * block_size, block_size)
+            f.seek(index * block_size)
+            block_hash = new_block_hash()
+            remaining = block_size
+            while remaining > 0:
+                view = memoryview(buffer)[:min(remaining, len(buffer))]
+                count = f.readinto(view)
+                if not count:
+                    break
+                block_hash.update(view[:count])
+                remaining -= count
+                bytes_read += count
+            _drop_cache(fd, index * block_size, block_size)
+            if block_hash.hexdigest() != checksums[index]:
+                errors.append('block {} (offset {}) is corrupted'.format(index, index * block_size))
+    return errors, bytes_read
+
+
+def check_sha256(filepath: str, checksum: str, backend: DestinationBackend = None) -> tuple[list[str], int]:
+    # whole file checksum (backups created before block checksums were stored)
+    sha256 = hashlib.sha256()
+    bytes_read = 0
+    f, fd = _open(filepath, backend)
+    with f:
+        _drop_cache(fd, 0, 0)
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            sha256.update(data)
+            bytes_read += len(data)
+        _drop_cache(fd, 0, 0)
+    return ([] if sha256.hexdigest() == checksum else ['checksum mismatch']), bytes_read
+
+
+def check_chunks(destination_directory: str, chunk_hashes: list[str]) -> tuple[list[str], int]:
+    # chunks are stored under the sha256 of their (uncompressed) content
+    errors: list[str] = []
+    bytes_read = 0
+    for chunk_hash in chunk_hashes:
+        try:
+            with open(get_chunk_file(destination_directory, chunk_hash), 'rb') as f:
+                data = f.read()
+            bytes_read += len(data)
+            if hashlib.sha256(zlib.decompress(data)).hexdigest() != chunk_hash:
+                errors.append('chunk {} is corrupted'.format(chunk_hash))
+        except (OSError, zlib.error) as e:
+            errors.append('chunk {} is missing or corrupted: {}'.format(chunk_hash, e))
+    return errors, bytes_read
+
+
+def select_blocks(count: int, sample: float) -> list[int]:
+    # sample: percentage of the blocks that are checked; the first and the last
+    # block (archive headers, zip central directory) are always checked
+    if (sample >= 100) or (count <= 2):
+        return list(range(count))
+    selected = {0, count - 1}
+    size = max(0, round(count * sample / 100) - len(selected))
+    selected.update(random.sample(range(1, count - 1), min(size, count - 2)))
+    return sorted(selected)
+
+
+class VerifyManager():
+    # Checks the backups stored in the destinations against the checksums of the
+    # catalog - without reading or decompressing the backed up data and without
+    # touching the source file systems.
+    #
+    # Archives are checked in blocks (see archive.CHECKSUM_BLOCK_SIZE) on several
+    # workers with large sequential reads; with --sample only a part of the
+    # blocks is checked. For chunk stores, the chunks referenced by a snapshot are
+    # checked against their hash (sampling works the same way). Destinations with a
+    # backend (see backends) are checked with ranged reads from the storage.
+
+    def __init__(self, args: typing.Union[argparse.Namespace, dict]):
+        self.args = args
+        self.backup_time: str = datetime.datetime.now().strftime("%y%m%d%H%M%S")
+        self.log = LogManager(self.backup_time)
+
+        self.config_filepath: str = get_config_filepath(self.args.config)
+        if not os.path.isfile(self.config_filepath):
+            raise Exception('Config file not found. Please ensure that the file is present:\n{}'.format(self.config_filepath))
+        self.configs = ConfigObject(self.config_filepath, self.log)
+        self.log.configure(self.configs.settings.log_directory, self.configs.settings.log_level)
+
+
+    def _get_destinations(self) -> list[Destination]:
+        if (self.args.destinations is not None) and (len(self.args.destinations) > 0):
+            destinations = []
+            for destination_id in self.args.destinations:
+                destination = self.configs.destinations.get(destination_id.strip())
+                if destination is None:
+                    self.log.log_error('Destination "{}" does not exist in config file {}'.format(destination_id, self.config_filepath))
+                else:
+                    destinations.append(destination)
+            return destinations
+        return [destination for destination in self.configs.destinations.values() if destination.active == True]
+
+
+    def _submit_archive(self, executor: ThreadPoolExecutor, catalog: Catalog, result: VerifyResult, size: int) -> None:
+        record = result.record
+        backend = catalog.backend
+        if (record.size is not None) and (size != record.size):
+            result.add_error(RESULT_CORRUPTED, 'size is {} bytes instead of {} bytes'.format(size, record.size))
+            return
+
+        block_size, checksums = catalog.get_blocks(record.filename)
+        if block_size is not None:
+            if len(checksums) != (size + block_size - 1) // block_size:
+                result.add_error(RESULT_CORRUPTED, 'size does not match the block checksums')
+                return
+            blocks = select_blocks(len(checksums), self.args.sample)
+            for i in range(0, len(blocks), BLOCKS_PER_TASK):
+                task = {index: checksums[index] for index in blocks[i:i + BLOCKS_PER_TASK]}
+                result.futures.append(executor.submit(check_blocks, result.backup_file, block_size, task, backend))
+        elif record.checksum:
+            result.futures.append(executor.submit(check_sha256, result.backup_file, record.checksum, backend))
+        else:
+            # no checksum at all: at least the zip directory is readable
+            result.status = RESULT_UNVERIFIED
+            if get_archive_format(result.backup_file) == FORMAT_ZIP:
+                try:
+                    f, _ = _open(result.backup_file, backend)
+                    with f, zipfile.ZipFile(f) as zip:
+                        zip.infolist()
+                except (OSError, zipfile.BadZipFile) as e:
+                    result.add_error(RESULT_CORRUPTED, str(e))
+
+
+    def _get_size(self, backup_file: str, backend: typing.Optional[DestinationBackend]) -> typing.Optional[int]:
+        # None: the file does not exist
+        if backend is not None:
+            return backend.get_size(backup_file)
+        return os.path.getsize(backup_file) if os.path.isfile(backup_file) else None
+
+
+    def _submit_snapshot(self, executor: ThreadPoolExecutor, destination_directory: str, result: VerifyResult) -> None:
+        try:
+            files = load_snapshot(result.backup_file).get('files', {})
+        except ValueError as e:
+            result.add_error(RESULT_CORRUPTED, 'invalid snapshot: {}'.format(e))
+            return
+        chunk_hashes = sorted({chunk_hash for file_info in files.values() for chunk_hash in file_info['chunks']})
+        chunk_hashes = [chunk_hashes[i] for i in select_blocks(len(chunk_hashes), self.args.sample)]
+        for i in range(0, len(chunk_hashes), BLOCKS_PER_TASK):
+            result.futures.append(executor.submit(check_chunks, destination_directory, chunk_hashes[i:i + BLOCKS_PER_TASK]))
+
+
+    def _collect(self, result: VerifyResult) -> None:
+        for future in result.futures:
+            try:
+                errors, bytes_read = future.result()
+            except OSError as e:
+                result.add_error(RESULT_CORRUPTED, str(e))
+                continue
+            result.bytes_checked += bytes_read
+            for error in errors:
+                result.add_error(RESULT_CORRUPTED, error)
+        result.futures.clear()
+
+
+    def run(self) -> int:
+        profile_id = self.args.profile.strip() if self.args.profile else None
+        workers = self.args.workers if (self.args.workers is not None) and (self.args.workers > 0) else get_default_workers()
+        if (self.args.sample <= 0) or (self.args.sample > 100):
+            self.log.log_error('Invalid sample: {} (percentage of the blocks, 0 < sample <= 100)'.format(self.args.sample))
+            return 1
+
+        results: list[VerifyResult] = []
+        backends: list[DestinationBackend] = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for destination in self._get_destinations():
+                backend = destination.backend.get_backend(destination.directory)
+                if (backend is None) and (not os.path.isdir(destination.directory)):
+                    self.log.log_hint('Destination "{}" is not available: {}'.format(destination.id, destination.directory))
+                    continue
+                if backend is not None:
+                    backends.append(backend)
+                with Catalog(destination.directory, backend) as catalog:
+                    records = catalog.list_backups(profile_id)
+                    self.log.log_hint('Verifying {} backups in destination "{}" ({})...'.format(len(records), destination.id, destination.directory))
+                    for record in records:
+                        result = VerifyResult(destination, record, catalog.get_file(record))
+                        results.append(result)
+                        try:
+                            size = self._get_size(result.backup_file, backend)
+                        except OSError as e:
+                            result.add_error(RESULT_MISSING, str(e))
+                            continue
+                        if size is None:
+                            result.add_error(RESULT_MISSING, 'file not found')
+                        elif record.kind == BACKUP_KIND_SNAPSHOT:
+                            self._submit_snapshot(executor, destination.directory, result)
+                        else:
+                            self._submit_archive(executor, catalog, result, size)
+
+            for result in results:
+                self._collect(result)
+                record = result.record
+                if result.status == RESULT_OK:
+                    self.log.log_hint('[{}]:: OK          {}'.format(record.profile, result.backup_file))
+                elif result.status == RESULT_UNVERIFIED:
+                    self.log.log_warning('[{}]:: No checksums in the catalog, cannot verify {}'.format(record.profile, result.backup_file), profile=record.profile, path=result.backup_file)
+                for error in result.errors:
+                    self.log.log_error('[{}]:: {}: {}'.format(record.profile, result.backup_file, error), profile=record.profile, destination=result.destination.id, path=result.backup_file, status=result.status)
+
+        for backend in backends:
+            backend.close()
+
+        failed = [result for result in results if result.status in (RESULT_CORRUPTED, RESULT_MISSING)]
+        unverified = [result for result in results if result.status == RESULT_UNVERIFIED]
+        bytes_checked = sum(result.bytes_checked for result in results)
+        self.log.log_hint('Verification completed: {} backups, {} failed, {} without checksums ({:.1f} MB read{}).'.format(
+            len(results), len(failed), len(unverified), bytes_checked / (1024 * 1024), ', {}% sample'.format(self.args.sample) if self.args.sample < 100 else ''))
+        self.log.flush()
+        return 0 if len(failed) == 0 else 1
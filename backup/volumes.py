@@ -0,0 +1,168 @@
+import os
+import json
+import typing
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from .compression import CompressionPolicy, FORMAT_ZIP, get_archive_extension
+from .scanner import ScanEntry, SourceFile
+from .throttle import ThrottleGroup
+from .backends import DestinationBackend
+from .delta import DeltaEncoder
+from .utils import WriteResult, create_zip, create_tar, get_temp_filepath, get_backup_timestamp, remove_backup_file, BACKUP_FILENAME_PREFIX, BACKUP_FILENAME_TIMESTAMP_LENGTH
+
+VOLUME_INDEX_PREFIX = 'volumes'
+VOLUME_INDEX_SUFFIX = '.json'
+VOLUME_NUMBER_PREFIX = '.vol'
+# volumes that are produced at the same time (they share the compression threads)
+VOLUMES_IN_FLIGHT = 2
+
+
+def get_volume_filename(timestamp: str, number: int, format: str) -> str:
+    # archive{backup_datetime}.vol001.zip - parse_backup_time and get_archive_format work as for single archives
+    return BACKUP_FILENAME_PREFIX + timestamp + VOLUME_NUMBER_PREFIX + '{:03d}'.format(number) + get_archive_extension(format)
+
+
+def get_volume_index_filename(timestamp: str) -> str:
+    # volumes{backup_datetime}.json - not picked up as a backup by Catalog.rebuild
+    return VOLUME_INDEX_PREFIX + timestamp + VOLUME_INDEX_SUFFIX
+
+
+def get_volume_index_filepath(backup_file: str) -> typing.Optional[str]:
+    # the index of the set a volume belongs to; None: the backup file is not a volume
+    filename = os.path.basename(backup_file)
+    end_of_timestamp = len(BACKUP_FILENAME_PREFIX) + BACKUP_FILENAME_TIMESTAMP_LENGTH
+    if (not filename.startswith(BACKUP_FILENAME_PREFIX)) or (not filename[end_of_timestamp:].startswith(VOLUME_NUMBER_PREFIX)):
+        return None
+    timestamp = filename[len(BACKUP_FILENAME_PREFIX):end_of_timestamp]
+    return os.path.join(os.path.dirname(backup_file), get_volume_index_filename(timestamp))
+
+
+def load_volume_index(index_file: str) -> dict:
+    with open(index_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_volume_index(index_file: str, index: dict) -> None:
+    # written last and renamed when complete: a set without index is incomplete
+    temp_file = get_temp_filepath(index_file)
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=1)
+    os.replace(temp_file, index_file)
+
+
+def _get_size(file: SourceFile) -> int:
+    if isinstance(file, ScanEntry):
+        return file.size
+    try:
+        return os.path.getsize(file)
+    except OSError:
+        # the file is gone - the archive writer reports it
+        return 0
+
+
+def create_volumes(filepaths: typing.Iterable[SourceFile], destination_directories: list[str], volume_size: int, format: str = FORMAT_ZIP, policy: CompressionPolicy = None, get_deleted_files: typing.Callable[[], list[str]] = None, workers: int = None, backup_info: dict = None, throttle: ThrottleGroup = None, backends: dict[str, DestinationBackend] = None, delta: DeltaEncoder = None, on_skipped: typing.Callable[[str, OSError], None] = None) -> WriteResult:
+    # Creates a set of archives ("volumes") of about volume_size bytes instead of one
+    # archive. Every volume is a complete archive that can be read on its own.
+    #
+    # The files are split by their (uncompressed) size; a file is never split, so a
+    # file larger than volume_size gets a volume of its own. VOLUMES_IN_FLIGHT volumes
+    # are produced at the same time, each one is streamed into all destinations and
+    # gets its final name there as soon as it is complete (see write_to_destinations).
+    # The files deleted since the last backup are stored in the last volume. Finally
+    # the index volumes{backup_datetime}.json that lists the volumes is written.
+    #
+    # Returns a WriteResult of the whole set (backup_files: the index files, size: the
+    # size of all volumes) with the results of the volumes in volumes. A destination
+    # fails if any of the volumes failed there. If the backup is interrupted, the
+    # volumes already written are deleted again - the set is only kept as a whole.
+    # backends: see write_to_destinations; the index is uploaded there as well.
+    # delta: shared by the zip volumes in flight (see delta.DeltaEncoder).
+    # on_skipped: see utils.create_archive; the skipped files are not part of the volumes.
+    from .archive import get_default_workers
+    backends = backends or {}
+    timestamp = get_backup_timestamp(backup_info)
+    # the compression threads are shared by the volumes in flight
+    volume_workers = max(1, (workers if (workers is not None) and (workers > 0) else get_default_workers()) // VOLUMES_IN_FLIGHT)
+    level = policy.level if policy is not None else None
+
+    def write_volume(number: int, volume_files: list[SourceFile], is_last: bool) -> WriteResult:
+        filename = get_volume_filename(timestamp, number, format)
+        info = dict(backup_info or {}, volume=number)
+        deleted_files = get_deleted_files if is_last else None
+        if format == FORMAT_ZIP:
+            result = create_zip(volume_files, destination_directories, deleted_files, volume_workers, policy, info, filename=filename, throttle=throttle, backends=backends, delta=delta, on_skipped=on_skipped)
+        else:
+            result = create_tar(volume_files, destination_directories, format, level, deleted_files, volume_workers, info, filename=filename, throttle=throttle, backends=backends, on_skipped=on_skipped)
+        result.file_count = len(volume_files) - len(result.skipped)
+        return result
+
+    futures: list[Future] = []
+    results: list[WriteResult] = []
+    executor = ThreadPoolExecutor(max_workers=VOLUMES_IN_FLIGHT)
+    try:
+        volume_files: list[SourceFile] = []
+        volume_input = 0
+
+        def submit(is_last: bool) -> None:
+            nonlocal volume_files, volume_input
+            # at most VOLUMES_IN_FLIGHT volumes are buffered (bounded memory)
+            while len(futures) - len(results) >= VOLUMES_IN_FLIGHT:
+                results.append(futures[len(results)].result())
+            futures.append(executor.submit(write_volume, len(futures) + 1, volume_files, is_last))
+            volume_files, volume_input = [], 0
+
+        for file in filepaths:
+            size = _get_size(file)
+            if (len(volume_files) > 0) and (volume_input + size > volume_size):
+                submit(False)
+            volume_files.append(file)
+            volume_input += size
+        # the last volume also holds the deleted files (and is created if there are no files at all)
+        submit(True)
+        while len(results) < len(futures):
+            results.append(futures[len(results)].result())
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future in futures:
+            if future.done() and (not future.cancelled()) and (future.exception() is None):
+                for destination_directory, backup_file in future.result().backup_files.items():
+                    try:
+                        remove_backup_file(backup_file, backends.get(destination_directory))
+                    except OSError:
+                        pass
+        raise
+    executor.shutdown()
+
+    result = WriteResult()
+    result.volumes = results
+    for volume in results:
+        result.size += volume.size
+        result.skipped.update(volume.skipped)
+        for destination_directory, error in volume.errors.items():
+            result.errors.setdefault(destination_directory, error)
+        for destination_directory, seconds in volume.durations.items():
+            result.durations[destination_directory] = result.durations.get(destination_directory, 0) + seconds
+
+    index = dict(backup_info or {}, format=format, volume_size=volume_size, volumes=[
+        {'filename': get_volume_filename(timestamp, number, format), 'size': volume.size, 'sha256': volume.checksum, 'files': volume.file_count}
+        for number, volume in enumerate(results, 1)])
+    for destination_directory in destination_directories:
+        if destination_directory not in result.errors:
+            index_file = os.path.join(destination_directory, get_volume_index_filename(timestamp))
+            try:
+                _write_volume_index(index_file, index)
+                if destination_directory in backends:
+                    backends[destination_directory].upload_file(index_file, index_file)
+                result.backup_files[destination_directory] = index_file
+                continue
+            except OSError as e:
+                result.errors[destination_directory] = e
+        # an incomplete set is of no use
+        for volume in results:
+            backup_file = volume.backup_files.pop(destination_directory, None)
+            if backup_file is not None:
+                try:
+                    remove_backup_file(backup_file, backends.get(destination_directory))
+                except OSError:
+                    pass
+    return result
@@ -0,0 +1,180 @@
+import os
+import time
+import signal
+import typing
+import datetime
+import argparse
+import threading
+
+from .configs import ConfigObject, Profile, get_config_filepath
+from .logmgr import LogManager
+from .manifest import BACKUP_MODE_INCREMENTAL
+from .scanner import IgnoreMatcher
+from .utils import expand_sources
+from .journal import ChangeJournal, InotifyWatcher, PollingWatcher, create_watcher, get_journal_file, get_backup_mark, FLUSH_INTERVAL, HEARTBEAT_INTERVAL
+
+
+class _WatchedProfile:
+
+    def __init__(self, profile: Profile, watcher: typing.Union[InotifyWatcher, PollingWatcher], journal: ChangeJournal):
+        self.profile: Profile = profile
+        self.watcher: typing.Union[InotifyWatcher, PollingWatcher] = watcher
+        self.journal: ChangeJournal = journal
+        self.thread: typing.Optional[threading.Thread] = None
+        self.backup_mark: typing.Optional[float] = None
+
+
+class WatchManager():
+    # Daemon mode ("backup.py watch"): the sources of the incremental profiles are
+    # watched (inotify, or polling where inotify is not available) and the changed
+    # paths are written to a change journal per profile (see journal.ChangeJournal).
+    #
+    # Incremental backups - started by the daemon every --interval seconds or by a
+    # scheduler as usual - read the journal instead of scanning the sources, as long
+    # as the daemon was watching since the last backup. Otherwise they scan.
+
+    def __init__(self, args: typing.Union[argparse.Namespace, dict]):
+        self.args = args
+        self.backup_time: str = datetime.datetime.now().strftime("%y%m%d%H%M%S")
+        self.log = LogManager(self.backup_time)
+
+        self.config_filepath: str = get_config_filepath(self.args.config)
+        if not os.path.isfile(self.config_filepath):
+            raise Exception('Config file not found. Please ensure that the file is present:\n{}'.format(self.config_filepath))
+        self.configs = ConfigObject(self.config_filepath, self.log)
+        self.log.configure(self.configs.settings.log_directory, self.configs.settings.log_level)
+
+        self._stop = threading.Event()
+
+
+    def _get_profiles(self) -> list[Profile]:
+        # only incremental backups use the journal
+        if (self.args.profile is not None) and (self.args.profile != ''):
+            profile = self.configs.profiles.get(self.args.profile.strip())
+            if profile is None:
+                self.log.log_error('Profile "{}" does not exist in config file {}'.format(self.args.profile, self.config_filepath))
+                return []
+            profiles = [profile]
+        else:
+            profiles = [profile for profile in self.configs.profiles.values() if profile.active == True]
+        for profile in profiles:
+            if profile.mode != BACKUP_MODE_INCREMENTAL:
+                self.log.log_hint('[{}]:: Not watched: the change journal is only used by incremental backups.'.format(profile.id))
+        return [profile for profile in profiles if profile.mode == BACKUP_MODE_INCREMENTAL]
+
+
+    def _start(self, profile: Profile) -> typing.Optional[_WatchedProfile]:
+        directories, files = expand_sources(profile.source)
+        matcher = IgnoreMatcher(profile.ignore)
+        watcher = create_watcher(list(directories.values()), list(files.values()), matcher, self.args.poll, self.args.poll_interval)
+        try:
+            watcher.start()
+        except OSError as e:
+            # e.g. the limit of inotify watches is reached (fs.inotify.max_user_watches)
+            self.log.log_warning('[{}]:: Cannot watch the sources with inotify ({}), polling every {} seconds instead.'.format(profile.id, e, self.args.poll_interval))
+            watcher = PollingWatcher(list(directories.values()), list(files.values()), matcher, self.args.poll_interval)
+            watcher.start()
+        # all changes after this point are recorded
+        journal = ChangeJournal(get_journal_file(self.configs.settings.journal_directory, profile.id), profile.id, profile.source, profile.ignore)
+        try:
+            journal.start(time.time())
+        except OSError as e:
+            self.log.log_error('[{}]:: Cannot write the change journal {}: {}'.format(profile.id, journal.journal_file, e), profile=profile.id)
+            watcher.close()
+            return None
+        kind = 'inotify' if isinstance(watcher, InotifyWatcher) else 'polling'
+        self.log.log_hint('[{}]:: Watching {} source directories and {} files ({}), journal: {}'.format(profile.id, len(directories), len(files), kind, journal.journal_file))
+        return _WatchedProfile(profile, watcher, journal)
+
+
+    def _watch(self, watched: _WatchedProfile) -> None:
+        # thread per profile: collects the changes and writes them in batches
+        profile_id = watched.profile.id
+        last_flush = last_heartbeat = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                changes = watched.watcher.read(FLUSH_INTERVAL)
+                if changes.overflow:
+                    self.log.log_warning('[{}]:: Changes were lost (inotify queue overflow) - the next backup scans the sources.'.format(profile_id))
+                    watched.watcher.close()
+                    watched.watcher.start()
+                    watched.journal.start(time.time())
+                    continue
+                watched.journal.add(changes.paths)
+                now = time.monotonic()
+                if now - last_flush >= FLUSH_INTERVAL:
+                    watched.journal.flush()
+                    last_flush = now
+                if now - last_heartbeat >= HEARTBEAT_INTERVAL:
+                    watched.journal.touch()
+                    last_heartbeat = now
+        except Exception as e:
+            # a journal that misses changes must not be used
+            self.log.log_error('[{}]:: Watching failed: {}'.format(profile_id, e), profile=profile_id)
+            watched.journal.close()
+
+
+    def _compact(self, watched: _WatchedProfile) -> None:
+        # the changes before the last backup are in its manifest
+        backup_mark = get_backup_mark(watched.journal.journal_file)
+        if (backup_mark is None) or (backup_mark == watched.backup_mark):
+            return
+        try:
+            remaining = watched.journal.compact(backup_mark)
+            watched.backup_mark = backup_mark
+            self.log.log_debug('[{}]:: Journal compacted: {} batches since the last backup.'.format(watched.profile.id, remaining))
+        except OSError as e:
+            self.log.log_error('[{}]:: Cannot compact the journal: {}'.format(watched.profile.id, e), profile=watched.profile.id)
+
+
+    def _run_backup(self) -> None:
+        from .backupmgr import BackupManager
+        args = argparse.Namespace(dryrun=False, profile=self.args.profile, destinations=self.args.destinations, workers=self.args.workers, list=False,
+                                  config=self.args.config, profile_run=False, resume=False, scan=False)
+        try:
+            BackupManager(args).run()
+        except Exception as e:
+            self.log.log_error('Scheduled backup failed: {}'.format(e))
+
+
+    def run(self) -> int:
+        profiles = self._get_profiles()
+        if len(profiles) == 0:
+            self.log.log_hint('No active incremental profiles to watch.')
+            return 1
+
+        watched_profiles: list[_WatchedProfile] = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stop.set())
+        try:
+            for profile in profiles:
+                watched = self._start(profile)
+                if watched is None:
+                    continue
+                watched.thread = threading.Thread(target=self._watch, args=(watched,), name='watch-{}'.format(profile.id), daemon=True)
+                watched.thread.start()
+                watched_profiles.append(watched)
+
+            if len(watched_profiles) == 0:
+                return 1
+            interval = self.args.interval if (self.args.interval is not None) and (self.args.interval > 0) else None
+            next_backup = time.monotonic() + interval if interval is not None else None
+            while (not self._stop.is_set()) and any(watched.thread.is_alive() for watched in watched_profiles):
+                self._stop.wait(min(HEARTBEAT_INTERVAL, max(0, next_backup - time.monotonic())) if next_backup is not None else HEARTBEAT_INTERVAL)
+                if self._stop.is_set():
+                    break
+                if (next_backup is not None) and (time.monotonic() >= next_backup):
+                    self._run_backup()
+                    next_backup = time.monotonic() + interval
+                for watched in watched_profiles:
+                    self._compact(watched)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.set()
+            for watched in watched_profiles:
+                watched.thread.join()
+                watched.watcher.close()
+                watched.journal.close()
+            self.log.log_hint('Watching stopped.')
+            self.log.flush()
+        return 0
@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import time
+
+import pytest
+
+# the tests import the backup package from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def write_config(directory, profiles: list[dict], destinations: list[dict], settings: dict = None) -> str:
+    # config file of a test run; reports and logs are written below directory
+    config = {
+        'backup_profiles': [dict({'active': True, 'ignore': []}, **profile) for profile in profiles],
+        'backup_destinations': [dict({'active': True, 'days_to_keep': -1}, **destination) for destination in destinations],
+        'settings': dict({'report_directory': os.path.join(str(directory), 'reports'), 'log_directory': os.path.join(str(directory), 'logs')},
+                         **(settings or {})),
+    }
+    config_file = os.path.join(str(directory), 'config.json')
+    with open(config_file, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+    return config_file
+
+
+def run_cli(config_file: str, *args: str) -> int:
+    # runs the command line interface (backup, restore, verify) in the test process
+    from backup.cli import main
+    argv = sys.argv
+    sys.argv = ['backup.py', '-c', config_file] + list(args)
+    try:
+        return main()
+    finally:
+        sys.argv = argv
+
+
+def next_second() -> None:
+    # backups are named after their start time (seconds)
+    start = int(time.time())
+    while int(time.time()) == start:
+        time.sleep(0.05)
+
+
+def read_tree(directory) -> dict[str, bytes]:
+    # relative path -> content of all files below directory
+    tree: dict[str, bytes] = {}
+    for root, _, files in os.walk(str(directory)):
+        for name in files:
+            filepath = os.path.join(root, name)
+            with open(filepath, 'rb') as f:
+                tree[os.path.relpath(filepath, str(directory))] = f.read()
+    return tree
+
+
+@pytest.fixture
+def source(tmp_path):
+    # a small source tree: text, random data, an empty file and a nested directory
+    root = tmp_path / 'source'
+    (root / 'docs' / 'nested').mkdir(parents=True)
+    (root / 'docs' / 'a.txt').write_text('hello world\n' * 100)
+    (root / 'docs' / 'nested' / 'b.bin').write_bytes(os.urandom(300 * 1024))
+    (root / 'docs' / 'empty').write_bytes(b'')
+    (root / 'c.log').write_text('log line\n' * 5000)
+    return root
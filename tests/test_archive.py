@@ -0,0 +1,109 @@
+import os
+import random
+import tarfile
+import zipfile
+
+import pytest
+
+from backup.archive import ParallelZipWriter, COMPRESSION_BLOCK_SIZE
+from backup.compression import CompressionPolicy, FORMAT_TAR_GZ, CODEC_DEFLATE, CODEC_LZMA
+from backup.utils import create_archive, scan_files, write_to_destinations, get_temp_filepath
+from backup.volumes import get_volume_index_filename
+
+BACKUP_TIME = '20200101120000'
+
+
+def test_archive_is_named_after_the_backup_start(tmp_path, source):
+    for format, volume_size in (('zip', 0), (FORMAT_TAR_GZ, 0), ('zip', 200 * 1024)):
+        destination = tmp_path / '{}-{}'.format(format, volume_size)
+        destination.mkdir()
+        result = create_archive(scan_files([str(source)]), [str(destination)], format, workers=2, volume_size=volume_size,
+                                backup_info={'profile': 'p', 'backup_time': BACKUP_TIME, 'mode': 'full'})
+        assert len(result.errors) == 0
+        names = sorted(os.listdir(str(destination)))
+        assert all(name.startswith('archive' + BACKUP_TIME) for name in names if name.startswith('archive'))
+        if volume_size > 0:
+            assert len(result.volumes) > 1
+            assert get_volume_index_filename(BACKUP_TIME) in names
+
+
+@pytest.mark.parametrize('format, volume_size', [('zip', 0), (FORMAT_TAR_GZ, 0), ('zip', 1024 * 1024)], ids=['zip', 'tar.gz', 'volumes'])
+def test_vanished_files_are_skipped(tmp_path, source, format, volume_size):
+    (source / 'large.bin').write_bytes(os.urandom(3 * COMPRESSION_BLOCK_SIZE))
+    files = scan_files([str(source)])
+    # a small (read ahead) and a large file vanish after the scan
+    vanished = sorted([str(source / 'docs' / 'a.txt'), str(source / 'large.bin')])
+    for filepath in vanished:
+        os.remove(filepath)
+    destination = tmp_path / 'destination'
+    reported = []
+    result = create_archive(iter(files), [str(destination)], format, workers=2, volume_size=volume_size,
+                            backup_info={'profile': 'p', 'backup_time': BACKUP_TIME, 'mode': 'full'}, on_skipped=lambda filepath, error: reported.append(filepath))
+    assert len(result.errors) == 0
+    assert sorted(result.skipped) == sorted(reported) == vanished
+    assert all(isinstance(error, FileNotFoundError) for error in result.skipped.values())
+    if volume_size > 0:
+        assert sum(volume.file_count for volume in result.volumes) == len(files) - 2
+    else:
+        with zipfile.ZipFile(result.backup_files[str(destination)]) if format == 'zip' else tarfile.open(result.backup_files[str(destination)]) as archive:
+            names = archive.namelist() if format == 'zip' else archive.getnames()
+        assert sorted(name for name in names if not name.startswith('.backup')) == sorted(file.path.lstrip(os.sep) for file in files if file.path not in vanished)
+
+
+@pytest.fixture
+def mixed_files(tmp_path) -> list[str]:
+    # small files (batched), large files (split into blocks), random data, an empty file
+    directory = tmp_path / 'files'
+    directory.mkdir()
+    rng = random.Random(1)
+    for i in range(150):
+        (directory / 'small{:03d}.txt'.format(i)).write_text('line {}\n'.format(i) * rng.randrange(1, 2000))
+    (directory / 'large.txt').write_bytes(b''.join(b'%d,%d\n' % (i, i * i) for i in range(200000)))
+    (directory / 'random.bin').write_bytes(rng.randbytes(2 * COMPRESSION_BLOCK_SIZE + 5))
+    (directory / 'photo.jpg').write_bytes(b'jpeg' * 1000)
+    (directory / 'empty').write_bytes(b'')
+    return sorted(os.path.join(str(directory), name) for name in os.listdir(str(directory)))
+
+
+@pytest.mark.parametrize('codec', [CODEC_DEFLATE, CODEC_LZMA])
+def test_parallel_zip_writer_output(tmp_path, mixed_files, codec):
+    archive_file = str(tmp_path / 'archive.zip')
+    with ParallelZipWriter(archive_file, workers=4, policy=CompressionPolicy(codec, level=1)) as writer:
+        writer.write_files(scan_files([os.path.dirname(mixed_files[0])]))
+        writer.writestr('info.json', '{}')
+
+    with zipfile.ZipFile(archive_file) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist()[-1] == 'info.json'
+        assert sorted(archive.namelist()[:-1]) == sorted(filepath.lstrip(os.sep) for filepath in mixed_files)
+        for filepath in mixed_files:
+            with open(filepath, 'rb') as f:
+                assert archive.read(filepath.lstrip(os.sep)) == f.read()
+        compress_types = {os.path.basename(info.filename): info.compress_type for info in archive.infolist()}
+        large = next(info for info in archive.infolist() if info.filename.endswith('large.txt'))
+        assert large.compress_size < large.file_size / 2
+    expected = zipfile.ZIP_LZMA if codec == CODEC_LZMA else zipfile.ZIP_DEFLATED
+    assert compress_types['large.txt'] == compress_types['small000.txt'] == expected
+    # already compressed data is stored
+    assert compress_types['random.bin'] == compress_types['photo.jpg'] == zipfile.ZIP_STORED
+
+
+def test_lost_temporary_file_does_not_hide_the_error(tmp_path):
+    destination = str(tmp_path / 'destination')
+
+    def fail(fileobj):
+        fileobj.write(b'data')
+        os.remove(get_temp_filepath(os.path.join(destination, 'backup.bin')))
+        raise ValueError('write failed')
+
+    # the original error, not the one of the clean-up
+    with pytest.raises(ValueError):
+        write_to_destinations('backup.bin', [destination], fail)
+
+    def lose_file(fileobj):
+        fileobj.write(b'data')
+        os.remove(get_temp_filepath(os.path.join(destination, 'backup.bin')))
+
+    result = write_to_destinations('backup.bin', [destination], lose_file)
+    assert result.backup_files == {}
+    assert isinstance(result.errors[destination], FileNotFoundError)
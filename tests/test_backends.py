@@ -0,0 +1,136 @@
+import os
+import zipfile
+from datetime import datetime, timedelta
+
+import pytest
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from backup.backends import S3Backend, MIB, MIN_PART_SIZE_MB
+from backup.catalog import Catalog, BackupRecord, BACKUP_KIND_ARCHIVE
+from backup.manifest import BACKUP_MODE_FULL
+from backup.utils import create_zip, cleanup_destination, BACKUP_FILENAME_FORMAT_DATETIMESTAMP
+
+BUCKET = 'backups'
+PREFIX = 'host1/'
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        backend = S3Backend(str(tmp_path / 'destination'), BUCKET, PREFIX, region='us-east-1', part_size=MIN_PART_SIZE_MB * MIB, max_connections=4)
+        backend.client.create_bucket(Bucket=BUCKET)
+        os.makedirs(backend.directory)
+        yield backend
+        backend.close()
+
+
+def _put(backend: S3Backend, key: str, data: bytes = b'data') -> None:
+    backend.client.put_object(Bucket=BUCKET, Key=key, Body=data)
+
+
+def _keys(backend: S3Backend) -> set[str]:
+    return {item['Key'] for page in backend.client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET) for item in page.get('Contents', [])}
+
+
+def _backup_file(backend: S3Backend, profile: str, backup_time: datetime) -> str:
+    return os.path.join(backend.directory, 'BACKUP_' + profile, 'archive{}.zip'.format(backup_time.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)))
+
+
+def test_multipart_upload_and_ranged_reads(backend):
+    data = os.urandom(12 * MIB + 12345)
+    filepath = _backup_file(backend, 'p', datetime(2025, 1, 1))
+    os.makedirs(os.path.dirname(filepath))
+    upload = backend.open_upload(filepath)
+    for i in range(0, len(data), MIB // 3):
+        upload.write(data[i:i + MIB // 3])
+    upload.complete()
+    upload.close()
+
+    parts = backend.client.head_object(Bucket=BUCKET, Key=backend.get_key(filepath), PartNumber=1)
+    assert parts['PartsCount'] == 3
+    assert backend.get_size(filepath) == len(data)
+    with backend.open_file(filepath) as f:
+        f.seek(5 * MIB - 10)
+        assert f.read(20) == data[5 * MIB - 10:5 * MIB + 10]
+        f.seek(0)
+        assert f.read() == data
+    # the upload state is removed with the completed upload
+    assert os.listdir(os.path.dirname(filepath)) == []
+
+
+def test_create_zip_streams_into_the_backend(backend, tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    contents = {'a.txt': b'hello', 'b.bin': os.urandom(7 * MIB)}
+    for name, data in contents.items():
+        (source / name).write_bytes(data)
+    destination_path = os.path.join(backend.directory, 'BACKUP_p')
+
+    result = create_zip([str(source / name) for name in contents], [destination_path], backends={destination_path: backend})
+
+    assert result.errors == {}
+    backup_file = result.backup_files[destination_path]
+    assert not os.path.exists(backup_file)
+    with backend.open_file(backup_file) as f, zipfile.ZipFile(f) as zip:
+        for name, data in contents.items():
+            member = [info for info in zip.infolist() if info.filename.endswith('/' + name)][0]
+            assert zip.read(member) == data
+
+
+def test_list_files_only_lists_the_prefix(backend):
+    _put(backend, PREFIX + 'BACKUP_p/archive20250101000000.zip')
+    _put(backend, PREFIX + 'photos/archive20200101000000.jpg')
+    _put(backend, 'other/BACKUP_p/archive20250101000000.zip')
+
+    listed = {backend.get_relpath(filepath) for filepath, _ in backend.list_files()}
+    assert listed == {'BACKUP_p/archive20250101000000.zip', 'photos/archive20200101000000.jpg'}
+    listed = {backend.get_relpath(filepath) for filepath, _ in backend.list_files('BACKUP_')}
+    assert listed == {'BACKUP_p/archive20250101000000.zip'}
+
+
+def test_retention_keeps_unrelated_objects(backend):
+    now = datetime.now().replace(microsecond=0)
+    old = now - timedelta(days=30)
+    old_file = _backup_file(backend, 'p', old)
+    new_file = _backup_file(backend, 'p', now)
+    _put(backend, backend.get_key(old_file))
+    _put(backend, backend.get_key(new_file))
+    with Catalog(backend.directory, backend) as catalog:
+        for backup_file, backup_time in ((old_file, old), (new_file, now)):
+            catalog.add_backup(BackupRecord('p', backup_time.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP), os.path.relpath(backup_file, backend.directory),
+                                            BACKUP_KIND_ARCHIVE, 4, 1, None, BACKUP_MODE_FULL))
+    # objects outside the backup folders share the bucket and prefix
+    _put(backend, PREFIX + 'photos/archive20200101000000.jpg')
+    _put(backend, PREFIX + 'archive20200101000000.zip')
+    # an upload that was interrupted long ago
+    backend.client.create_multipart_upload(Bucket=BUCKET, Key=PREFIX + 'photos/upload.bin')
+
+    cleanup_destination(backend.directory, 1, backend)
+
+    assert _keys(backend) == {backend.get_key(new_file), PREFIX + 'photos/archive20200101000000.jpg', PREFIX + 'archive20200101000000.zip'}
+    uploads = backend.client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', [])
+    assert [upload['Key'] for upload in uploads] == [PREFIX + 'photos/upload.bin']
+    with Catalog(backend.directory, backend) as catalog:
+        assert [record.filename for record in catalog.list_backups('p')] == [os.path.relpath(new_file, backend.directory)]
+
+
+def test_retention_deletes_what_the_catalog_lists(backend):
+    now = datetime.now().replace(microsecond=0)
+    old = now - timedelta(days=30)
+    old_file = _backup_file(backend, 'p', old)
+    _put(backend, backend.get_key(old_file))
+    with Catalog(backend.directory, backend) as catalog:
+        # registered by a run, but already gone from the storage
+        catalog.add_backup(BackupRecord('q', old.strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP), os.path.join('BACKUP_q', 'archive.zip'),
+                                        BACKUP_KIND_ARCHIVE, 1, 1, None, BACKUP_MODE_FULL))
+
+    cleanup_destination(backend.directory, 1, backend)
+
+    assert _keys(backend) == set()
+    with Catalog(backend.directory, backend) as catalog:
+        assert catalog.list_backups() == []
@@ -0,0 +1,104 @@
+import os
+import sqlite3
+
+from backup import catalog as catalog_module
+from backup.catalog import Catalog, BackupRecord, FileRecord, FileIndexStage, CATALOG_FILENAME, CATALOG_VERSION, BACKUP_KIND_ARCHIVE
+from backup.manifest import BACKUP_MODE_FULL
+
+# schema of the first catalog version (no user_version, no file index)
+_V1_SCHEMA = '''CREATE TABLE backups (
+    id INTEGER PRIMARY KEY,
+    profile TEXT NOT NULL,
+    backup_time TEXT NOT NULL,
+    filename TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    size INTEGER,
+    file_count INTEGER,
+    checksum TEXT
+)'''
+
+# file index before delta files (catalog version 3)
+_V3_FILES = '''CREATE TABLE files (
+    backup_id INTEGER NOT NULL REFERENCES backups (id) ON DELETE CASCADE,
+    arcname TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    deleted INTEGER NOT NULL DEFAULT 0
+)'''
+
+FILENAME = 'BACKUP_p/archive20200101120000.zip'
+
+
+def _create_catalog(directory, statements: list[str], version: int = 0) -> None:
+    connection = sqlite3.connect(str(directory / CATALOG_FILENAME))
+    for statement in statements:
+        connection.execute(statement)
+    connection.execute("INSERT INTO backups (profile, backup_time, filename, kind, size, file_count, checksum) VALUES ('p', '20200101120000', ?, 'archive', 7, 1, 'abc')",
+                       (FILENAME,))
+    connection.execute('PRAGMA user_version = {}'.format(version))
+    connection.commit()
+    connection.close()
+
+
+def _get_version(directory) -> int:
+    connection = sqlite3.connect(str(directory / CATALOG_FILENAME))
+    try:
+        return connection.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def test_migration_from_the_first_version(tmp_path):
+    _create_catalog(tmp_path, [_V1_SCHEMA])
+
+    with Catalog(str(tmp_path)) as catalog:
+        # the backups are kept (of unknown mode, not indexed yet) ...
+        assert catalog.list_backups() == [BackupRecord('p', '20200101120000', FILENAME, BACKUP_KIND_ARCHIVE, 7, 1, 'abc', None)]
+        assert not catalog.is_indexed(FILENAME)
+        assert catalog.get_blocks(FILENAME) == (None, [])
+        # ... and the tables added later are usable
+        catalog.set_mode(FILENAME, BACKUP_MODE_FULL)
+        catalog.add_files(FILENAME, [FileRecord('a.txt', 1, 2), FileRecord('b.bin', 3, 4, delta=True)])
+        catalog.add_blocks(FILENAME, 1024, ['x', 'y'])
+        assert catalog.find_files(FILENAME, ['b.bin']) == [FileRecord('b.bin', 3, 4, False, True)]
+        assert catalog.get_blocks(FILENAME) == (1024, ['x', 'y'])
+        assert catalog.get_latest_backup('p').mode == BACKUP_MODE_FULL
+    assert _get_version(tmp_path) == CATALOG_VERSION
+
+
+def test_migration_adds_the_delta_column(tmp_path):
+    v3_backups = _V1_SCHEMA.replace('checksum TEXT', 'checksum TEXT, mode TEXT, indexed INTEGER NOT NULL DEFAULT 0, block_size INTEGER')
+    _create_catalog(tmp_path, [v3_backups, _V3_FILES], 3)
+    connection = sqlite3.connect(str(tmp_path / CATALOG_FILENAME))
+    connection.execute("INSERT INTO files (backup_id, arcname, size, mtime_ns) VALUES (1, 'a.txt', 1, 2)")
+    connection.commit()
+    connection.close()
+
+    with Catalog(str(tmp_path)) as catalog:
+        assert catalog.find_files(FILENAME, []) == [FileRecord('a.txt', 1, 2, False, False)]
+    assert _get_version(tmp_path) == CATALOG_VERSION
+    # opening a current catalog again does not migrate it twice
+    with Catalog(str(tmp_path)) as catalog:
+        assert len(catalog.list_backups()) == 1
+
+
+def test_file_index_stage(tmp_path, monkeypatch):
+    # small batches: the files are written while they are added
+    monkeypatch.setattr(catalog_module, 'FILE_INDEX_BATCH_SIZE', 3)
+    missing = tmp_path / 'file' / 'missing'
+    (tmp_path / 'file').write_text('not a directory')
+    with FileIndexStage([str(missing), str(tmp_path / 'BACKUP_p')]) as stage:
+        assert os.path.dirname(stage.filepath) == str(tmp_path / 'BACKUP_p')
+        for i in range(10):
+            stage.add(FileRecord('f{}'.format(i), i, i))
+        stage.remove(['f3'])
+        stage.set_delta(['f8'])
+        stage.add(FileRecord('gone', None, None, True))
+        assert [f.arcname for f in stage.iter_files(0, 5)] == ['f0', 'f1', 'f2', 'f4']
+        assert list(stage.iter_files(8)) == [FileRecord('f8', 8, 8, False, True), FileRecord('f9', 9, 9), FileRecord('gone', None, None, True)]
+
+        with Catalog(str(tmp_path)) as catalog:
+            catalog.add_backup(BackupRecord('p', '20200101120000', FILENAME, BACKUP_KIND_ARCHIVE, 7, 9, 'abc', BACKUP_MODE_FULL))
+            catalog.add_files(FILENAME, stage.iter_files())
+            assert len(catalog.find_files(FILENAME, [])) == 10
+    assert not os.path.exists(stage.filepath)
@@ -0,0 +1,95 @@
+import os
+import zipfile
+
+import pytest
+
+from backup.checkpoint import CheckpointWriter, find_checkpoint, CHECKPOINT_SUFFIX
+
+from conftest import write_config, run_cli, next_second, read_tree
+
+INTERRUPT_AFTER = 8
+
+
+@pytest.fixture
+def interrupted(tmp_path, monkeypatch):
+    # a zip backup that was interrupted after INTERRUPT_AFTER files (checkpoint after every file)
+    source = tmp_path / 'source'
+    source.mkdir()
+    for i in range(30):
+        (source / 'file{:02d}.bin'.format(i)).write_bytes(os.urandom(100 * 1024))
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': [str(source) + '/']}], [{'id': 'd', 'directory': str(destination)}],
+                          {'checkpoint_interval': 0.000001})
+
+    add_member = CheckpointWriter.add_member
+    members = []
+
+    def interrupt(self, *args):
+        add_member(self, *args)
+        members.append(args[0].filename)
+        if len(members) == INTERRUPT_AFTER:
+            raise KeyboardInterrupt()
+
+    with monkeypatch.context() as context:
+        context.setattr(CheckpointWriter, 'add_member', interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            run_cli(config)
+    return config, source, destination / 'BACKUP_p'
+
+
+def _leftovers(backup_dir) -> list[str]:
+    return [name for name in os.listdir(str(backup_dir)) if name.endswith(CHECKPOINT_SUFFIX) or name.endswith('.part')]
+
+
+def _members(archive_file) -> list[str]:
+    # the archived files (without the backup info)
+    with zipfile.ZipFile(str(archive_file)) as archive:
+        assert archive.testzip() is None
+        return [name for name in archive.namelist() if name.endswith('.bin')]
+
+
+def test_interrupted_backup_is_resumed(tmp_path, interrupted):
+    config, source, backup_dir = interrupted
+    checkpoint = find_checkpoint([str(backup_dir)])
+    assert checkpoint is not None
+    assert len(checkpoint.members) == INTERRUPT_AFTER
+    assert not any(name.startswith('archive') for name in os.listdir(str(backup_dir)))
+
+    assert run_cli(config, '--resume') == 0
+
+    assert _leftovers(backup_dir) == []
+    # the archive of the interrupted run is completed: every file once, all intact
+    archives = [name for name in os.listdir(str(backup_dir)) if name.startswith('archive')]
+    assert archives == [checkpoint.filename]
+    names = _members(backup_dir / checkpoint.filename)
+    assert len(names) == len(set(names)) == 30
+    target = tmp_path / 'restored'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(target)) == 0
+    assert read_tree(os.path.join(str(target), str(source).lstrip(os.sep))) == read_tree(source)
+
+
+def test_changed_files_are_archived_again(tmp_path, interrupted):
+    config, source, backup_dir = interrupted
+    checkpoint = find_checkpoint([str(backup_dir)])
+    changed = sorted(checkpoint.members)[0]
+    with open(os.sep + changed, 'wb') as f:
+        f.write(b'changed after the interruption')
+
+    assert run_cli(config, '--resume') == 0
+
+    assert len(_members(backup_dir / checkpoint.filename)) == 30
+    with zipfile.ZipFile(str(backup_dir / checkpoint.filename)) as archive:
+        assert archive.read(changed) == b'changed after the interruption'
+
+
+def test_interrupted_backup_is_discarded_without_resume(interrupted):
+    config, _, backup_dir = interrupted
+    checkpoint = find_checkpoint([str(backup_dir)])
+    next_second()
+
+    assert run_cli(config) == 0
+
+    assert _leftovers(backup_dir) == []
+    archives = [name for name in os.listdir(str(backup_dir)) if name.startswith('archive')]
+    assert len(archives) == 1
+    assert archives != [checkpoint.filename]
@@ -0,0 +1,182 @@
+import io
+import os
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from backup import chunkstore
+
+from backup.catalog import Catalog, BackupRecord, BACKUP_KIND_SNAPSHOT
+from backup.chunkstore import (CHUNK_DIRECTORY, CHUNK_MAX_SIZE, CHUNK_MIN_SIZE, iter_chunks, read_chunk, store_snapshot, load_snapshot,
+                               cleanup_chunk_store)
+from backup.manifest import BACKUP_MODE_FULL
+from backup.scanner import get_scan_entry
+from backup.utils import BACKUP_FILENAME_FORMAT_DATETIMESTAMP
+
+
+class _Log:
+    def __init__(self):
+        self.errors: list[str] = []
+
+    def log_error(self, message: str, **kwargs) -> None:
+        self.errors.append(message)
+
+
+def _random_bytes(size: int, seed: int) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+
+def _entries(*paths) -> list:
+    return [get_scan_entry(str(path), os.stat(str(path))) for path in paths]
+
+
+def _chunk_files(destination) -> set[str]:
+    return {name for _, _, files in os.walk(os.path.join(str(destination), CHUNK_DIRECTORY)) for name in files}
+
+
+def test_chunks_respect_the_size_limits():
+    data = _random_bytes(20 * 1024 * 1024, 1)
+    chunks = list(iter_chunks(io.BytesIO(data)))
+    assert b''.join(chunks) == data
+    assert all(CHUNK_MIN_SIZE <= len(chunk) <= CHUNK_MAX_SIZE for chunk in chunks[:-1])
+    # content defined boundaries, not only cuts at the maximum size
+    assert any(len(chunk) < CHUNK_MAX_SIZE for chunk in chunks[:-1])
+
+
+def test_uniform_data_is_cut_at_the_maximum_size():
+    chunks = list(iter_chunks(io.BytesIO(bytes(CHUNK_MAX_SIZE * 2 + 10))))
+    assert [len(chunk) for chunk in chunks] == [CHUNK_MAX_SIZE, CHUNK_MAX_SIZE, 10]
+
+
+def test_insertion_shifts_only_the_first_chunks():
+    data = _random_bytes(16 * 1024 * 1024, 2)
+    chunks = list(iter_chunks(io.BytesIO(data)))
+    shifted = list(iter_chunks(io.BytesIO(b'inserted at the beginning' + data)))
+    assert b''.join(shifted[1:]).endswith(data[-1024:])
+    # all but the first chunks are the same again
+    assert len(set(chunks) & set(shifted)) >= len(chunks) - 2
+
+
+def test_snapshot_round_trip(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    files = []
+    for i in range(12):
+        path = source / 'file{}.bin'.format(i)
+        path.write_bytes(_random_bytes(i * 300 * 1024 + 1, 10 + i))
+        files.append(path)
+    destination = tmp_path / 'destination'
+    destination.mkdir()
+
+    log = _Log()
+    [(snapshot_file, count)] = store_snapshot(_entries(*files), [str(destination)], 'p', '20240101000000', log, workers=4)
+
+    assert count == len(files)
+    assert len(log.errors) == 0
+    snapshot = load_snapshot(snapshot_file)
+    # the index keeps the order of the files, even though they are chunked in parallel
+    assert list(snapshot['files']) == [str(path) for path in files]
+    for path in files:
+        data = b''.join(read_chunk(str(destination), chunk_hash) for chunk_hash in snapshot['files'][str(path)]['chunks'])
+        assert data == path.read_bytes()
+
+
+def test_missing_file_is_reported(tmp_path):
+    source = tmp_path / 'a.bin'
+    source.write_bytes(b'data')
+    entries = _entries(source)
+    os.remove(str(source))
+    log = _Log()
+
+    [(_, count)] = store_snapshot(entries, [str(tmp_path / 'destination')], 'p', '20240101000000', log)
+
+    assert count == 0
+    assert len(log.errors) == 1
+
+
+def test_unchanged_files_are_not_read_again(tmp_path, monkeypatch):
+    source = tmp_path / 'a.bin'
+    source.write_bytes(_random_bytes(1024 * 1024, 3))
+    destination = str(tmp_path / 'destination')
+    store_snapshot(_entries(source), [destination], 'p', '20240101000000', _Log())
+    monkeypatch.setattr(chunkstore, '_store_file', lambda *args: pytest.fail('unchanged file was read'))
+
+    [(snapshot_file, count)] = store_snapshot(_entries(source), [destination], 'p', '20240102000000', _Log())
+
+    assert count == 1
+    assert load_snapshot(snapshot_file)['files'][str(source)]['chunks'] != []
+
+
+def test_files_are_read_once_for_all_stores(tmp_path, monkeypatch):
+    unchanged, changed = tmp_path / 'unchanged.bin', tmp_path / 'changed.bin'
+    unchanged.write_bytes(_random_bytes(512 * 1024, 7))
+    changed.write_bytes(_random_bytes(512 * 1024, 8))
+    first, second = str(tmp_path / 'first'), str(tmp_path / 'second')
+    # the first store has a snapshot of the unchanged file already
+    store_snapshot(_entries(unchanged), [first], 'p', '20240101000000', _Log())
+    store_file = chunkstore._store_file
+    reads = []
+
+    def record(filepath, destination_directories, throttle):
+        reads.append((os.path.basename(filepath), destination_directories))
+        return store_file(filepath, destination_directories, throttle)
+
+    monkeypatch.setattr(chunkstore, '_store_file', record)
+    snapshots = store_snapshot(_entries(unchanged, changed), [first, second], 'p', '20240102000000', _Log())
+
+    assert sorted(reads) == [('changed.bin', [first, second]), ('unchanged.bin', [second])]
+    assert [count for _, count in snapshots] == [2, 2]
+    for destination, (snapshot_file, _) in zip((first, second), snapshots):
+        for path, file_info in load_snapshot(snapshot_file)['files'].items():
+            with open(path, 'rb') as f:
+                assert b''.join(read_chunk(destination, chunk_hash) for chunk_hash in file_info['chunks']) == f.read()
+
+
+def test_cleanup_deletes_unreferenced_chunks(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    shared, old, new = source / 'shared.bin', source / 'old.bin', source / 'new.bin'
+    shared.write_bytes(_random_bytes(512 * 1024, 4))
+    old.write_bytes(_random_bytes(512 * 1024, 5))
+    destination = str(tmp_path / 'destination')
+
+    old_time = (datetime.now() - timedelta(days=30)).strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+    [(old_snapshot, _)] = store_snapshot(_entries(shared, old), [destination], 'p', old_time, _Log())
+    old_chunks = _chunk_files(destination)
+    os.remove(str(old))
+    new.write_bytes(_random_bytes(512 * 1024, 6))
+    new_time = datetime.now().strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+    [(new_snapshot, _)] = store_snapshot(_entries(shared, new), [destination], 'p', new_time, _Log())
+    with Catalog(destination) as catalog:
+        for backup_time, snapshot_file in ((old_time, old_snapshot), (new_time, new_snapshot)):
+            catalog.add_backup(BackupRecord('p', backup_time, os.path.relpath(snapshot_file, destination), BACKUP_KIND_SNAPSHOT,
+                                            os.path.getsize(snapshot_file), 2, None, BACKUP_MODE_FULL))
+
+    cleanup_chunk_store(destination, 10)
+
+    assert not os.path.exists(old_snapshot)
+    assert os.path.exists(new_snapshot)
+    new_files = load_snapshot(new_snapshot)['files']
+    assert _chunk_files(destination) == {chunk_hash for file_info in new_files.values() for chunk_hash in file_info['chunks']}
+    # the chunks of the shared file are still there, the ones of the deleted file are gone
+    assert set(new_files[str(shared)]['chunks']) <= old_chunks
+    assert len(old_chunks - _chunk_files(destination)) == 1
+
+
+def test_unregistered_snapshots_expire(tmp_path):
+    source = tmp_path / 'a.bin'
+    source.write_bytes(_random_bytes(1024, 9))
+    destination = str(tmp_path / 'destination')
+    old_time = (datetime.now() - timedelta(days=30)).strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+    new_time = datetime.now().strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+    [(old_snapshot, _)] = store_snapshot(_entries(source), [destination], 'p', old_time, _Log())
+    [(new_snapshot, _)] = store_snapshot(_entries(source), [destination], 'p', new_time, _Log())
+    # only the new snapshot could be registered
+    with Catalog(destination) as catalog:
+        catalog.remove_backup(os.path.relpath(old_snapshot, destination))
+
+    cleanup_chunk_store(destination, 10)
+
+    assert not os.path.exists(old_snapshot)
+    assert os.path.exists(new_snapshot)
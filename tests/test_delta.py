@@ -0,0 +1,106 @@
+import io
+import os
+import random
+import zipfile
+
+import pytest
+
+from backup.catalog import Catalog
+from backup.delta import Signature, SignatureBuilder, iter_delta, apply_delta, get_delta_arcname
+
+from conftest import write_config, run_cli, next_second, read_tree
+
+BLOCK_SIZE = 4096
+BASE_TIME = '20240101000000'
+
+
+def _signature(data: bytes, backup_time: str = BASE_TIME) -> Signature:
+    builder = SignatureBuilder(Signature('/file', len(data), 1, backup_time, BLOCK_SIZE))
+    # fed in pieces that are not aligned to the blocks
+    for i in range(0, len(data), 10000):
+        builder.update(data[i:i + 10000])
+    return builder.finish()
+
+
+def _round_trip(old: bytes, new: bytes) -> bytes:
+    builder = SignatureBuilder(Signature('/file', len(new), 2, '20240102000000', BLOCK_SIZE))
+    delta = b''.join(iter_delta(io.BytesIO(new), _signature(old), builder))
+    out = io.BytesIO()
+    apply_delta(io.BytesIO(old), io.BytesIO(delta), out, BASE_TIME)
+    assert out.getvalue() == new
+    # the signatures of the new version are built while encoding
+    signature, expected = builder.finish(), _signature(new, '20240102000000')
+    assert (signature.length, signature.weak, signature.strong) == (expected.length, expected.weak, expected.strong)
+    return delta
+
+
+OLD = random.Random(1).randbytes(1024 * 1024 + 123)
+
+
+def _overwrite(data: bytes, position: int, length: int) -> bytes:
+    return data[:position] + random.Random(position).randbytes(length) + data[position + length:]
+
+
+@pytest.mark.parametrize('new', [
+    OLD,
+    _overwrite(_overwrite(OLD, 5000, 100), 700000, 3000),
+    OLD[:300000] + b'inserted' * 50 + OLD[300000:],
+    OLD[:200000] + OLD[210003:],
+    OLD + b'appended',
+    OLD[:500000],
+    b'',
+], ids=['unchanged', 'overwritten', 'inserted', 'deleted', 'appended', 'truncated', 'empty'])
+def test_delta_round_trip(new):
+    delta = _round_trip(OLD, new)
+    # only the changes (and the copy instructions) are stored
+    assert len(delta) < 20000
+
+
+def test_unrelated_and_small_files():
+    _round_trip(OLD, random.Random(2).randbytes(300000))
+    _round_trip(b'', b'new content')
+    _round_trip(b'short', b'short, but longer')
+
+
+def test_delta_of_another_base_is_rejected():
+    new = _overwrite(OLD, 1000, 10)
+    delta = b''.join(iter_delta(io.BytesIO(new), _signature(OLD), SignatureBuilder(Signature('/file', len(new), 2, '20240102000000', BLOCK_SIZE))))
+    with pytest.raises(ValueError):
+        apply_delta(io.BytesIO(OLD), io.BytesIO(delta), io.BytesIO(), '20231231000000')
+    with pytest.raises(ValueError):
+        apply_delta(io.BytesIO(_overwrite(OLD, 600000, 10)), io.BytesIO(delta), io.BytesIO(), BASE_TIME)
+    with pytest.raises(ValueError):
+        apply_delta(io.BytesIO(OLD), io.BytesIO(delta[:-10]), io.BytesIO(), BASE_TIME)
+
+
+def test_incremental_backup_stores_deltas(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    large = source / 'large.bin'
+    large.write_bytes(random.Random(3).randbytes(3 * 1024 * 1024))
+    (source / 'small.txt').write_text('small')
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': [str(source) + '/'], 'mode': 'incremental', 'days_between_full': -1, 'delta_min_size': 1}],
+                          [{'id': 'd', 'directory': str(destination)}])
+    assert run_cli(config) == 0
+    first = read_tree(source)
+
+    for version in range(2):
+        next_second()
+        large.write_bytes(_overwrite(large.read_bytes(), 1000000 + version * 5000, 100))
+        assert run_cli(config) == 0
+
+    with Catalog(str(destination)) as catalog:
+        records = catalog.list_backups('p')
+        assert [[f.delta for f in catalog.find_files(record.filename, [])] for record in records] == [[False, False], [True], [True]]
+    with zipfile.ZipFile(catalog.get_file(records[-1])) as archive:
+        delta_info = archive.getinfo(get_delta_arcname(str(large).lstrip(os.sep)))
+        assert delta_info.file_size < 100 * 1024
+
+    # the latest version is rebuilt from the full backup and both deltas
+    latest = tmp_path / 'latest'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(latest)) == 0
+    assert read_tree(os.path.join(str(latest), str(source).lstrip(os.sep))) == read_tree(source)
+    earlier = tmp_path / 'earlier'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(earlier), '-T', records[0].backup_time) == 0
+    assert read_tree(os.path.join(str(earlier), str(source).lstrip(os.sep))) == first
@@ -0,0 +1,39 @@
+import os
+import json
+
+from backup.logmgr import LogManager
+
+
+def _events(log_directory) -> list[dict]:
+    with open(os.path.join(str(log_directory), 'events_backup000000000000.jsonl'), encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_debug_messages_are_printed_at_every_log_level(tmp_path, capsys):
+    log = LogManager('000000000000', str(tmp_path), 'info')
+    log.configure()
+    log.log_debug('details')
+    log.log_hint('hint')
+    log.close()
+
+    assert 'DEBUG:: details' in capsys.readouterr().out
+    # the log level applies to the event log
+    assert [event['msg'] for event in _events(tmp_path)] == ['hint']
+
+
+
+
+
+def test_errors_are_written_in_batches(tmp_path, capsys):
+    log = LogManager('000000000000', str(tmp_path), 'debug')
+    log.configure()
+    for i in range(1000):
+        log.log_error('cannot read file{}'.format(i), path='file{}'.format(i))
+    log.log_debug('details')
+    log.close()
+
+    events = _events(tmp_path)
+    assert log.error_count == 1000
+    assert [event['level'] for event in events] == ['error'] * 1000 + ['debug']
+    assert events[999]['path'] == 'file999'
+    assert os.path.exists(os.path.join(str(tmp_path), 'ERROR_occured_backup000000000000.log'))
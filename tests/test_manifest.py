@@ -0,0 +1,85 @@
+import os
+import json
+from datetime import datetime
+
+from backup.manifest import (Manifest, ChangeDetector, MANIFEST_FILENAME, STATE_HASH, load_manifest, save_manifest, needs_full_backup,
+                             hash_file)
+from backup.scanner import get_scan_entry
+from backup.utils import BACKUP_FILENAME_FORMAT_DATETIMESTAMP
+
+
+def _scan(directory) -> list:
+    return sorted(get_scan_entry(entry.path, entry.stat()) for entry in os.scandir(str(directory)) if entry.is_file())
+
+
+def _changed(detector: ChangeDetector, directory) -> list[str]:
+    return [os.path.basename(entry.path) for entry in detector.iter_changed(_scan(directory))]
+
+
+def _manifest(detector: ChangeDetector) -> Manifest:
+    manifest = Manifest()
+    manifest.files = detector.states
+    return manifest
+
+
+def test_new_changed_and_deleted_files(tmp_path):
+    for name in ('a', 'b', 'c'):
+        (tmp_path / name).write_text(name)
+    detector = ChangeDetector(None, False)
+    assert _changed(detector, tmp_path) == ['a', 'b', 'c']
+    assert detector.get_deleted() == []
+
+    (tmp_path / 'a').write_text('longer content')
+    (tmp_path / 'b').unlink()
+    (tmp_path / 'd').write_text('d')
+    detector = ChangeDetector(_manifest(detector), False)
+    assert _changed(detector, tmp_path) == ['a', 'd']
+    assert detector.get_deleted() == [str(tmp_path / 'b')]
+    assert detector.changed_count == 2
+    # the new manifest has the state of all current files
+    assert sorted(os.path.basename(path) for path in detector.states) == ['a', 'c', 'd']
+
+
+def test_touched_files_are_compared_by_hash(tmp_path):
+    (tmp_path / 'same').write_text('content')
+    (tmp_path / 'other').write_text('content')
+    detector = ChangeDetector(None, True)
+    assert _changed(detector, tmp_path) == ['other', 'same']
+    assert detector.states[str(tmp_path / 'same')][STATE_HASH] == hash_file(str(tmp_path / 'same'))
+
+    # new mtime, same size: the content decides
+    os.utime(str(tmp_path / 'same'), ns=(0, 10 ** 18))
+    (tmp_path / 'other').write_text('CONTENT')
+    os.utime(str(tmp_path / 'other'), ns=(0, 10 ** 18))
+    with_hash = ChangeDetector(_manifest(detector), True)
+    assert _changed(with_hash, tmp_path) == ['other']
+    without_hash = ChangeDetector(_manifest(detector), False)
+    assert _changed(without_hash, tmp_path) == ['other', 'same']
+
+
+def test_destinations_have_to_agree_on_the_manifest(tmp_path):
+    destinations = [str(tmp_path / 'd1'), str(tmp_path / 'd2')]
+    manifest = Manifest.from_dict({'backup_time': '20240102000000', 'full_backup_time': '20240101000000', 'files': {'/a': [1, 2, 3, None]}})
+    for destination in destinations:
+        save_manifest(manifest, destination)
+    loaded = load_manifest(destinations)
+    assert loaded.to_dict() == manifest.to_dict()
+
+    # a destination that missed the last backup
+    manifest.backup_time = '20240103000000'
+    save_manifest(manifest, destinations[1])
+    assert load_manifest(destinations) is None
+    # a damaged manifest
+    with open(os.path.join(destinations[0], MANIFEST_FILENAME), 'w', encoding='utf-8') as f:
+        f.write('{"backup_time": ')
+    assert load_manifest(destinations[:1]) is None
+    assert load_manifest([str(tmp_path / 'missing')]) is None
+
+
+def test_needs_full_backup():
+    manifest = Manifest.from_dict(json.loads('{"backup_time": "20240110000000", "full_backup_time": "20240101000000"}'))
+    now = datetime(2024, 1, 8)
+    assert needs_full_backup(None, 7, now, BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+    assert needs_full_backup(manifest, 7, now, BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+    assert not needs_full_backup(manifest, 8, now, BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+    assert not needs_full_backup(manifest, -1, now, BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
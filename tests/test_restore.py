@@ -0,0 +1,163 @@
+import os
+import shutil
+
+import pytest
+
+from backup import configs
+from backup.catalog import Catalog
+from backup.compression import FORMAT_TAR_GZ
+from backup.manifest import load_manifest
+
+from conftest import write_config, run_cli, next_second, read_tree
+
+
+def _restored(target, source) -> dict[str, bytes]:
+    # the files restored into target (below the absolute path of the source)
+    return read_tree(os.path.join(str(target), str(source).lstrip(os.sep)))
+
+
+def _backup_times(destination, profile: str) -> list[str]:
+    with Catalog(str(destination)) as catalog:
+        return sorted({record.backup_time for record in catalog.list_backups(profile)})
+
+
+@pytest.mark.parametrize('profile', [
+    {'compression': {'format': 'zip'}},
+    {'compression': {'format': FORMAT_TAR_GZ}},
+    {'compression': {'format': 'zip'}, 'volume_size': 1},
+    {'compression': {'format': 'zip', 'codec': 'lzma'}, 'workers': 1},
+], ids=['zip', 'tar.gz', 'volumes', 'lzma'])
+def test_archive_round_trip(tmp_path, source, profile):
+    # volumes of 1 MiB: the large file spans several of them
+    (source / 'large.bin').write_bytes(os.urandom(3 * 1024 * 1024))
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [dict({'id': 'p', 'source': [str(source) + '/']}, **profile)], [{'id': 'd', 'directory': str(destination)}])
+    assert run_cli(config) == 0
+    if 'volume_size' in profile:
+        with Catalog(str(destination)) as catalog:
+            assert len(catalog.list_backups('p')) > 1
+
+    target = tmp_path / 'restored'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(target)) == 0
+    assert _restored(target, source) == read_tree(source)
+
+
+def test_snapshot_round_trip(tmp_path, source):
+    # two chunk stores, filled by one scan
+    config = write_config(tmp_path, [{'id': 'p', 'source': [str(source) + '/']}],
+                          [{'id': destination, 'directory': str(tmp_path / destination), 'storage': 'chunks'} for destination in ('d1', 'd2')])
+    assert run_cli(config) == 0
+
+    for destination in ('d1', 'd2'):
+        target = tmp_path / ('restored_' + destination)
+        assert run_cli(config, 'restore', '-p', 'p', '-d', destination, '--target', str(target)) == 0
+        assert _restored(target, source) == read_tree(source)
+
+
+def test_incremental_chain_round_trip(tmp_path, source):
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': [str(source) + '/'], 'mode': 'incremental', 'days_between_full': -1}],
+                          [{'id': 'd', 'directory': str(destination)}])
+    assert run_cli(config) == 0
+    first = read_tree(source)
+    next_second()
+    (source / 'docs' / 'a.txt').write_text('changed\n')
+    (source / 'c.log').unlink()
+    (source / 'new.txt').write_text('new file\n')
+    assert run_cli(config) == 0
+    assert len(_backup_times(destination, 'p')) == 2
+
+    # the latest state: changed, deleted and new files
+    latest = tmp_path / 'latest'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(latest)) == 0
+    assert _restored(latest, source) == read_tree(source)
+
+    # the state of the full backup
+    earlier = tmp_path / 'earlier'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(earlier), '-T', _backup_times(destination, 'p')[0]) == 0
+    assert _restored(earlier, source) == first
+
+
+def test_vanished_files_are_left_out(tmp_path, source, monkeypatch):
+    from backup import backupmgr
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': [str(source) + '/'], 'mode': 'incremental', 'days_between_full': -1}],
+                          [{'id': 'd', 'directory': str(destination)}])
+    assert run_cli(config) == 0
+    next_second()
+    changed = source / 'docs' / 'a.txt'
+    changed.write_text('changed\n')
+
+    iter_files = backupmgr.iter_files
+
+    def vanish(*args, **kwargs):
+        # the changed file is deleted between the scan and the archive
+        for entry in iter_files(*args, **kwargs):
+            if entry.path == str(changed):
+                os.remove(entry.path)
+            yield entry
+
+    monkeypatch.setattr(backupmgr, 'iter_files', vanish)
+    assert run_cli(config) == 0
+    assert str(changed) not in load_manifest([str(destination / 'BACKUP_p')]).files
+    with Catalog(str(destination)) as catalog:
+        latest = catalog.list_backups('p')[-1]
+        assert [(record.arcname, record.deleted) for record in catalog.find_files(latest.filename, [])] == [(str(changed).lstrip(os.sep), True)]
+
+    target = tmp_path / 'restored'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(target)) == 0
+    assert _restored(target, source) == read_tree(source)
+
+
+def test_relative_sources_are_restored_to_their_origin(tmp_path, source, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': ['source/docs/', 'source/*.log']}], [{'id': 'd', 'directory': str(destination)}])
+    assert run_cli(config) == 0
+    expected = read_tree(source)
+    shutil.rmtree(str(source))
+
+    # without --target, into the directory the sources were relative to
+    assert run_cli(config, 'restore', '-p', 'p') == 0
+    assert read_tree(source) == expected
+
+    # relative paths select files like absolute ones
+    target = tmp_path / 'restored'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(target), 'source/docs/a.txt') == 0
+    assert read_tree(target) == {os.path.join(str(source / 'docs' / 'a.txt').lstrip(os.sep)): expected[os.path.join('docs', 'a.txt')]}
+
+
+def test_relative_member_names_of_older_backups(tmp_path, source, monkeypatch):
+    # backups made before relative sources were resolved have relative member names
+    monkeypatch.chdir(str(tmp_path))
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': ['source/']}], [{'id': 'd', 'directory': str(destination)}])
+    with monkeypatch.context() as context:
+        context.setattr(configs, 'resolve_source', lambda source: source)
+        assert run_cli(config) == 0
+    expected = read_tree(source)
+    shutil.rmtree(str(source))
+
+    # a relative path selects them and restores them relative to the current directory
+    assert run_cli(config, 'restore', '-p', 'p', 'source/docs/') == 0
+    assert read_tree(source) == {path: data for path, data in expected.items() if path.startswith('docs' + os.sep)}
+    assert not (tmp_path / 'source' / 'c.log').exists()
+
+
+def test_incremental_backup_after_relative_member_names(tmp_path, source, monkeypatch):
+    # the first run after relative sources were resolved is a full backup
+    monkeypatch.chdir(str(tmp_path))
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': ['source/'], 'mode': 'incremental', 'days_between_full': -1}], [{'id': 'd', 'directory': str(destination)}])
+    with monkeypatch.context() as context:
+        context.setattr(configs, 'resolve_source', lambda source: source)
+        assert run_cli(config) == 0
+    next_second()
+    assert run_cli(config) == 0
+
+    with Catalog(str(destination)) as catalog:
+        assert [record.mode for record in catalog.list_backups('p')] == ['full', 'full']
+    assert all(os.path.isabs(filepath) for filepath in load_manifest([str(destination / 'BACKUP_p')]).files)
+    target = tmp_path / 'restored'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(target)) == 0
+    assert _restored(target, source) == read_tree(source)
@@ -0,0 +1,180 @@
+import os
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from backup.catalog import Catalog, BackupRecord, BACKUP_KIND_ARCHIVE, BACKUP_KIND_SNAPSHOT
+from backup.manifest import BACKUP_MODE_FULL, BACKUP_MODE_INCREMENTAL, MANIFEST_FILENAME
+from backup.restore import get_backup_chain
+from backup.utils import cleanup_destination, BACKUP_FILENAME_FORMAT_DATETIMESTAMP
+from backup.volumes import get_volume_index_filename
+
+from conftest import write_config, run_cli, next_second, read_tree
+
+NOW = datetime.now().replace(microsecond=0)
+
+
+def _time(days: int) -> str:
+    return (NOW - timedelta(days=days)).strftime(BACKUP_FILENAME_FORMAT_DATETIMESTAMP)
+
+
+def _add(catalog: Catalog, profile: str, days: int, mode: str, suffix: str = '.zip', kind: str = BACKUP_KIND_ARCHIVE) -> str:
+    # an archive of the profile, days ago - stored and registered in the catalog
+    filename = os.path.join('BACKUP_' + profile, 'archive' + _time(days) + suffix)
+    filepath = catalog.get_file(BackupRecord(profile, _time(days), filename, kind, 0, 0, None, mode))
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'wb') as f:
+        f.write(b'archive')
+    catalog.add_backup(BackupRecord(profile, _time(days), filename, kind, 7, 1, None, mode))
+    return filename
+
+
+def _stored(destination) -> set[str]:
+    return {os.path.relpath(os.path.join(root, name), str(destination)) for root, _, files in os.walk(str(destination)) for name in files
+            if name.startswith('archive')}
+
+
+def test_chain_expires_with_its_newest_backup(tmp_path):
+    with Catalog(str(tmp_path)) as catalog:
+        old_chain = [_add(catalog, 'p', 40, BACKUP_MODE_FULL), _add(catalog, 'p', 35, BACKUP_MODE_INCREMENTAL), _add(catalog, 'p', 20, BACKUP_MODE_INCREMENTAL)]
+        # the full backup is older than days_to_keep, its last incremental backup is not
+        current_chain = [_add(catalog, 'p', 12, BACKUP_MODE_FULL), _add(catalog, 'p', 5, BACKUP_MODE_INCREMENTAL)]
+        other_profile = [_add(catalog, 'q', 30, BACKUP_MODE_FULL)]
+
+    cleanup_destination(str(tmp_path), 10)
+
+    assert _stored(tmp_path) == set(current_chain)
+    with Catalog(str(tmp_path)) as catalog:
+        assert [record.filename for record in catalog.list_backups()] == current_chain
+    assert set(old_chain + other_profile).isdisjoint(_stored(tmp_path))
+
+
+def test_unregistered_archives_expire(tmp_path):
+    # the catalog of the run that wrote the old archive could not be updated
+    with Catalog(str(tmp_path)) as catalog:
+        unregistered = _add(catalog, 'p', 30, BACKUP_MODE_FULL)
+        catalog.remove_backup(unregistered)
+        current = _add(catalog, 'p', 2, BACKUP_MODE_FULL)
+
+    cleanup_destination(str(tmp_path), 10)
+
+    assert _stored(tmp_path) == {current}
+    with Catalog(str(tmp_path)) as catalog:
+        assert [record.filename for record in catalog.list_backups()] == [current]
+
+
+def test_chain_without_new_full_backup_is_kept(tmp_path):
+    # "days_between_full": -1 - the first backup is the base of all others
+    with Catalog(str(tmp_path)) as catalog:
+        chain = [_add(catalog, 'p', 100, BACKUP_MODE_FULL)] + [_add(catalog, 'p', days, BACKUP_MODE_INCREMENTAL) for days in (80, 50, 20, 1)]
+
+    cleanup_destination(str(tmp_path), 10)
+
+    assert _stored(tmp_path) == set(chain)
+
+
+def test_volumes_of_a_full_backup_stay_in_one_chain(tmp_path):
+    with Catalog(str(tmp_path)) as catalog:
+        volumes = [_add(catalog, 'p', 30, BACKUP_MODE_FULL, '.vol{:03d}.zip'.format(i)) for i in (1, 2)]
+        incremental = _add(catalog, 'p', 2, BACKUP_MODE_INCREMENTAL)
+        chains = catalog.get_backup_chains('p')
+    assert [[record.filename for record in chain] for chain in chains] == [volumes + [incremental]]
+
+
+def test_volume_index_expires_with_its_set(tmp_path):
+    with Catalog(str(tmp_path)) as catalog:
+        expired = [_add(catalog, 'p', 30, BACKUP_MODE_FULL, '.vol{:03d}.zip'.format(i)) for i in (1, 2)]
+        current = [_add(catalog, 'p', 2, BACKUP_MODE_FULL, '.vol{:03d}.zip'.format(i)) for i in (1, 2)]
+    index_files = [tmp_path / 'BACKUP_p' / get_volume_index_filename(_time(days)) for days in (30, 2)]
+    for index_file in index_files:
+        index_file.write_text('{}')
+
+    cleanup_destination(str(tmp_path), 10)
+
+    assert _stored(tmp_path) == set(current)
+    assert set(expired).isdisjoint(_stored(tmp_path))
+    assert [index_file.exists() for index_file in index_files] == [False, True]
+
+
+def test_snapshots_expire_on_their_own(tmp_path):
+    with Catalog(str(tmp_path)) as catalog:
+        for days in (30, 20, 1):
+            catalog.add_backup(BackupRecord('p', _time(days), os.path.join('BACKUP_p', 'snapshot' + _time(days) + '.json'), BACKUP_KIND_SNAPSHOT, 1, 1, None, BACKUP_MODE_FULL))
+        expired = catalog.get_expired_backups(NOW - timedelta(days=10), BACKUP_KIND_SNAPSHOT)
+    assert [record.backup_time for record in expired] == [_time(30), _time(20)]
+
+
+def test_rebuilt_catalog_keeps_archives_of_unknown_mode(tmp_path):
+    destination = tmp_path / 'destination'
+    with Catalog(str(destination)) as catalog:
+        older = [_add(catalog, 'p', 60, BACKUP_MODE_FULL), _add(catalog, 'p', 40, BACKUP_MODE_INCREMENTAL)]
+        current = [_add(catalog, 'p', 30, BACKUP_MODE_FULL), _add(catalog, 'p', 2, BACKUP_MODE_INCREMENTAL)]
+        full_only = [_add(catalog, 'q', 60, BACKUP_MODE_FULL), _add(catalog, 'q', 1, BACKUP_MODE_FULL)]
+    with open(destination / 'BACKUP_p' / MANIFEST_FILENAME, 'w', encoding='utf-8') as f:
+        json.dump({'backup_time': _time(2), 'full_backup_time': _time(30), 'files': {}}, f)
+    os.remove(destination / 'backup_catalog.sqlite')
+
+    with Catalog(str(destination)) as catalog:
+        modes = {record.filename: record.mode for record in catalog.list_backups()}
+    # the current chain is known from the manifest; the profile without manifest only has full backups
+    assert modes == {older[0]: None, older[1]: None, current[0]: BACKUP_MODE_FULL, current[1]: BACKUP_MODE_INCREMENTAL,
+                     full_only[0]: BACKUP_MODE_FULL, full_only[1]: BACKUP_MODE_FULL}
+
+    # the older chain of unknown modes expires with its newest backup
+    cleanup_destination(str(destination), 50)
+    assert _stored(destination) == set(older + current + full_only[1:])
+    cleanup_destination(str(destination), 20)
+    assert _stored(destination) == set(current + full_only[1:])
+
+
+def test_restore_chain_without_full_backup_fails():
+    full = BackupRecord('p', _time(3), 'BACKUP_p/a.zip', BACKUP_KIND_ARCHIVE, 1, 1, None, BACKUP_MODE_FULL)
+    incremental = [BackupRecord('p', _time(days), 'BACKUP_p/{}.zip'.format(days), BACKUP_KIND_ARCHIVE, 1, 1, None, BACKUP_MODE_INCREMENTAL) for days in (2, 1)]
+    assert get_backup_chain([full] + incremental) == [full] + incremental
+    assert get_backup_chain([]) == []
+    with pytest.raises(ValueError):
+        get_backup_chain(incremental)
+
+
+def test_missing_full_backup_forces_a_full_backup(tmp_path, source):
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': [str(source) + '/'], 'mode': 'incremental', 'days_between_full': -1}],
+                          [{'id': 'd', 'directory': str(destination)}])
+    assert run_cli(config) == 0
+    full_backup = sorted(_stored(destination))
+    next_second()
+    (source / 'c.log').write_text('changed\n')
+    assert run_cli(config) == 0
+    assert len(_stored(destination)) == 2
+
+    # the full backup is lost: the next backup must not depend on it
+    os.remove(destination / full_backup[0])
+    next_second()
+    (source / 'new.txt').write_text('new\n')
+    assert run_cli(config) == 0
+    with Catalog(str(destination)) as catalog:
+        backups = catalog.list_backups('p')
+    assert backups[-1].mode == BACKUP_MODE_FULL
+
+    target = tmp_path / 'restored'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(target)) == 0
+    assert read_tree(target / str(source).lstrip(os.sep)) == read_tree(source)
+
+
+def test_restore_of_a_broken_chain_fails(tmp_path, source):
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': [str(source) + '/'], 'mode': 'incremental', 'days_between_full': -1}],
+                          [{'id': 'd', 'directory': str(destination)}])
+    assert run_cli(config) == 0
+    next_second()
+    (source / 'c.log').write_text('changed\n')
+    assert run_cli(config) == 0
+    with Catalog(str(destination)) as catalog:
+        full_backup = catalog.list_backups('p')[0]
+        os.remove(catalog.get_file(full_backup))
+        catalog.remove_backup(full_backup.filename)
+
+    target = tmp_path / 'restored'
+    assert run_cli(config, 'restore', '-p', 'p', '--target', str(target)) == 1
+    assert not target.exists()
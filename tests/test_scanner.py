@@ -0,0 +1,113 @@
+import os
+import glob
+import threading
+
+import pytest
+
+from backup import scanner
+from backup.planner import ScanPlan
+from backup.utils import iter_files
+
+
+@pytest.fixture
+def tree(tmp_path):
+    # /data with pascal sources at several levels, hidden entries and a directory named like a file
+    root = tmp_path / 'data'
+    for path in ['a.pas', 'src/b.pas', 'src/b.txt', 'x/src/c.pas', 'x/y/src/d.pas', 'x/y/src/sub/e.txt',
+                 '.hidden/src/f.pas', 'x/.g.pas', 'dir.pas/h.txt', 'tmp/src/i.pas']:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text(path)
+    return root
+
+
+def _files(patterns, ignore=None) -> list[str]:
+    files = [entry.path for entry in iter_files(patterns, ignore or [])]
+    assert len(files) == len(set(files))
+    return sorted(files)
+
+
+def _glob(patterns) -> list[str]:
+    # the files selected by the old glob.glob expansion of the sources
+    files = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern, recursive=True):
+            if os.path.isdir(path):
+                files.update(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+            else:
+                files.add(path)
+    return sorted(os.path.normpath(path) for path in files)
+
+
+@pytest.mark.parametrize('patterns', [['**/*.pas'], ['**/src/'], ['**/src/*.pas'], ['*'], ['**'], ['x/*/src/'], ['*/src/*.txt'],
+                                      ['**/src', 'x/'], ['[sx]/**/*.pas'], ['**/.hidden/**'], ['src/b.pas', '**/*.pas']])
+def test_glob_sources_select_the_same_files_as_glob(tree, patterns):
+    patterns = [os.path.join(str(tree), pattern) for pattern in patterns]
+    assert [os.path.normpath(path) for path in _files(patterns)] == _glob(patterns)
+
+
+def test_relative_glob_sources_keep_relative_paths(tree, monkeypatch):
+    monkeypatch.chdir(str(tree))
+    assert _files(['**/src/*.pas']) == sorted(['src/b.pas', 'x/src/c.pas', 'x/y/src/d.pas', 'tmp/src/i.pas'])
+
+
+def test_ignored_directories_are_not_walked(tree):
+    patterns = [os.path.join(str(tree), '**/*.pas')]
+    assert 'i.pas' not in {os.path.basename(path) for path in _files(patterns, ['*/tmp/'])}
+
+
+def test_every_directory_is_listed_once(tree, monkeypatch):
+    listed: list[str] = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        listed.append(os.path.normpath(path))
+        return scandir(path)
+
+    patterns = [os.path.join(str(tree), pattern) for pattern in ['**/*.pas', '**/src/', 'x/', 'x/y/*/*.txt']]
+    expected = _glob(patterns)
+    monkeypatch.setattr(scanner.os, 'scandir', counting_scandir)
+    files = _files(patterns)
+
+    assert files == expected
+    assert len(listed) == len(set(listed))
+    # hidden directories cannot match and are pruned
+    assert os.path.join(str(tree), '.hidden') not in listed
+
+
+def test_symbolic_link_matching_a_pattern_is_scanned(tree, tmp_path):
+    linked = tmp_path / 'linked'
+    (linked / 'src').mkdir(parents=True)
+    (linked / 'src' / 'l.pas').write_text('l')
+    os.symlink(str(linked), str(tree / 'link'))
+
+    assert os.path.join(str(tree), 'link', 'src', 'l.pas') in _files([os.path.join(str(tree), '*')])
+    # links are not followed to match the patterns below them
+    assert os.path.join(str(tree), 'link', 'src', 'l.pas') not in _files([os.path.join(str(tree), '**/*.pas')])
+
+
+def test_scan_plan_matches_glob_sources(tree):
+    sources = {
+        'pascal': [os.path.join(str(tree), '**/*.pas')],
+        'src': [os.path.join(str(tree), '**/src/')],
+        'all': [os.path.join(str(tree), '')],
+        'text': [os.path.join(str(tree), 'x/**/*.txt'), os.path.join(str(tree), 'dir.pas/')],
+    }
+    plan = ScanPlan(4)
+    for profile_id, source in sources.items():
+        plan.add_profile(profile_id, source, ['*/tmp/'])
+    plan.start()
+    results: dict[str, list[str]] = {}
+
+    def take(profile_id: str) -> None:
+        results[profile_id] = sorted(entry.path for entry in plan.take(profile_id))
+
+    threads = [threading.Thread(target=take, args=(profile_id,)) for profile_id in sources]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    plan.close()
+
+    for profile_id, source in sources.items():
+        assert results[profile_id] == _files(source, ['*/tmp/'])
+
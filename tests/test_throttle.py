@@ -0,0 +1,88 @@
+import io
+import os
+import sys
+import time
+import subprocess
+
+import pytest
+
+from backup.throttle import MIB, TokenBucket, Throttle, ThrottleGroup, throttle_file, parse_io_priority
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a thread that is already running (like the log writer) reports its nice value
+# after the priority of the process was set
+_THREAD_PRIORITY = '''
+import os, threading
+from backup.throttle import set_process_priority
+started, priority_set, result = threading.Event(), threading.Event(), []
+def run():
+    started.set()
+    priority_set.wait()
+    result.append(os.getpriority(os.PRIO_PROCESS, 0))
+thread = threading.Thread(target=run)
+thread.start()
+started.wait()
+set_process_priority(nice=os.getpriority(os.PRIO_PROCESS, 0) + 5)
+priority_set.set()
+thread.join()
+print(os.getpriority(os.PRIO_PROCESS, 0), result[0])
+'''
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='nice values per thread (Linux)')
+def test_priority_applies_to_running_threads():
+    output = subprocess.run([sys.executable, '-c', _THREAD_PRIORITY], cwd=REPOSITORY, capture_output=True, text=True, check=True).stdout
+    main_thread, running_thread = output.split()
+    assert running_thread == main_thread
+    assert int(main_thread) == os.getpriority(os.PRIO_PROCESS, 0) + 5
+
+
+def test_token_bucket_takes_tokens_in_advance():
+    bucket = TokenBucket(1000)
+    # the burst is free, a larger request waits for its debt
+    assert bucket.consume(500) == 0
+    wait = bucket.consume(1000)
+    assert 0.9 < wait <= 1.0
+    # the next request waits behind it
+    assert bucket.consume(100) > wait
+
+
+def test_throttled_reads_and_writes(tmp_path):
+    data = os.urandom(3 * MIB)
+    (tmp_path / 'source').write_bytes(data)
+    throttle = Throttle(read_rate=4 * MIB)
+    group = ThrottleGroup(throttle, {str(tmp_path): Throttle(write_rate=4 * MIB), 'other': Throttle(write_rate=1)})
+
+    start = time.perf_counter()
+    with group.open_source(str(tmp_path / 'source')) as f:
+        read = b''.join(iter(lambda: f.read(256 * 1024), b''))
+    # 3 MiB at 4 MiB/s, minus the burst of half a second
+    assert read == data
+    assert time.perf_counter() - start >= 0.2
+    assert throttle.delay >= 0.2
+
+    out = io.BytesIO()
+    start = time.perf_counter()
+    writer = group.wrap_destination(str(tmp_path), out)
+    for i in range(0, len(data), 256 * 1024):
+        writer.write(data[i:i + 256 * 1024])
+    assert out.getvalue() == data
+    # the limit of this destination applies, not the one of the other destination
+    assert time.perf_counter() - start >= 0.2
+
+
+def test_unlimited_throttles_are_skipped():
+    f = io.BytesIO(b'data')
+    assert throttle_file(f, [None, Throttle()]) is f
+    assert ThrottleGroup(Throttle()).get_source_opener() is None
+    assert not Throttle().is_active()
+    assert Throttle(iops=10).is_active()
+
+
+def test_parse_io_priority():
+    assert parse_io_priority('idle') == (3, 0)
+    assert parse_io_priority('best-effort') == (2, 4)
+    assert parse_io_priority('realtime:1') == (1, 1)
+    assert parse_io_priority('best-effort:8') is None
+    assert parse_io_priority('fast') is None
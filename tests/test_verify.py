@@ -0,0 +1,65 @@
+import os
+
+from backup.catalog import Catalog
+from backup.chunkstore import CHUNK_DIRECTORY
+from backup.verify import select_blocks
+
+from conftest import write_config, run_cli
+
+
+def _corrupt(filepath: str, offset: int) -> None:
+    with open(filepath, 'r+b') as f:
+        f.seek(offset)
+        data = f.read(1)
+        f.seek(offset)
+        f.write(bytes([data[0] ^ 0xff]))
+
+
+def _backup_files(destination) -> list[str]:
+    with Catalog(str(destination)) as catalog:
+        return [catalog.get_file(record) for record in catalog.list_backups()]
+
+
+def test_verify_archives(tmp_path, source):
+    (source / 'large.bin').write_bytes(os.urandom(2 * 1024 * 1024))
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'zip', 'source': [str(source) + '/']},
+                                     {'id': 'tar', 'source': [str(source) + '/'], 'compression': {'format': 'tar.gz'}},
+                                     {'id': 'volumes', 'source': [str(source) + '/'], 'volume_size': 1}],
+                          [{'id': 'd', 'directory': str(destination)}])
+    assert run_cli(config) == 0
+    assert len([filepath for filepath in _backup_files(destination) if 'BACKUP_volumes' in filepath]) > 1
+    assert run_cli(config, 'verify') == 0
+    assert run_cli(config, 'verify', '-s', '10') == 0
+
+    archive = next(filepath for filepath in _backup_files(destination) if 'BACKUP_tar' in filepath)
+    _corrupt(archive, os.path.getsize(archive) // 2)
+    assert run_cli(config, 'verify') == 1
+    # the other profiles are fine
+    assert run_cli(config, 'verify', '-p', 'zip') == 0
+    assert run_cli(config, 'verify', '-p', 'volumes') == 0
+
+    os.remove(next(filepath for filepath in _backup_files(destination) if 'BACKUP_zip' in filepath))
+    assert run_cli(config, 'verify', '-p', 'zip') == 1
+
+
+def test_verify_snapshots(tmp_path, source):
+    destination = tmp_path / 'destination'
+    config = write_config(tmp_path, [{'id': 'p', 'source': [str(source) + '/']}], [{'id': 'd', 'directory': str(destination), 'storage': 'chunks'}])
+    assert run_cli(config) == 0
+    assert run_cli(config, 'verify') == 0
+
+    chunks = [os.path.join(root, name) for root, _, files in os.walk(str(destination / CHUNK_DIRECTORY)) for name in files]
+    _corrupt(chunks[0], 0)
+    assert run_cli(config, 'verify') == 1
+    os.remove(chunks[0])
+    assert run_cli(config, 'verify') == 1
+
+
+def test_select_blocks():
+    assert select_blocks(5, 100) == [0, 1, 2, 3, 4]
+    assert select_blocks(2, 10) == [0, 1]
+    selected = select_blocks(1000, 10)
+    assert len(selected) == 100
+    assert (selected[0], selected[-1]) == (0, 999)
+    assert selected == sorted(set(selected))